@@ -1,12 +1,21 @@
 from openTron_electrodeposition.ardu import Arduino
+from openTron_electrodeposition import calibration
 import logging
+import os
 from datetime import datetime
 import sys
+import pandas as pd
 from openTron_electrodeposition.parameters import (
     pump_slope,
     pump_intercept,
+    pump_calibration_file,
 )
 
+# Calibrates the pumps and stores their models in pump_calibration_file, which
+# the Arduino loads at startup. Run it with the path of a CSV file with
+# measurements to fit those instead:
+#     python example/example_arduino_pump_calibration.py [measurements.csv]
+
 # Folder where data and log-file will be saved
 DATA_PATH = ""
 ARDUINO_NAME = "CH340"  # Arduino name on Windows
@@ -36,6 +45,7 @@ robot = Arduino(
     list_of_ultrasonic_relays=[6, 7],  # Ultrasonic connected to which relays
     pump_slope=pump_slope,  # dict of pump slopes: a in y = ax + b
     pump_intercept=pump_intercept,  # dict of pump intercepts: b in y = ax + b
+    calibration_file=pump_calibration_file,  # The previous calibration
 )
 
 
@@ -44,21 +54,31 @@ robot = Arduino(
 ###############################################################################
 robot.set_temperature(0, 0)
 robot.set_temperature(1, 0)
-# Write down the weight of dispensed water and tare in between dispensing.
-# Repeat for each pump 3 times.
-# This can, combined with temparature, be used to calibrate the pumps by
-# converting to flow and then making a linear regression to find
-# the slope and intercept for each pump.
 
-list_of_times = [0.5, 1, 2, 5, 10, 15]
-# Ask for user input
-pump_number = int(input("Enter pump number to calibrate: "))
-for seconds in list_of_times:
-    input(f"Press enter to start dispensing {seconds} seconds")
-    robot.set_pump_on(pump_number, seconds)
-    # secondss = int(input("Enter seconds to drain: "))
-    # robot.set_pump_on(3, secondss)
+if len(sys.argv) > 1:
+    measurements = calibration.load_measurements(sys.argv[1])
+else:
+    # Each pump runs for each time 3 times. Tare the scale before each run and
+    # enter the weight of the dispensed water after it.
+    pumps = [int(pump) for pump in input("Enter pump numbers to calibrate: ").split()]
+    measurements = calibration.measure_pumps(
+        robot,
+        pumps=pumps,
+        times=[0.5, 1, 2, 5, 10, 15],
+        repeats=3,
+        scale=calibration.manual_scale,  # or a SimulatedScale to try it out
+    )
+    # Keep all measurements, eg. to refit them later
+    measurements_file = DATA_PATH + "pump_calibration_measurements.csv"
+    measurements.assign(Date=time_now).to_csv(
+        measurements_file,
+        mode="a",
+        header=not os.path.exists(measurements_file),
+        index=False,
+    )
 
-print("Calibration done")
+models = calibration.fit_pumps(measurements)
+print(pd.DataFrame(models).T)
+calibration.save_calibration(models, pump_calibration_file)
 
-robot.dispense_ml(pump=0, ml=1)
+print("Calibration done")
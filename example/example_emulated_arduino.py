@@ -0,0 +1,59 @@
+import sys
+import time
+from openTron_electrodeposition.ardu import Arduino
+from openTron_electrodeposition.emulator import ArduinoEmulator
+
+# Benchmarks the Arduino driver against the emulated firmware: the latency of
+# single commands, the throughput of pipelined commands and the duration of
+# the rinse program of Experiment.cleaning(). Runs on Linux or macOS without
+# the robot: python example/example_emulated_arduino.py [text|binary]
+
+protocol = sys.argv[1] if len(sys.argv) > 1 else "binary"
+COMMANDS = 500
+SPEED = 10  # Firmware clock relative to real time
+
+with ArduinoEmulator(speed=SPEED) as emulator:
+    arduino = Arduino(
+        port=emulator.port,
+        protocol=protocol,
+        telemetry=True,
+        pump_slope={0: 1.0, 1: 1.0, 2: 1.0, 3: 1.0, 4: 1.0, 5: 1.0},
+        pump_intercept={0: 0.0, 1: 0.0, 2: 0.0, 3: 0.0, 4: 0.0, 5: 0.0},
+    )
+
+    start = time.perf_counter()
+    for _ in range(COMMANDS):
+        arduino.get_relay_status(3)
+    latency = (time.perf_counter() - start) / COMMANDS
+
+    start = time.perf_counter()
+    futures = [
+        arduino.send_command("get_relay_3_state", response="state", wait=False)
+        for _ in range(COMMANDS)
+    ]
+    for future in futures:
+        future.result()
+    throughput = COMMANDS / (time.perf_counter() - start)
+
+    # Two water rinses: fill, ultrasound, then drain
+    fill = arduino.pump_time(3, 0.5)
+    drain = arduino.pump_time(5, 2)
+    program = []
+    for start_time in (0, fill + 5 + drain):
+        program += [
+            (3, start_time, fill),
+            (arduino.ultrasound_relay(1), start_time + fill, 5),
+            (5, start_time + fill + 5, drain),
+        ]
+    start = time.perf_counter()
+    timings = arduino.run_program(program)
+    rinse = time.perf_counter() - start
+
+    print(f"Protocol: {protocol}, {emulator.baudrate} baud")
+    print(f"Command latency: {latency * 1000:.2f} ms")
+    print(f"Pipelined commands: {throughput:.0f} commands/s")
+    print(
+        f"Rinse program of {timings[-1]['end [s]']:.1f} s ran in "
+        f"{rinse * SPEED:.1f} s firmware time"
+    )
+    arduino.disconnect()
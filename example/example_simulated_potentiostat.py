@@ -0,0 +1,28 @@
+import sys
+import time
+import tracemalloc
+from openTron_electrodeposition.admiral import AdmiralSquidstatWrapper
+from openTron_electrodeposition.protocol import load_protocol
+
+# Runs the electrochemical testing protocol on the simulated potentiostat and
+# reports the throughput and the memory use of the data path. Runs on any
+# platform, without the Admiral Squidstat software, eg. in Linux CI:
+# python example/example_simulated_potentiostat.py [protocol file]
+
+plan = load_protocol(*sys.argv[1:])
+my_experiment = AdmiralSquidstatWrapper(simulated=True)
+my_experiment.handler.cell_settings = {"ohmic_resistance": 2.5, "seed": 1}
+
+tracemalloc.start()
+start = time.perf_counter()
+results = my_experiment.run_plan(plan, sample_surface_area=1.0)
+duration = time.perf_counter() - start
+_, peak = tracemalloc.get_traced_memory()
+tracemalloc.stop()
+
+samples = len(my_experiment.dc_buffer) + len(my_experiment.ac_buffer)
+for result in results:
+    print(result["label"], result["summary"])
+print(f"{samples} samples in {duration:.2f} s: {samples / duration:.0f} samples/s")
+print(f"Peak memory: {peak / 1e6:.1f} MB")
+my_experiment.close_experiment()
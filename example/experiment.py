@@ -5,10 +5,16 @@ import json
 import smtplib
 from email.mime.text import MIMEText
 import os
+import numpy as np
 import pandas as pd
 from openTron_electrodeposition.ardu import Arduino
 from OpentronsHTTPAPIWrapper.opentronsHTTPAPI_clientBuilder import opentronsClient
 from openTron_electrodeposition.admiral import AdmiralSquidstatWrapper
+from openTron_electrodeposition.protocol import (
+    DEFAULT_PROTOCOL,
+    ProtocolPlan,
+    load_protocol,
+)
 from openTron_electrodeposition.parameters import (
     labware_paths,
     wells,
@@ -17,6 +23,7 @@ from openTron_electrodeposition.parameters import (
     pipette_tips,
     pump_slope,
     pump_intercept,
+    pump_calibration_file,
     tool_x_offset,
     tool_y_offset,
     tool_z_offset,
@@ -80,9 +87,16 @@ class Experiment:
                 "total_volume [ml]",
                 "deposition_current [A]",
                 "electrodeposition_time [s]",
+                "electrodeposition_target_charge [C/cm2]",
+                "deposited_charge [C]",
+                "deposited_charge_density [C/cm2]",
+                "electrodeposition_duration [s]",
                 "sample_surface_area",
                 "ohmic_resistance [ohm]",
                 "well_temperature_during_deposition [C]",
+                "ocp_duration [s]",
+                "ocp_time_saved [s]",
+                "ocp_final_drift [V/s]",
                 "well_temperature_during_electrochemical_measurements [C]",
                 "potential_at_10mAcm2 [V]",
                 "corrected_potential_at_10mAcm2 [V]",
@@ -92,6 +106,8 @@ class Experiment:
                 "electrodeposition_temperature_setpoint [C]",
                 "chemical_ultrasound_mixing_time [s]",
                 "chemical_rest_time [s]",
+                "setpoint_reached",
+                "cp_termination",
             ]
         )
         # Update the metadata with the unique id
@@ -120,28 +136,34 @@ class Experiment:
         ARDUINO_NAME: str = "CH340",
         pump_intercept: dict = pump_intercept,
         pump_slope: dict = pump_slope,
+        calibration_file: str = pump_calibration_file,
         list_of_cartridges: list = [0, 1],
         list_of_pump_relays=[0, 1, 2, 3, 4, 5],  # Pumps connected to which relays
         list_of_ultrasonic_relays=[6, 7],  # Ultrasonic connected to which relays
     ) -> None:
-        """Initiate the arduino
+        """Initiate the arduino. The connection is shared by the experiments
+        of the session and only made by the first one, see Arduino.shared().
 
         Args:
             ARDUINO_NAME (str, optional): Name of the arduino. Defaults to "CH340".
             pump_intercept (dict, optional): Intercept for the pumps. Defaults to pump_intercept.
             pump_slope (dict, optional): Slope for the pumps. Defaults to pump_slope.
+            calibration_file (str, optional): Measured pump models, which replace pump_slope and pump_intercept. Defaults to pump_calibration_file.
             list_of_cartridges (list, optional): List of cartridges. Defaults to [0, 1].
             list_of_pump_relays (list, optional): Pumps connected to which relays. Defaults to [0, 1, 2, 3, 4, 5].
             list_of_ultrasonic_relays (list, optional): Ultrasonic connected to which relays. Defaults to [6, 7].
         """
         LOGGER.info(f"Initiating arduino with usb nam: {ARDUINO_NAME}")
-        self.arduino = Arduino(
+        self.arduino = Arduino.shared(
             arduino_search_string=ARDUINO_NAME,  # Change string to match arduino name
             list_of_cartridges=list_of_cartridges,  # List of cartridges, where len(list) = number of cartridges
             list_of_pump_relays=list_of_pump_relays,  # Pumps connected to which relays
             list_of_ultrasonic_relays=list_of_ultrasonic_relays,  # Ultrasonic connected to which relays
             pump_slope=pump_slope,  # dict of pump slopes: a in y = ax + b
             pump_intercept=pump_intercept,  # dict of pump intercepts: b in y = ax + b
+            calibration_file=calibration_file,  # Measured pump models
+            telemetry=True,  # Stream the temperatures every second
+            protocol="binary",  # Framed commands with sequence numbers and CRC
         )
 
     def initiate_openTron(self):
@@ -202,6 +224,25 @@ class Experiment:
         with open(path, encoding="utf8") as f:
             return json.load(f)
 
+    def ohmic_corrected_potential(
+        self,
+        voltage: np.ndarray,
+        current: np.ndarray,
+        ohmic_resistance: float,
+        ohmic_correction_factor: float = OHMIC_CORRECTION_FACTOR,
+    ) -> np.ndarray:
+        """Correct potential for ohmic resistance, vectorised
+
+        Args:
+            voltage (np.ndarray): Working electrode voltage in V
+            current (np.ndarray): Working electrode current in A
+            ohmic_resistance (float): Ohmic resistance in ohm
+
+        Returns:
+            np.ndarray: Corrected potential in V
+        """
+        return voltage - ohmic_correction_factor * ohmic_resistance * current
+
     def correct_for_ohmic_resistance(
         self,
         df: pd.DataFrame,
@@ -219,16 +260,36 @@ class Experiment:
             pd.DataFrame: Dataframe with corrected potential
         """
         LOGGER.info("Correcting for ohmic resistance")
-        df["Corrected Working Electrode Voltage [V]"] = (
-            df["Working Electrode Voltage [V]"]
-            - ohmic_correction_factor
-            * ohmic_resistance
-            * df["Working Electrode Current [A]"]
+        df["Corrected Working Electrode Voltage [V]"] = self.ohmic_corrected_potential(
+            df["Working Electrode Voltage [V]"].to_numpy(),
+            df["Working Electrode Current [A]"].to_numpy(),
+            ohmic_resistance,
+            ohmic_correction_factor,
         )
         return df
 
+    def tail_average(self, values: np.ndarray, tail_fraction: float) -> float:
+        """Average of the last part of the values, ignoring NaN
+
+        Args:
+            values (np.ndarray): The values, eg. a column of the DC data
+            tail_fraction (float): Fraction of the values to average
+
+        Returns:
+            float: The average or NaN if there are no values to average
+        """
+        tail = int(round(len(values) * tail_fraction, 6))
+        values = values[len(values) - tail :]
+        if tail == 0 or np.isnan(values).all():
+            return np.nan
+        return float(np.nanmean(values))
+
     def store_data_admiral(
-        self, dc_data: pd.DataFrame, ac_data: pd.DataFrame, file_name: str
+        self,
+        dc_data: pd.DataFrame,
+        ac_data: pd.DataFrame,
+        file_name: str,
+        stats: dict = None,
     ):
         """Store data from the potentiostat in a csv file
 
@@ -236,6 +297,8 @@ class Experiment:
             dc_data (pd.DataFrame): Data from the potentiostat
             ac_data (pd.DataFrame): Data from the potentiostat
             file_name (str): Name of the file to store the data in without the file extension
+            stats (dict, optional): Instrumentation of the data path for the
+                step, stored as json next to the data. Defaults to None.
         """
 
         if dc_data is not None:
@@ -244,299 +307,138 @@ class Experiment:
         if ac_data is not None:
             LOGGER.debug(f"Storing AC data in {file_name} ac_data.csv")
             ac_data.to_csv(file_name + " ac_data.csv", sep=",")
+        if stats is not None:
+            LOGGER.debug(f"Storing data path stats in {file_name} stats.json")
+            with open(file_name + " stats.json", "w", encoding="utf8") as f:
+                json.dump(stats, f, indent=4)
 
-    def perform_potentiostat_measurements(self):
-        ### 0 - Electrochemical Activation
-        LOGGER.info("Performing electrochemical test: 0 - Electrochemical activation")
-        self.admiral.setup_constant_current(
-            holdAtCurrent=0.2 * self.sample_surface_area,
-            samplingInterval=0.05,
-            duration=60,
-        )
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-        self.admiral.clear_data()
-        filepath = DATA_PATH + "\\data\\" + str(self.unique_id) + " 0 CP 200 mA cm-2"
-        self.store_data_admiral(dc_data=dc_data, ac_data=ac_data, file_name=filepath)
-
-        ### 1 - Perform CV
-        LOGGER.info("Performing electrochemical test: 1 - Cyclic voltammetry")
-        self.admiral.setup_cyclic_voltammetry(
-            startVoltage=0.8,
-            firstVoltageLimit=2.3,
-            secondVoltageLimit=0.8,
-            endVoltage=0.8,
-            scanRate=0.2,
-            samplingInterval=0.05,
-            cycles=25,
-        )
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-        # Save data
-        filepath = DATA_PATH + "\\data\\" + str(self.unique_id) + " 1 CV 25x 200mV s-1"
-        self.store_data_admiral(dc_data=dc_data, ac_data=ac_data, file_name=filepath)
-        self.admiral.clear_data()
-
-        ### 2 - Perform CV
-        LOGGER.info("Performing electrochemical test: 2 - Cyclic voltammetry")
-        self.admiral.setup_cyclic_voltammetry(
-            startVoltage=0.8,
-            firstVoltageLimit=2.3,
-            secondVoltageLimit=0.8,
-            endVoltage=0.8,
-            scanRate=0.01,
-            samplingInterval=0.2,
-            cycles=2,
-        )
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-        # Save data
-        filepath = DATA_PATH + "\\data\\" + str(self.unique_id) + " 2 CV 2x 10mV s-1"
-        self.store_data_admiral(dc_data=dc_data, ac_data=ac_data, file_name=filepath)
-        self.admiral.clear_data()
+    def store_temperature_trace(self, since: float = None):
+        """Store the temperatures the Arduino streamed during the run in a csv
+        file next to the potentiostat data.
 
-        ### 3 - Perform EIS
-        LOGGER.info(
-            "Performing electrochemical test: 3 - Electrochemical impedance spectroscopy"
-        )
-        self.admiral.setup_EIS_potentiostatic(
-            start_frequency=500000,
-            end_frequency=1,
-            points_per_decade=10,
-            voltage_bias=1.5,
-            voltage_amplitude=0.01,
-            number_of_runs=0,
-        )
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-        # Save data
-        filepath = DATA_PATH + "\\data\\" + str(self.unique_id) + " 3 EIS"
-        self.store_data_admiral(dc_data=dc_data, ac_data=ac_data, file_name=filepath)
-        # Find ohmic resistance
-        self.ohmic_resistance = self.find_ohmic_resistance(
-            df=ac_data,
-            column_name_imag="Imaginary Impedance",
-            column_name_real="Real Impedance",
-        )
-        self.admiral.clear_data()
-
-        # Updata metadata
-        self.metadata.loc[0, "ohmic_resistance [ohm]"] = self.ohmic_resistance
-        self.save_metadata()
-
-        ### 4 - Perform CP at 100 mA/cm^2
-        LOGGER.info(
-            "Performing electrochemical test: 4 - Constant current at 100 mA/cm^2"
-        )
-        self.admiral.setup_constant_current(
-            holdAtCurrent=0.1 * self.sample_surface_area,
-            samplingInterval=0.05,
-            duration=70,
-        )
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-        # Correct DC data for ohmic resistance
-        dc_data = self.correct_for_ohmic_resistance(
-            df=dc_data,
-            ohmic_resistance=self.ohmic_resistance,
-            ohmic_correction_factor=OHMIC_CORRECTION_FACTOR,
+        Args:
+            since (float, optional): Start of the run as time.time(). Defaults
+                to None, which stores all buffered temperatures.
+        """
+        trace = pd.DataFrame(self.arduino.temperature_trace(since=since))
+        file_name = (
+            DATA_PATH + "\\data\\" + str(self.unique_id) + " temperature_trace.csv"
         )
-        # Save data
-        filepath = DATA_PATH + "\\data\\" + str(self.unique_id) + " 4 CP 100 mA cm-2"
-        self.store_data_admiral(dc_data=dc_data, ac_data=ac_data, file_name=filepath)
-        self.admiral.clear_data()
+        LOGGER.debug(f"Storing {len(trace)} temperatures in {file_name}")
+        trace.to_csv(file_name, sep=",", index=False)
 
-        ### 5 - Perform CP at 50 mA/cm^2
-        LOGGER.info(
-            "Performing electrochemical test: 5 - Constant current at 50 mA/cm^2"
-        )
-        self.admiral.setup_constant_current(
-            holdAtCurrent=0.05 * self.sample_surface_area,
-            samplingInterval=0.05,
-            duration=70,
-        )
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-        # Correct DC data for ohmic resistance
-        dc_data = self.correct_for_ohmic_resistance(
-            df=dc_data,
-            ohmic_resistance=self.ohmic_resistance,
-            ohmic_correction_factor=OHMIC_CORRECTION_FACTOR,
-        )
-        # Save data
-        filepath = DATA_PATH + "\\data\\" + str(self.unique_id) + " 5 CP 50 mA cm-2"
-        self.store_data_admiral(dc_data=dc_data, ac_data=ac_data, file_name=filepath)
-        self.admiral.clear_data()
+    def perform_potentiostat_measurements(
+        self, protocol_path: str = DEFAULT_PROTOCOL, while_measuring=None
+    ):
+        """Perform the electrochemical tests of a protocol file on the sample
 
-        ### 6 - Perform CP at 20 mA/cm^2
-        LOGGER.info(
-            "Performing electrochemical test: 6 - Constant current at 20 mA/cm^2"
-        )
-        self.admiral.setup_constant_current(
-            holdAtCurrent=0.02 * self.sample_surface_area,
-            samplingInterval=0.05,
-            duration=70,
-        )
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-        # Correct DC data for ohmic resistance
-        dc_data = self.correct_for_ohmic_resistance(
-            df=dc_data,
-            ohmic_resistance=self.ohmic_resistance,
-            ohmic_correction_factor=OHMIC_CORRECTION_FACTOR,
+        Args:
+            protocol_path (str, optional): Path of the protocol file. Defaults
+                to the OER protocol shipped with openTron_electrodeposition.
+                STEADY_STATE_PROTOCOL ends its CP steps once the potential is
+                stable.
+            while_measuring (callable, optional): Function without arguments
+                that is run while the potentiostat measures, if the potentiostat
+                runs in threaded mode, or before the measurements otherwise.
+                Defaults to None.
+        """
+        # Stream the raw data to disk while measuring so it survives a crash
+        self.admiral.stream_to_csv(
+            DATA_PATH
+            + "\\data\\"
+            + str(self.unique_id)
+            + " raw electrochemical testing"
         )
-        # Save data
-        filepath = DATA_PATH + "\\data\\" + str(self.unique_id) + " 6 CP 20 mA cm-2"
-        self.store_data_admiral(dc_data=dc_data, ac_data=ac_data, file_name=filepath)
-        self.admiral.clear_data()
 
-        ### 7 - Perform CP at 10 mA/cm^2
+        # All steps are appended to one potentiostat experiment, which is
+        # uploaded and run once. The data is split per step afterwards.
+        plan = load_protocol(protocol_path)
         LOGGER.info(
-            "Performing electrochemical test: 7 - Constant current at 10 mA/cm^2"
-        )
-        self.admiral.setup_constant_current(
-            holdAtCurrent=0.01 * self.sample_surface_area,
-            samplingInterval=0.05,
-            duration=70,
-        )
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-        # Correct DC data for ohmic resistance
-        dc_data = self.correct_for_ohmic_resistance(
-            df=dc_data,
-            ohmic_resistance=self.ohmic_resistance,
-            ohmic_correction_factor=OHMIC_CORRECTION_FACTOR,
-        )
-        # Save data
-        filepath = DATA_PATH + "\\data\\" + str(self.unique_id) + " 7 CP 10 mA cm-2"
-        self.store_data_admiral(dc_data=dc_data, ac_data=ac_data, file_name=filepath)
-        self.admiral.clear_data()
+            f"Performing electrochemical tests: {plan.name} ({len(plan.steps)} steps)"
+        )
+        if getattr(self.admiral, "threaded", False):
+            # Let the robot and the Arduino work while the potentiostat measures
+            future = self.admiral.submit_plan(plan, self.sample_surface_area)
+            if while_measuring is not None:
+                while_measuring()
+            results = future.result()
+        else:
+            if while_measuring is not None:
+                while_measuring()
+            results = self.admiral.run_plan(plan, self.sample_surface_area)
+
+        # Find ohmic resistance from the EIS
+        for step, result in zip(plan.steps, results):
+            if step.get("find_ohmic_resistance"):
+                # Use the estimate made while the EIS was measured, if any
+                estimate = result["summary"].get("ohmic_resistance [ohm]")
+                if estimate is not None and pd.notna(estimate):
+                    self.ohmic_resistance = round(float(estimate), 3)
+                    LOGGER.info(
+                        f"Ohmic resistance: {self.ohmic_resistance} "
+                        f"({result['summary']['intercept_method']} at "
+                        f"{result['summary']['intercept_frequency [Hz]']:.0f} Hz)"
+                    )
+                else:
+                    self.ohmic_resistance = self.find_ohmic_resistance(
+                        df=result["ac_data"],
+                        column_name_imag="Imaginary Impedance",
+                        column_name_real="Real Impedance",
+                    )
+                # Updata metadata
+                self.metadata.loc[0, "ohmic_resistance [ohm]"] = self.ohmic_resistance
+                self.save_metadata()
+
+        for step, result in zip(plan.steps, results):
+            dc_data = result["dc_data"]
+            # Float64 views of the DC samples of the step, no copies
+            columns = {}
+            if result.get("dc_range") is not None:
+                columns = self.admiral.get_arrays("dc", *result["dc_range"])
+            # Correct DC data for ohmic resistance
+            if step.get("ohmic_correction") and dc_data is not None and columns:
+                LOGGER.info("Correcting for ohmic resistance")
+                corrected = self.ohmic_corrected_potential(
+                    columns["Working Electrode Voltage [V]"],
+                    columns["Working Electrode Current [A]"],
+                    ohmic_resistance=self.ohmic_resistance,
+                    ohmic_correction_factor=OHMIC_CORRECTION_FACTOR,
+                )
+                columns["Corrected Working Electrode Voltage [V]"] = corrected
+                dc_data["Corrected Working Electrode Voltage [V]"] = corrected
+            # Save data
+            filepath = (
+                DATA_PATH + "\\data\\" + str(self.unique_id) + " " + result["label"]
+            )
+            self.store_data_admiral(
+                dc_data=dc_data,
+                ac_data=result["ac_data"],
+                file_name=filepath,
+                stats=result.get("stats"),
+            )
 
-        # Find average ohmic corrected potential at 10 mA/cm^2 for the last third of the data
-        self.metadata.loc[0, "potential_at_10mAcm2 [V]"] = (
-            dc_data["Working Electrode Voltage [V]"].tail(int(len(dc_data) / 3)).mean()
-        )
-        self.metadata.loc[0, "corrected_potential_at_10mAcm2 [V]"] = (
-            dc_data["Corrected Working Electrode Voltage [V]"]
-            .tail(int(len(dc_data) / 3))
-            .mean()
-        )
+            # Average eg. the ohmic corrected potential at 10 mA/cm^2 over the
+            # last third of the data. NaN if the step recorded no DC data
+            for average in step["averages"]:
+                if average["column"] in columns:
+                    value = self.tail_average(
+                        columns[average["column"]], average["tail_fraction"]
+                    )
+                else:
+                    value = np.nan
+                self.metadata.loc[0, average["metadata"]] = value
+
+        # Store how the steps with a steady state detector terminated
+        terminations = [
+            f"{result['label']}: {result['summary']['termination']} after "
+            f"{result['summary']['duration [s]']:.1f} s"
+            for step, result in zip(plan.steps, results)
+            if "steady_state" in step["monitors"]
+        ]
+        if terminations:
+            self.metadata.loc[0, "cp_termination"] = "; ".join(terminations)
         self.save_metadata()
-
-        # 8 - Perform CP at 5 mA/cm^2
-        LOGGER.info(
-            "Performing electrochemical test: 8 - Constant current at 5 mA/cm^2"
-        )
-        self.admiral.setup_constant_current(
-            holdAtCurrent=0.005 * self.sample_surface_area,
-            samplingInterval=0.05,
-            duration=70,
-        )
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-
-        # Correct DC data for ohmic resistance
-        dc_data = self.correct_for_ohmic_resistance(
-            df=dc_data,
-            ohmic_resistance=self.ohmic_resistance,
-            ohmic_correction_factor=OHMIC_CORRECTION_FACTOR,
-        )
-        # Save data
-        filepath = DATA_PATH + "\\data\\" + str(self.unique_id) + " 8 CP 5 mA cm-2"
-        self.store_data_admiral(dc_data=dc_data, ac_data=ac_data, file_name=filepath)
-        self.admiral.clear_data()
-
-        ### 9 - Perform CP at 2 mA/cm^2
-        LOGGER.info(
-            "Performing electrochemical test: 9 - Constant current at 2 mA/cm^2"
-        )
-        self.admiral.setup_constant_current(
-            holdAtCurrent=0.002 * self.sample_surface_area,
-            samplingInterval=0.05,
-            duration=70,
-        )
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-        # Correct DC data for ohmic resistance
-        dc_data = self.correct_for_ohmic_resistance(
-            df=dc_data,
-            ohmic_resistance=self.ohmic_resistance,
-            ohmic_correction_factor=OHMIC_CORRECTION_FACTOR,
-        )
-        # Save data
-        filepath = DATA_PATH + "\\data\\" + str(self.unique_id) + " 9 CP 2 mA cm-2"
-        self.store_data_admiral(dc_data=dc_data, ac_data=ac_data, file_name=filepath)
-        self.admiral.clear_data()
-
-        ### 10 - Perform CP at 1 mA/cm^2
-        LOGGER.info(
-            "Performing electrochemical test: 10 - Constant current at 1 mA/cm^2"
-        )
-        self.admiral.setup_constant_current(
-            holdAtCurrent=0.001 * self.sample_surface_area,
-            samplingInterval=0.05,
-            duration=70,
-        )
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-        # Correct DC data for ohmic resistance
-        dc_data = self.correct_for_ohmic_resistance(
-            df=dc_data,
-            ohmic_resistance=self.ohmic_resistance,
-            ohmic_correction_factor=OHMIC_CORRECTION_FACTOR,
-        )
-        # Save data
-        filepath = DATA_PATH + "\\data\\" + str(self.unique_id) + " 10 CP 1 mA cm-2"
-        self.store_data_admiral(dc_data=dc_data, ac_data=ac_data, file_name=filepath)
-        self.admiral.clear_data()
-
-        ### 11 - Perform CV
-        LOGGER.info("Performing electrochemical test: 11 - Cyclic voltammetry")
-        self.admiral.setup_cyclic_voltammetry(
-            startVoltage=0.8,
-            firstVoltageLimit=2.3,
-            secondVoltageLimit=0.8,
-            endVoltage=0.8,
-            scanRate=0.01,
-            samplingInterval=0.2,
-            cycles=2,
-        )
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-        # Correct DC data for ohmic resistance
-        dc_data = self.correct_for_ohmic_resistance(
-            df=dc_data,
-            ohmic_resistance=self.ohmic_resistance,
-            ohmic_correction_factor=OHMIC_CORRECTION_FACTOR,
-        )
-        # Save data
-        filepath = DATA_PATH + "\\data\\" + str(self.unique_id) + " 11 CV 2x 10mV s-1"
-        self.store_data_admiral(dc_data=dc_data, ac_data=ac_data, file_name=filepath)
-        self.admiral.clear_data()
-
-        ### 12 - Perform CV to reduce the surface again so that it looks nice and not rusty
-        LOGGER.info("Performing electrochemical test: 12 - Cyclic voltammetry")
-        self.admiral.setup_cyclic_voltammetry(
-            startVoltage=0.8,
-            firstVoltageLimit=-0.2,
-            secondVoltageLimit=0,
-            endVoltage=-0.2,
-            scanRate=0.01,
-            samplingInterval=0.2,
-            cycles=2,
-        )
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-        # Correct DC data for ohmic resistance
-        dc_data = self.correct_for_ohmic_resistance(
-            df=dc_data,
-            ohmic_resistance=self.ohmic_resistance,
-            ohmic_correction_factor=OHMIC_CORRECTION_FACTOR,
-        )
-        # Save data
-        filepath = DATA_PATH + "\\data\\" + str(self.unique_id) + " 12 CV 2x 10mV s-1"
-        self.store_data_admiral(dc_data=dc_data, ac_data=ac_data, file_name=filepath)
-        self.admiral.clear_data()
+        self.admiral.detach_sinks()
 
     def send_mail(self, msg: str, title: str, receivers: list):
         """Send an email to the specified receivers
@@ -565,11 +467,24 @@ class Experiment:
         except Exception:
             logging.warning("Error: unable to send email")
 
-    def perform_potentiostat_electrodeposition(self, seconds: int = 10):
-        """Perform electrodeposition of the sample
+    def perform_potentiostat_electrodeposition(
+        self,
+        seconds: int = 10,
+        target_charge_density: float = None,
+        adaptive_ocp: bool = True,
+        ocp_min_duration: float = 30,
+        ocp_max_duration: float = 120,
+        ocp_max_drift: float = 1e-4,
+    ):
+        """Perform electrodeposition of the sample followed by an OCV
 
         Args:
-            seconds (int, optional): Duration of the electrodeposition in seconds. Defaults to 10.
+            seconds (int, optional): Duration of the electrodeposition in seconds, maximum duration if a target charge is given. Defaults to 10.
+            target_charge_density (float, optional): End the electrodeposition once this charge in C/cm2 has been passed. Defaults to None.
+            adaptive_ocp (bool, optional): End the OCV once the potential drifts less than ocp_max_drift. Defaults to True.
+            ocp_min_duration (float, optional): Minimum duration of an adaptive OCV in seconds. Defaults to 30.
+            ocp_max_duration (float, optional): Duration of the OCV in seconds, maximum duration if adaptive. Defaults to 120.
+            ocp_max_drift (float, optional): Drift rate in V/s that counts as stable. Defaults to 1e-4.
         """
         LOGGER.info(
             f"Potentiostat performing electrodeposition of the sample with {self.deposition_current} A for {seconds} seconds"
@@ -600,44 +515,102 @@ class Experiment:
         # )
         # XXX END OF REMOVABLE SECTION
 
+        # Stream the raw data to disk while measuring so it survives a crash
+        self.admiral.stream_to_csv(
+            DATA_PATH + "\\data\\" + str(self.unique_id) + " raw electrodeposition"
+        )
+
         LOGGER.info("Performing electrodeposition")
-        # Apply constant current for X seconds
-        self.admiral.setup_constant_current(
-            holdAtCurrent=-self.deposition_current,
-            samplingInterval=0.1,
-            duration=seconds,
-        )
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-        self.admiral.clear_data()
+        # Apply constant current for X seconds, counting the charge passed
+        charge_settings = {}
+        if target_charge_density is not None:
+            # End the deposition once the target charge has been passed
+            charge_settings["target_charge"] = (
+                target_charge_density * self.sample_surface_area
+            )
+        deposition_step = {
+            "label": "-2 Electrodeposition",
+            "technique": "constant_current",
+            "params": {
+                "holdAtCurrent": -self.deposition_current,
+                "samplingInterval": 0.1,
+                "duration": seconds,
+            },
+            "monitors": {"charge": charge_settings},
+        }
+        [result] = self.admiral.run_plan(
+            ProtocolPlan({"name": "Electrodeposition", "steps": [deposition_step]}),
+            self.sample_surface_area,
+        )
         # Save data
         self.store_data_admiral(
-            dc_data=dc_data,
-            ac_data=ac_data,
+            dc_data=result["dc_data"],
+            ac_data=result["ac_data"],
             file_name=DATA_PATH
             + "\\data\\"
             + str(self.unique_id)
-            + " -2 Electrodeposition",
+            + " "
+            + result["label"],
+            stats=result.get("stats"),
         )
+        summary = result["summary"]
+        LOGGER.info(
+            f"Deposited {summary['charge [C]']:.4g} C in {summary['duration [s]']:.1f} s "
+            f"({summary['termination']})"
+        )
+        self.metadata.loc[0, "deposited_charge [C]"] = summary["charge [C]"]
+        self.metadata.loc[0, "deposited_charge_density [C/cm2]"] = (
+            summary["charge [C]"] / self.sample_surface_area
+        )
+        self.metadata.loc[0, "electrodeposition_duration [s]"] = summary["duration [s]"]
+        self.save_metadata()
 
         # Get temperature of the well
         self.metadata.loc[0, "well_temperature_during_deposition [C]"] = (
             self.arduino.get_temperature1()
         )
         LOGGER.info("Making an OCV")
-        self.admiral.setup_OCP(duration=120, samplingInterval=0.2)
-        self.admiral.run_experiment()
-        ac_data, dc_data = self.admiral.get_data()
-        self.admiral.clear_data()
+        ocp_step = {
+            "label": "-1 OCV scan 1x 10mV s-1",
+            "technique": "OCP",
+            "params": {"duration": ocp_max_duration, "samplingInterval": 0.2},
+        }
+        if adaptive_ocp:
+            # End the OCV as soon as the potential has stabilised
+            ocp_step["monitors"] = {
+                "drift": {
+                    "max_drift": ocp_max_drift,
+                    "min_duration": ocp_min_duration,
+                    "max_duration": ocp_max_duration,
+                }
+            }
+        [result] = self.admiral.run_plan(
+            ProtocolPlan({"name": "OCV", "steps": [ocp_step]}),
+            self.sample_surface_area,
+        )
         # Save data
         self.store_data_admiral(
-            dc_data=dc_data,
-            ac_data=ac_data,
+            dc_data=result["dc_data"],
+            ac_data=result["ac_data"],
             file_name=DATA_PATH
             + "\\data\\"
             + str(self.unique_id)
-            + " -1 OCV scan 1x 10mV s-1",
+            + " "
+            + result["label"],
+            stats=result.get("stats"),
         )
+        self.admiral.detach_sinks()
+
+        if adaptive_ocp:
+            summary = result["summary"]
+            LOGGER.info(
+                f"OCV ended after {summary['duration [s]']:.1f} s "
+                f"({summary['termination']}), saving {summary['time saved [s]']:.1f} s"
+            )
+            self.metadata.loc[0, "ocp_duration [s]"] = summary["duration [s]"]
+            self.metadata.loc[0, "ocp_time_saved [s]"] = summary["time saved [s]"]
+            self.metadata.loc[0, "ocp_final_drift [V/s]"] = summary["drift [V/s]"]
+            self.save_metadata()
 
     def emergency_parking_of_electrode(self, well_number: int):
         """Emergency park the electrode"""
@@ -892,6 +865,78 @@ class Experiment:
 
             counter += 1
 
+    def rinse_steps(
+        self,
+        chemical: str,
+        start: float = 0,
+        volume: float = 0.5,
+        ultrasound_time: float = 5,
+        drain_volume: float = 2,
+        soak_time: float = None,
+    ):
+        """Relay program steps that rinse the well with the flush tool: the
+        rinse is pumped in, the ultrasound runs once it is in, or after
+        soak_time, then the well is drained.
+
+        Args:
+            chemical (str): Pump of the rinse in peristaltic_pump_content, eg.
+                "Flush_tool_H2O"
+            start (float, optional): Start of the rinse in the program in s.
+                Defaults to 0.
+            volume (float, optional): Volume of the rinse in ml. Defaults to
+                0.5.
+            ultrasound_time (float, optional): Time of the ultrasound in s.
+                Defaults to 5.
+            drain_volume (float, optional): Volume to drain in ml. Defaults
+                to 2.
+            soak_time (float, optional): Time in s to let the rinse work
+                before the ultrasound. Defaults to None.
+
+        Returns:
+            tuple: The steps for Arduino.run_program() and the end of the
+            rinse in the program in s.
+        """
+        pump = peristaltic_pump_content[chemical]
+        drain = peristaltic_pump_content["Flush_tool_Drain"]
+        fill_time = self.arduino.pump_time(pump, volume)
+        ultrasound_start = start + fill_time
+        if soak_time is not None:
+            ultrasound_start += soak_time
+        drain_start = ultrasound_start + ultrasound_time
+        drain_time = self.arduino.pump_time(drain, drain_volume)
+        steps = [
+            (pump, start, fill_time),
+            (self.arduino.ultrasound_relay(1), ultrasound_start, ultrasound_time),
+            (drain, drain_start, drain_time),
+        ]
+        return steps, drain_start + drain_time
+
+    def rinse(self, chemicals: list, soak_time: float = None) -> list:
+        """Rinse the well with the flush tool, with one chemical after the
+        other. All rinses are run as one relay program by the Arduino.
+
+        Args:
+            chemicals (list): Pumps of the rinses in peristaltic_pump_content
+            soak_time (float, optional): Time in s to let the HCl rinses work.
+                Defaults to None.
+
+        Returns:
+            list: Measured timings of the relay program.
+        """
+        program, start = [], 0
+        for chemical in chemicals:
+            steps, start = self.rinse_steps(
+                chemical,
+                start,
+                soak_time=soak_time if chemical == "Flush_tool_HCl" else None,
+            )
+            program += steps
+            self.chemical_volumes_left[chemical] -= 1
+            self.chemical_volumes_left["Waste"] -= 1
+        timings = self.arduino.run_program(program)
+        LOGGER.debug(f"Rinse program timings: {timings}")
+        return timings
+
     def cleaning(self, well_number: int, sleep_time: int = 0, use_acid: bool = True):
         """Clean the well
 
@@ -1016,61 +1061,18 @@ class Experiment:
         self.chemical_volumes_left["Waste"] -= self.well_volume
 
         # Flush with water
-        self.arduino.dispense_ml(
-            pump=peristaltic_pump_content["Flush_tool_H2O"], volume=0.5
-        )  # ml to dispense
-        self.chemical_volumes_left["Flush_tool_H2O"] -= 1
-        self.arduino.set_ultrasound_on(1, 5)
-        self.arduino.dispense_ml(
-            pump=peristaltic_pump_content["Flush_tool_Drain"], volume=2
-        )  # ml to dispense DRAIN
-        self.chemical_volumes_left["Waste"] -= 1
-        self.arduino.dispense_ml(
-            pump=peristaltic_pump_content["Flush_tool_H2O"], volume=0.5
-        )  # ml to dispense
-        self.chemical_volumes_left["Flush_tool_H2O"] -= 1
-        self.arduino.set_ultrasound_on(1, 5)
-        self.arduino.dispense_ml(
-            pump=peristaltic_pump_content["Flush_tool_Drain"], volume=2
-        )  # ml to dispense DRAIN
-        self.chemical_volumes_left["Waste"] -= 1
+        self.rinse(["Flush_tool_H2O", "Flush_tool_H2O"])
 
         # Save the volumes of the chemicals left
         self.save_chemical_volumes_left()
 
         if use_acid is True:
-            # Flush with acid
-            self.arduino.dispense_ml(
-                pump=peristaltic_pump_content["Flush_tool_HCl"], volume=0.5
-            )  # ml to dispense
-            self.chemical_volumes_left["Flush_tool_HCl"] -= 1
-            LOGGER.info(f"Sleeping for {sleep_time} seconds")
-            time.sleep(sleep_time)  # Sleep to let the acid work
-            self.arduino.set_ultrasound_on(1, 5)
-            self.arduino.dispense_ml(
-                pump=peristaltic_pump_content["Flush_tool_Drain"], volume=2
-            )  # ml to dispense DRAIN
-            self.chemical_volumes_left["Waste"] -= 1
-
-            # Flush with water
-            self.arduino.dispense_ml(
-                pump=peristaltic_pump_content["Flush_tool_H2O"], volume=0.5
-            )  # ml to dispense
-            self.chemical_volumes_left["Flush_tool_H2O"] -= 1
-            self.arduino.set_ultrasound_on(1, 5)
-            self.arduino.dispense_ml(
-                pump=peristaltic_pump_content["Flush_tool_Drain"], volume=2
-            )  # ml to dispense DRAIN
-            self.chemical_volumes_left["Waste"] -= 1
-            self.arduino.dispense_ml(
-                pump=peristaltic_pump_content["Flush_tool_H2O"], volume=0.5
-            )  # ml to dispense
-            self.chemical_volumes_left["Flush_tool_H2O"] -= 1
-            self.arduino.set_ultrasound_on(1, 5)
-            self.arduino.dispense_ml(
-                pump=peristaltic_pump_content["Flush_tool_Drain"], volume=2
-            )  # ml to dispense DRAIN
-            self.chemical_volumes_left["Waste"] -= 1
+            # Flush with acid, let the acid work, then flush with water
+            LOGGER.info(f"Letting the acid work for {sleep_time} seconds")
+            self.rinse(
+                ["Flush_tool_HCl", "Flush_tool_H2O", "Flush_tool_H2O"],
+                soak_time=sleep_time,
+            )
 
             # Save the volumes of the chemicals left
             self.save_chemical_volumes_left()
@@ -1272,13 +1274,17 @@ class Experiment:
             )
 
     def perform_electrodeposition(
-        self, well_number: int, electrodeposition_time: float = 10
+        self,
+        well_number: int,
+        electrodeposition_time: float = 10,
+        target_charge_density: float = None,
     ):
         """Perform electrodeposition of the sample
 
         Args:
             well_number (int): Well number to perform electrodeposition in
             seconds (float, optional): Duration of the electrodeposition in seconds. Defaults to 10.
+            target_charge_density (float, optional): Charge in C/cm2 that ends the electrodeposition. Defaults to None.
         """
         # Go to Ni deposition tool
         self.openTron.moveToWell(
@@ -1327,7 +1333,9 @@ class Experiment:
         self.arduino.set_relay_on(8)
 
         # Perform the actual electrochemical deposition
-        self.perform_potentiostat_electrodeposition(seconds=electrodeposition_time)
+        self.perform_potentiostat_electrodeposition(
+            seconds=electrodeposition_time, target_charge_density=target_charge_density
+        )
 
         # Switch relay off to make reference electrode the real reference electrode
         self.arduino.set_relay_off(8)
@@ -1592,17 +1600,19 @@ class Experiment:
             intSpeed=10,  # mm/s
         )
 
-        # Get temperature of the well and store in metadata
-        self.metadata.loc[
-            0, "well_temperature_during_electrochemical_measurements [C]"
-        ] = self.arduino.get_temperature1()
-        self.save_metadata()
+        # Get temperature of the well and store in metadata, while measuring
+        # if the potentiostat runs in threaded mode
+        def read_well_temperature():
+            self.metadata.loc[
+                0, "well_temperature_during_electrochemical_measurements [C]"
+            ] = self.arduino.get_temperature1()
+            self.save_metadata()
 
         # Perform reference electrode calibration
         # self.perform_potentiostat_reference_measurement(" before")
 
         # Perform the actual electrochemical testing
-        self.perform_potentiostat_measurements()
+        self.perform_potentiostat_measurements(while_measuring=read_well_temperature)
 
         # Perform reference electrode calibration
         # self.perform_potentiostat_reference_measurement(" after")
@@ -1778,7 +1788,8 @@ class Experiment:
         # Save metadata
         self.save_metadata()
 
-        self.arduino.disconnect()
+        # The arduino connection stays open for the next experiment and is
+        # closed when the session ends
 
     def load_well_number(self):
         # Load well number from last_processed_well.txt and update it to +1 (until 14). If the file doesn't exist, start with 0.
@@ -1954,6 +1965,7 @@ class Experiment:
         electrolyte: str = "KOH",
         well_number: int = None,
         electrodeposition_time: float = 10,
+        electrodeposition_target_charge: float = None,
         electrodeposition_temperature: float = 0,
         chemical_ultrasound_mixing_time: int = 30,
         chemical_rest_time: int = 300,
@@ -1966,11 +1978,14 @@ class Experiment:
             electrolyte (str, optional): Electrolyte to dispense. Defaults to "KOH".
             well_number (int, optional): Well number to run the experiment in. Defaults to None.
             electrodeposition_time (float, optional): Duration of the electrodeposition in seconds. Defaults to 10.
+            electrodeposition_target_charge (float, optional): Charge in C/cm2 that ends the electrodeposition before electrodeposition_time. Defaults to None.
             chemical_ultrasound_mixing_time (int, optional): Time to mix chemicals with ultrasound in seconds. Defaults to 30.
             electrodeposition_temperature (float, optional): Temperature of the electrodeposition in degrees Celsius. Defaults to 0.
             chemical_ultrasound_mixing_time (int, optional): Time to mix chemicals with ultrasound in seconds. Defaults to 30.
             chemical_rest_time (int, optional): Time to rest after mixing chemicals in seconds. Defaults to 300.
         """
+        run_start = time.time()
+
         # Check that there is enough stock solution for a run
         self.check_chemical_volumes(
             chemicals_to_mix=chemicals_to_mix,
@@ -1991,6 +2006,9 @@ class Experiment:
         self.metadata.loc[0, "chemicals_to_mix"] = str(chemicals_to_mix)
         self.metadata.loc[0, "total_volume [ml]"] = self.well_volume
         self.metadata.loc[0, "electrodeposition_time [s]"] = electrodeposition_time
+        self.metadata.loc[0, "electrodeposition_target_charge [C/cm2]"] = (
+            electrodeposition_target_charge
+        )
         self.metadata.loc[0, "deposition_current [A]"] = self.deposition_current
         self.metadata.loc[0, "sample_surface_area [cm2]"] = self.sample_surface_area
         self.metadata.loc[0, "electrodeposition_temperature_setpoint [C]"] = (
@@ -2041,9 +2059,22 @@ class Experiment:
         )
         time.sleep(chemical_rest_time)
 
+        # Make sure the well is at the electrodeposition temperature. The
+        # chemicals are already dosed, so a slow heater doesn't stop the run.
+        if electrodeposition_temperature > 0:
+            try:
+                self.arduino.wait_until_setpoint(1)
+                self.metadata.loc[0, "setpoint_reached"] = True
+            except RuntimeWarning as e:
+                LOGGER.warning(f"Depositing without reaching the setpoint: {e}")
+                self.metadata.loc[0, "setpoint_reached"] = False
+            self.save_metadata()
+
         # Run recipe for electrodeposition
         self.perform_electrodeposition(
-            well_number=self.well_number, electrodeposition_time=electrodeposition_time
+            well_number=self.well_number,
+            electrodeposition_time=electrodeposition_time,
+            target_charge_density=electrodeposition_target_charge,
         )
 
         # Clean the well
@@ -2072,6 +2103,9 @@ class Experiment:
         # Set status of metadata
         self.metadata.loc[0, "status_of_run"] = "success"
 
+        # Store the temperatures of the run
+        self.store_temperature_trace(since=run_start)
+
         # Set temperature to 0 C so it doesnt heat
         self.arduino.set_temperature(0, 0)
         self.arduino.set_temperature(1, 0)
@@ -2,8 +2,7 @@ import logging
 from datetime import datetime
 import sys
 from experiment import Experiment
-import time
-from openTron_electrodeposition.admiral import AdmiralSquidstatWrapper
+from openTron_electrodeposition.worker import PotentiostatProcess
 
 port = "COM5"
 instrument_name = "Plus1894"
@@ -60,9 +59,10 @@ logging.basicConfig(
 )
 time_now = datetime.now().strftime("%Y-%m-%d_%H_%M_%S")
 
-# Initialize Admiral potentiostat
+# Initialize Admiral potentiostat in a worker process, which owns the Qt
+# application for the whole session
 logging.info(f"Initiating potentiostat on port {port} with name {instrument_name}")
-admiral = AdmiralSquidstatWrapper(port=port, instrument_name=instrument_name)
+admiral = PotentiostatProcess(port=port, instrument_name=instrument_name)
 
 # Setting temperature on test cell/well (and making an object to do so)
 experiment = Experiment(
@@ -73,8 +73,8 @@ experiment = Experiment(
 )
 experiment.arduino.set_temperature(1, 35)
 
-logging.info("Sleep 600 seconds to heat up the well plate to 35C")
-time.sleep(300)
+logging.info("Waiting for the well plate to heat up to 35C")
+experiment.arduino.wait_until_setpoint(1)
 #####################
 # This section is just for a homing run and not necessary for the experiment
 # once all pumps are primed and once the well is 35C
@@ -15,20 +15,75 @@
 */
 #include <Wire.h>
 #include <EEPROM.h>
-const byte buff_size = 40;
+const byte buff_size = 160;  // Large enough for a program of PROGRAM_STEPS steps
 char input_buffer[buff_size];
 const char start_marker = '<';
 const char end_marker = '>';
 byte bytes_rcvd = 0;
 boolean read_in_progress = false;
 boolean new_data_pc = false;
-String message_from_pc;
 int direction_in = 0;
 int steps_in = 0;
 int step_time_in = 0;
 int m_num = 0;
 float ultrasound_time_in;
 
+/*
+   Scheduler
+*/
+const unsigned long SENSOR_INTERVAL = 1000;  // ms between temperature and PID updates
+unsigned long last_sensor_update = 0;
+// Send a "T,..." telemetry frame after every sensor update, see send_telemetry()
+boolean telemetry = false;
+// Timed relay pulses, relay 0-8. A pulse ends when millis() - start >= duration,
+// which also holds when millis() overflows.
+const int TIMED_RELAYS = 9;
+boolean relay_timed[TIMED_RELAYS];
+unsigned long relay_started[TIMED_RELAYS];
+unsigned long relay_duration[TIMED_RELAYS];
+// Relay program, a list of timed pulses with start times relative to the start
+// of the program. The program reports "P,<start>,<end>,..." with the measured
+// start and end of every step in ms once all steps are done.
+const int PROGRAM_STEPS = 12;
+int program_steps = 0;
+boolean program_running = false;
+unsigned long program_started;
+byte program_relay[PROGRAM_STEPS];
+unsigned long program_start[PROGRAM_STEPS];
+unsigned long program_duration[PROGRAM_STEPS];
+unsigned long program_on_at[PROGRAM_STEPS];
+unsigned long program_off_at[PROGRAM_STEPS];
+byte program_state[PROGRAM_STEPS];  // 0 = waiting, 1 = on, 2 = done
+
+/*
+   Binary protocol
+   A frame is 0xA5, sequence, opcode, length, payload, CRC-8 (polynomial 0x07)
+   over sequence to payload, see framing.py. Frames are received into
+   input_buffer. Replies have the sequence of the command and opcode | 0x80,
+   events have sequence 0. After "<binary,1>" the events are sent as frames.
+*/
+const byte FRAME_SYNC = 0xA5;
+const byte FRAME_REPLY = 0x80;
+const unsigned long FRAME_TIMEOUT = 100;  // ms to receive a whole frame
+const byte OP_RELAY_ON = 0x01;
+const byte OP_RELAY_OFF = 0x02;
+const byte OP_RELAY_ON_TIME = 0x03;
+const byte OP_RELAY_STATE = 0x04;
+const byte OP_READ_TEMPERATURE = 0x05;
+const byte OP_SETPOINT = 0x06;
+const byte OP_PROGRAM = 0x07;
+const byte OP_TELEMETRY = 0x08;
+const byte OP_MODE = 0x09;
+const byte OP_PING = 0x0A;
+const byte EV_RELAY_DONE = 0x41;
+const byte EV_PROGRAM_DONE = 0x42;
+const byte EV_TELEMETRY = 0x43;
+const byte OP_ERROR = 0x7F;
+boolean binary_mode = false;
+boolean frame_in_progress = false;
+unsigned long frame_started;
+byte frame_crc;
+
 
 /*
    Load temperature sensor
@@ -101,12 +156,12 @@ void setup() {
   /*
      Setup LCD
   */
-  // Serial.println("Booting LCD");
+  // Serial.println(F("Booting LCD"));
   lcd.begin(Wire);                  //Set up the LCD for I2C communication
   lcd.setBacklight(255, 255, 255);  //Set backlight to bright white
   lcd.setContrast(5);               //Set contrast. Lower to 0 for higher contrast.
   lcd.clear();                      //Clear the display - this moves the cursor to home position as well
-  lcd.print("Booting!");
+  lcd.print(F("Booting!"));
 
 
   /*
@@ -114,51 +169,51 @@ void setup() {
   */
   if (!quadRelay.begin()) {
     lcd.setCursor(0, 0);
-    lcd.print("Quad relay not connected");
-    Serial.println("Check connections to Qwiic Relay 0-3.");
+    lcd.print(F("Quad relay not connected"));
+    Serial.println(F("Check connections to Qwiic Relay 0-3."));
     delay(2000);
   }
   if (!solidStateRelay.begin()) {
     lcd.setCursor(0, 0);
-    lcd.print("SolStateRelay not connected");
-    Serial.println("Check connections to solid state relay.");
+    lcd.print(F("SolStateRelay not connected"));
+    Serial.println(F("Check connections to solid state relay."));
     delay(2000);
   }
   if (!quadRelay2.begin()) {
     lcd.setCursor(0, 0);
-    lcd.print("Quad relay not connected");
-    Serial.println("Check connections to Qwiic Relay 4-7.");
+    lcd.print(F("Quad relay not connected"));
+    Serial.println(F("Check connections to Qwiic Relay 4-7."));
     delay(2000);
   }
   if (!singleRelay3.begin()) {
     lcd.setCursor(0, 0);
-    lcd.print("Single relay not connected");
-    Serial.println("Check connections to Qwiic Relay 8.");
+    lcd.print(F("Single relay not connected"));
+    Serial.println(F("Check connections to Qwiic Relay 8."));
     delay(2000);
   }
 
   /*
      Setup temperature sensor 0
   */
-  // Serial.println("Booting temperature sensors");
+  // Serial.println(F("Booting temperature sensors"));
   tempSensor0.begin(0x60);  // Uses the default address (0x60) for SparkFun Thermocouple Amplifier
   tempSensor1.begin(0x67);
 
   // Check if temperature sensor is connected
-  // Serial.println("Check if temperature sensor 0 is online");
+  // Serial.println(F("Check if temperature sensor 0 is online"));
   if (!tempSensor0.isConnected()) {
     lcd.setCursor(0, 0);
-    lcd.print("Temp 0 not connected");
-    Serial.println("Temperature sensor 0 not connected");
+    lcd.print(F("Temp 0 not connected"));
+    Serial.println(F("Temperature sensor 0 not connected"));
     delay(10000);
   }
 
   // Check if the temperature sensor address is correct
-  // Serial.println("Check temperature sensor 0 address");
+  // Serial.println(F("Check temperature sensor 0 address"));
   if (!tempSensor0.checkDeviceID()) {
     lcd.setCursor(0, 0);
-    lcd.print("Temp 0 addr. is wrong");
-    Serial.println("Temperature sensor 0 address is wrong");
+    lcd.print(F("Temp 0 addr. is wrong"));
+    Serial.println(F("Temperature sensor 0 address is wrong"));
     delay(10000);
   }
 
@@ -167,20 +222,20 @@ void setup() {
      Setup temperature sensor 1
   */
   // Check if temperature sensor 1 is connected
-  // Serial.println("Check if temperature sensor 1 is online");
+  // Serial.println(F("Check if temperature sensor 1 is online"));
   if (!tempSensor1.isConnected()) {
     lcd.setCursor(0, 0);
-    lcd.print("Temp 1 not connected");
-    Serial.println("Temperature sensor 1 not connected");
+    lcd.print(F("Temp 1 not connected"));
+    Serial.println(F("Temperature sensor 1 not connected"));
     delay(10000);
   }
 
   // Check if the temperature sensor address is correct
-  // Serial.println("Check temperature sensor 1 address");
+  // Serial.println(F("Check temperature sensor 1 address"));
   if (!tempSensor1.checkDeviceID()) {
     lcd.setCursor(0, 0);
-    lcd.print("Temp 1 addr. is wrong");
-    Serial.println("Temperature sensor 1 address is wrong");
+    lcd.print(F("Temp 1 addr. is wrong"));
+    Serial.println(F("Temperature sensor 1 address is wrong"));
     delay(10000);
   }
 
@@ -199,13 +254,34 @@ void setup() {
   PID1.setTimeStep(1200);
 
   lcd.clear();
+
+  // Boot banner, the PC waits for it after opening the port resets the board
+  Serial.println(F("Ready"));
 }
 
 void loop() {
+  // Nothing in the loop blocks, so the relay pulses, the PID loop and the
+  // commands from the PC are all served within a few milliseconds
+  unsigned long now = millis();
+  if (now - last_sensor_update >= SENSOR_INTERVAL) {
+    last_sensor_update = now;
+    update_sensors();
+  }
+
+  // End the relay pulses that are due
+  update_relay_timers();
+  update_program();
+
+  // Check if there is instructions from the PC
+  get_data_from_pc();
+}
+
+void update_sensors() {
   // Updating the sensor values
-  delay(1000);
   sample_temperature0 = read_sample_temperature(0);
   sample_temperature1 = read_sample_temperature(1);
+  ambient_temperature0 = read_ambient_temperature(0);
+  ambient_temperature1 = read_ambient_temperature(1);
 
 
 
@@ -232,17 +308,213 @@ void loop() {
   // Write the sensor values to the LCD
   write_to_lcd(sample_temperature0, sample_temperature1, dutyCycle0, dutyCycle1);
 
+  if (telemetry) {
+    send_telemetry();
+  }
+}
 
-  // Check if there is instructions from the PC
-  get_data_from_pc();
+void send_telemetry() {
+  if (binary_mode) {
+    // millis() and 8 floats, in the order of the text frame
+    uint32_t now = millis();
+    float values[8] = { sample_temperature0, sample_temperature1, ambient_temperature0, ambient_temperature1,
+                        (float)setPoint0, (float)setPoint1, (float)dutyCycle0, (float)dutyCycle1 };
+    frame_begin(0, EV_TELEMETRY, 36);
+    frame_write(&now, 4);
+    frame_write(values, 32);
+    frame_end();
+    return;
+  }
+  // T,<millis>,<sample 0>,<sample 1>,<ambient 0>,<ambient 1>,<setpoint 0>,<setpoint 1>,<duty cycle 0>,<duty cycle 1>
+  Serial.print(F("T,"));
+  Serial.print(millis());
+  Serial.print(F(","));
+  Serial.print(sample_temperature0);
+  Serial.print(F(","));
+  Serial.print(sample_temperature1);
+  Serial.print(F(","));
+  Serial.print(ambient_temperature0);
+  Serial.print(F(","));
+  Serial.print(ambient_temperature1);
+  Serial.print(F(","));
+  Serial.print(setPoint0);
+  Serial.print(F(","));
+  Serial.print(setPoint1);
+  Serial.print(F(","));
+  Serial.print(dutyCycle0);
+  Serial.print(F(","));
+  Serial.println(dutyCycle1);
+}
+
+void switch_relay(int relay_num, boolean on) {
+  if (0 <= relay_num && relay_num <= 3)  // First quad relay
+  {
+    int relay = relay_num + 1;
+    if (on) {
+      quadRelay.turnRelayOn(relay);
+    } else {
+      quadRelay.turnRelayOff(relay);
+    }
+  }
+  if (4 <= relay_num && relay_num <= 7)  // Second quad relay
+  {
+    int relay = relay_num - 3;
+    if (on) {
+      quadRelay2.turnRelayOn(relay);
+    } else {
+      quadRelay2.turnRelayOff(relay);
+    }
+  }
+  if (8 == relay_num)  // Single relay
+  {
+    if (on) {
+      singleRelay3.turnRelayOn();
+    } else {
+      singleRelay3.turnRelayOff();
+    }
+  }
+}
+
+void start_relay_timer(int relay_num, unsigned long time_ms) {
+  // A new pulse on a relay that is already running replaces the old pulse
+  switch_relay(relay_num, true);
+  relay_started[relay_num] = millis();
+  relay_duration[relay_num] = time_ms;
+  relay_timed[relay_num] = true;
+}
+
+void finish_relay_timer(int relay_num) {
+  if (0 <= relay_num && relay_num < TIMED_RELAYS) {
+    relay_timed[relay_num] = false;
+  }
+  if (binary_mode) {
+    byte relay = relay_num;
+    frame_begin(0, EV_RELAY_DONE, 1);
+    frame_write(&relay, 1);
+    frame_end();
+  } else {
+    Serial.print(F("#"));  // '#<relay>' indicates the pulse of the relay is done
+    Serial.println(relay_num);
+  }
+}
+
+void update_relay_timers() {
+  for (int relay_num = 0; relay_num < TIMED_RELAYS; relay_num++) {
+    if (relay_timed[relay_num] && millis() - relay_started[relay_num] >= relay_duration[relay_num]) {
+      switch_relay(relay_num, false);
+      finish_relay_timer(relay_num);
+    }
+  }
+}
+
+void start_program() {
+  // Parse the steps of "program,<relay>,<start ms>,<duration ms>,..."
+  // A new program replaces a running one
+  stop_program();
+  program_steps = 0;
+  char *relay_str = strtok(NULL, ",");
+  while (relay_str != NULL && program_steps < PROGRAM_STEPS) {
+    char *start_str = strtok(NULL, ",");
+    char *duration_str = strtok(NULL, ",");
+    if (start_str == NULL || duration_str == NULL) {
+      break;
+    }
+    program_relay[program_steps] = atoi(relay_str);
+    program_start[program_steps] = atol(start_str);
+    program_duration[program_steps] = atol(duration_str);
+    program_state[program_steps] = 0;
+    program_steps++;
+    relay_str = strtok(NULL, ",");
+  }
+  begin_program();
+}
+
+void begin_program() {
+  program_started = millis();
+  program_running = true;
+}
+
+void stop_program() {
+  for (int step = 0; step < program_steps; step++) {
+    if (program_state[step] == 1) {
+      switch_relay(program_relay[step], false);
+    }
+  }
+  program_running = false;
+}
+
+void update_program() {
+  if (!program_running) {
+    return;
+  }
+  unsigned long elapsed = millis() - program_started;
+  boolean done = true;
+  for (int step = 0; step < program_steps; step++) {
+    if (program_state[step] == 0 && elapsed >= program_start[step]) {
+      switch_relay(program_relay[step], true);
+      program_on_at[step] = elapsed;
+      program_state[step] = 1;
+    }
+    if (program_state[step] == 1 && elapsed - program_on_at[step] >= program_duration[step]) {
+      switch_relay(program_relay[step], false);
+      program_off_at[step] = elapsed;
+      program_state[step] = 2;
+    }
+    if (program_state[step] != 2) {
+      done = false;
+    }
+  }
+  if (done && binary_mode) {
+    program_running = false;
+    frame_begin(0, EV_PROGRAM_DONE, program_steps * 8);
+    for (int step = 0; step < program_steps; step++) {
+      uint32_t times[2] = { program_on_at[step], program_off_at[step] };
+      frame_write(times, 8);
+    }
+    frame_end();
+  } else if (done) {
+    program_running = false;
+    Serial.print(F("P"));  // 'P' indicates the program is done
+    for (int step = 0; step < program_steps; step++) {
+      Serial.print(F(","));
+      Serial.print(program_on_at[step]);
+      Serial.print(F(","));
+      Serial.print(program_off_at[step]);
+    }
+    Serial.println();
+  }
 }
 
 void get_data_from_pc() {
 
+  // Drop a frame that was not received completely
+  if (frame_in_progress && millis() - frame_started > FRAME_TIMEOUT) {
+    frame_in_progress = false;
+  }
+
   // receive data from PC and save it into input_buffer
   while (Serial.available()) {
     char x = Serial.read();
 
+    // Binary frames, which may contain the text markers
+    if (frame_in_progress) {
+      input_buffer[bytes_rcvd] = x;
+      bytes_rcvd++;
+      if (bytes_rcvd == 3 && (byte)input_buffer[2] > buff_size - 4) {
+        frame_in_progress = false;  // Too long to be a frame
+      } else if (bytes_rcvd >= 3 && bytes_rcvd == (byte)input_buffer[2] + 4) {
+        frame_in_progress = false;
+        parse_frame();
+      }
+      continue;
+    }
+    if (!read_in_progress && (byte)x == FRAME_SYNC) {
+      bytes_rcvd = 0;
+      frame_in_progress = true;
+      frame_started = millis();
+      continue;
+    }
+
     // the order of these IF clauses is significant
 
     if (x == end_marker) {
@@ -267,105 +539,285 @@ void get_data_from_pc() {
   }
 }
 
+byte crc8_update(byte crc, byte data) {
+  crc ^= data;
+  for (int bit = 0; bit < 8; bit++) {
+    crc = crc & 0x80 ? (crc << 1) ^ 0x07 : crc << 1;
+  }
+  return crc;
+}
+
+void frame_begin(byte seq, byte opcode, byte len) {
+  Serial.write(FRAME_SYNC);
+  frame_crc = 0;
+  frame_write(&seq, 1);
+  frame_write(&opcode, 1);
+  frame_write(&len, 1);
+}
+
+void frame_write(const void *data, byte len) {
+  const byte *bytes = (const byte *)data;
+  for (byte i = 0; i < len; i++) {
+    Serial.write(bytes[i]);
+    frame_crc = crc8_update(frame_crc, bytes[i]);
+  }
+}
+
+void frame_end() {
+  Serial.write(frame_crc);
+}
+
+void send_reply(byte seq, byte opcode, const void *data, byte len) {
+  frame_begin(seq, opcode | FRAME_REPLY, len);
+  frame_write(data, len);
+  frame_end();
+}
+
+void send_error(byte seq, byte opcode) {
+  frame_begin(seq, OP_ERROR, 1);
+  frame_write(&opcode, 1);
+  frame_end();
+}
+
+int payload_length(byte opcode, const byte *payload, byte len) {
+  // Bytes of payload a command needs, see framing.encode_command()
+  switch (opcode) {
+    case OP_RELAY_ON_TIME:
+      return 5;
+    case OP_SETPOINT:
+      return 3;
+    case OP_PROGRAM:
+      return len < 1 ? 1 : 1 + 9 * payload[0];  // Number of steps, then steps
+    case OP_PING:
+      return 0;
+    default:
+      return 1;
+  }
+}
+
+int relay_state(int relay_num) {
+  // 0 = off, 1 = on, the same relays as get_relay_<n>_state
+  if (0 <= relay_num && relay_num <= 3) {
+    return quadRelay.getState(relay_num + 1);
+  }
+  if (4 <= relay_num && relay_num <= 7) {
+    return quadRelay2.getState(relay_num - 3);
+  }
+  if (relay_num == 8 || relay_num == 9) {
+    return solidStateRelay.getState(relay_num - 7);
+  }
+  return 0;
+}
+
+float read_temperature(byte sensor) {
+  switch (sensor) {
+    case 0: return sample_temperature0;
+    case 1: return sample_temperature1;
+    case 2: return ambient_temperature0;
+    case 3: return ambient_temperature1;
+  }
+  return 999.99;
+}
+
+void parse_frame() {
+  // input_buffer holds sequence, opcode, length, payload and CRC
+  byte seq = input_buffer[0];
+  byte opcode = input_buffer[1];
+  byte len = input_buffer[2];
+  byte *payload = (byte *)input_buffer + 3;
+  byte crc = 0;
+  for (byte i = 0; i < len + 3; i++) {
+    crc = crc8_update(crc, input_buffer[i]);
+  }
+  if (crc != (byte)input_buffer[len + 3]) {
+    return;  // Corrupted, the PC times out and may retry
+  }
+  // A short frame would act on stale bytes of the buffer, eg. a random relay
+  if (len < payload_length(opcode, payload, len)) {
+    send_error(seq, opcode);
+    return;
+  }
+
+  switch (opcode) {
+    case OP_RELAY_ON:
+      switch_relay(payload[0], true);
+      send_reply(seq, opcode, NULL, 0);
+      break;
+
+    case OP_RELAY_OFF:
+      switch_relay(payload[0], false);
+      if (payload[0] < TIMED_RELAYS && relay_timed[payload[0]]) {
+        finish_relay_timer(payload[0]);
+      }
+      send_reply(seq, opcode, NULL, 0);
+      break;
+
+    case OP_RELAY_ON_TIME:
+      {
+        uint32_t time_ms;
+        memcpy(&time_ms, payload + 1, 4);
+        send_reply(seq, opcode, NULL, 0);
+        if (payload[0] < TIMED_RELAYS) {
+          start_relay_timer(payload[0], time_ms);
+        } else {
+          finish_relay_timer(payload[0]);
+        }
+      }
+      break;
+
+    case OP_RELAY_STATE:
+      {
+        byte state = relay_state(payload[0]);
+        send_reply(seq, opcode, &state, 1);
+      }
+      break;
+
+    case OP_READ_TEMPERATURE:
+      {
+        float temperature = read_temperature(payload[0]);
+        send_reply(seq, opcode, &temperature, 4);
+      }
+      break;
+
+    case OP_SETPOINT:
+      {
+        int16_t tenths;
+        memcpy(&tenths, payload + 1, 2);
+        if (payload[0] == 0) {
+          setPoint0 = tenths / 10.0;
+          write_to_eeprom_setPoint0(setPoint0);
+        } else {
+          setPoint1 = tenths / 10.0;
+          write_to_eeprom_setPoint1(setPoint1);
+        }
+        send_reply(seq, opcode, NULL, 0);
+      }
+      break;
+
+    case OP_PROGRAM:
+      stop_program();
+      program_steps = min((int)payload[0], PROGRAM_STEPS);
+      for (int step = 0; step < program_steps; step++) {
+        byte *data = payload + 1 + step * 9;
+        uint32_t start, duration;
+        memcpy(&start, data + 1, 4);
+        memcpy(&duration, data + 5, 4);
+        program_relay[step] = data[0];
+        program_start[step] = start;
+        program_duration[step] = duration;
+        program_state[step] = 0;
+      }
+      begin_program();
+      send_reply(seq, opcode, NULL, 0);
+      break;
+
+    case OP_TELEMETRY:
+      telemetry = payload[0] != 0;
+      send_reply(seq, opcode, NULL, 0);
+      break;
+
+    case OP_MODE:
+      send_reply(seq, opcode, NULL, 0);
+      binary_mode = payload[0] != 0;
+      break;
+
+    case OP_PING:
+      send_reply(seq, opcode, NULL, 0);
+      break;
+
+    default:
+      send_error(seq, opcode);
+  }
+}
+
+boolean command_is(const char *command, PGM_P name) {
+  // The names of the commands are kept in flash, see PSTR()
+  return command != NULL && strcmp_P(command, name) == 0;
+}
+
 void parse_data() {
   // split the data into its parts
   char *str_to_ind;  // this is used by strtok() as an index
 
   str_to_ind = strtok(input_buffer, ",");  // get the first part - the string
-  message_from_pc = String(str_to_ind);
+  const char *command = str_to_ind;
 
-  if (message_from_pc == "set_relay_on_time") {
+  if (command_is(command, PSTR("set_relay_on_time"))) {
     str_to_ind = strtok(NULL, ",");    // this continues where the previous call left off
     int relay_num = atoi(str_to_ind);  // convert this part to an integer
 
     str_to_ind = strtok(NULL, ",");
-    int time_ms = atoi(str_to_ind);
+    unsigned long time_ms = atol(str_to_ind);
 
-    if (0 <= relay_num && relay_num <= 3)  // First quad relay
-    {
-      int relay = relay_num + 1;
-      quadRelay.turnRelayOn(relay);
-      delay(time_ms);
-      quadRelay.turnRelayOff(relay);
+    Serial.println(F("#"));  // '#' indicates the pulse has started
+    if (0 <= relay_num && relay_num < TIMED_RELAYS) {
+      start_relay_timer(relay_num, time_ms);
+    } else {
+      finish_relay_timer(relay_num);
     }
-    if (4 <= relay_num && relay_num <= 7)  // Second quad relay
-    {
-      int relay = relay_num - 3;
-      quadRelay2.turnRelayOn(relay);
-      delay(time_ms);
-      quadRelay2.turnRelayOff(relay);
-    }
-    if (8 == relay_num)  // Single relay
-    {
-      singleRelay3.turnRelayOn();
-      delay(time_ms);
-      singleRelay3.turnRelayOff();
-    }
-    Serial.println("#");  // '#' indicates process is done
   }
 
-  if (message_from_pc == "set_relay_on") {
+  else if (command_is(command, PSTR("set_relay_on"))) {
     str_to_ind = strtok(NULL, ",");    // this continues where the previous call left off
     int relay_num = atoi(str_to_ind);  // convert this part to an integer
 
-    if (0 <= relay_num && relay_num <= 3)  // First quad relay
-    {
-      int relay = relay_num + 1;
-      quadRelay.turnRelayOn(relay);
-    }
-    if (4 <= relay_num && relay_num <= 7)  // Second quad relay
-    {
-      int relay = relay_num - 3;
-      quadRelay2.turnRelayOn(relay);
-    }
-    if (8 == relay_num)  // Single relay
-    {
-      singleRelay3.turnRelayOn();
-    }
-    Serial.println("#");  // '#' indicates process is done
+    switch_relay(relay_num, true);
+    Serial.println(F("#"));  // '#' indicates process is done
   }
 
-  if (message_from_pc == "set_relay_off") {
+  else if (command_is(command, PSTR("set_relay_off"))) {
     str_to_ind = strtok(NULL, ",");    // this continues where the previous call left off
     int relay_num = atoi(str_to_ind);  // convert this part to an integer
 
-    if (0 <= relay_num && relay_num <= 3)  // First quad relay
-    {
-      int relay = relay_num + 1;
-      quadRelay.turnRelayOff(relay);
+    switch_relay(relay_num, false);
+    if (0 <= relay_num && relay_num < TIMED_RELAYS && relay_timed[relay_num]) {
+      // Switching a relay off ends its pulse early
+      finish_relay_timer(relay_num);
     }
-    if (4 <= relay_num && relay_num <= 7)  // Second quad relay
-    {
-      int relay = relay_num - 3;
-      quadRelay2.turnRelayOff(relay);
-    }
-    if (8 == relay_num)  // Single relay
-    {
-      singleRelay3.turnRelayOff();
-    }
-    Serial.println("#");  // '#' indicates process is done
+    Serial.println(F("#"));  // '#' indicates process is done
   }
 
 
-  if (message_from_pc == "read_temp0") {
+  else if (command_is(command, PSTR("program"))) {
+    start_program();
+    Serial.println(F("#"));  // '#' indicates the program has started
+  }
+
+  else if (command_is(command, PSTR("binary"))) {
+    str_to_ind = strtok(NULL, ",");  // 1 = binary events, 0 = text events
+    Serial.println(F("#"));  // '#' indicates process is done
+    binary_mode = str_to_ind != NULL && atoi(str_to_ind) != 0;
+  }
+
+  else if (command_is(command, PSTR("ping"))) {
+    Serial.println(F("#"));  // '#' indicates the firmware is running
+  }
+
+  else if (command_is(command, PSTR("telemetry"))) {
+    str_to_ind = strtok(NULL, ",");  // 1 = on, 0 = off
+    telemetry = str_to_ind != NULL && atoi(str_to_ind) != 0;
+    Serial.println(F("#"));  // '#' indicates process is done
+  }
+
+  else if (command_is(command, PSTR("read_temp0"))) {
     Serial.println(sample_temperature0);
   }
-  if (message_from_pc == "read_temp1") {
+  else if (command_is(command, PSTR("read_temp1"))) {
     Serial.println(sample_temperature1);
   }
-  if (message_from_pc == "read_temp0_ambient") {
+  else if (command_is(command, PSTR("read_temp0_ambient"))) {
     Serial.println(ambient_temperature0);
   }
-  if (message_from_pc == "read_temp1_ambient") {
+  else if (command_is(command, PSTR("read_temp1_ambient"))) {
     Serial.println(ambient_temperature1);
   }
-  if (message_from_pc == "setpoint0") {
+  else if (command_is(command, PSTR("setpoint0"))) {
     str_to_ind = strtok(NULL, ",");  // this continues where the previous call left off
     setPoint0 = atoi(str_to_ind);
     setPoint0 = setPoint0 / 10;
     write_to_eeprom_setPoint0(setPoint0);
   }
-  if (message_from_pc == "setpoint1") {
+  else if (command_is(command, PSTR("setpoint1"))) {
     str_to_ind = strtok(NULL, ",");  // this continues where the previous call left off
     setPoint1 = atoi(str_to_ind);
     setPoint1 = setPoint1 / 10;
@@ -373,49 +825,49 @@ void parse_data() {
   }
   // ... in the future
 
-  if (message_from_pc == "get_relay_0_state") {
+  else if (command_is(command, PSTR("get_relay_0_state"))) {
     int state = quadRelay.getState(1);
     Serial.println(state);  // 0 = off, 1 = on
   }
-  if (message_from_pc == "get_relay_1_state") {
+  else if (command_is(command, PSTR("get_relay_1_state"))) {
     int state = quadRelay.getState(2);
     Serial.println(state);  // 0 = off, 1 = on
   }
-  if (message_from_pc == "get_relay_2_state") {
+  else if (command_is(command, PSTR("get_relay_2_state"))) {
     int state = quadRelay.getState(3);
     Serial.println(state);  // 0 = off, 1 = on
   }
-  if (message_from_pc == "get_relay_3_state") {
+  else if (command_is(command, PSTR("get_relay_3_state"))) {
     int state = quadRelay.getState(4);
     Serial.println(state);  // 0 = off, 1 = on
   }
-  if (message_from_pc == "get_relay_4_state") {
+  else if (command_is(command, PSTR("get_relay_4_state"))) {
     int state = quadRelay2.getState(1);
     Serial.println(state);  // 0 = off, 1 = on
   }
-  if (message_from_pc == "get_relay_5_state") {
+  else if (command_is(command, PSTR("get_relay_5_state"))) {
     int state = quadRelay2.getState(2);
     Serial.println(state);  // 0 = off, 1 = on
   }
-  if (message_from_pc == "get_relay_6_state") {
+  else if (command_is(command, PSTR("get_relay_6_state"))) {
     int state = quadRelay2.getState(3);
     Serial.println(state);  // 0 = off, 1 = on
   }
-  if (message_from_pc == "get_relay_7_state") {
+  else if (command_is(command, PSTR("get_relay_7_state"))) {
     int state = quadRelay2.getState(4);
     Serial.println(state);  // 0 = off, 1 = on
   }
-  if (message_from_pc == "get_relay_8_state") {
+  else if (command_is(command, PSTR("get_relay_8_state"))) {
     int state = solidStateRelay.getState(1);
     Serial.println(state);  // 0 = off, 1 = on
   }
-  if (message_from_pc == "get_relay_9_state") {
+  else if (command_is(command, PSTR("get_relay_9_state"))) {
     int state = solidStateRelay.getState(2);
     Serial.println(state);  // 0 = off, 1 = on
   }
-
   else {
-    Serial.println("Unknown command: " + message_from_pc);
+    Serial.print(F("Unknown command: "));
+    Serial.println(command != NULL ? command : "");
   }
 }
 
@@ -423,17 +875,17 @@ void ultrasound(float ultrasound_time) {
   // flip relay on
   delay(ultrasound_time);
   // Flip relay off
-  Serial.println("#");  // '#' indicates process is done
+  Serial.println(F("#"));  // '#' indicates process is done
 }
 
 void drain(float drain_time) {
   // Do something
-  Serial.println("#");  // '#' indicates process is done
+  Serial.println(F("#"));  // '#' indicates process is done
 }
 
 void transfer_liquid(float drain_time) {
   // Do something
-  Serial.println("#");  // '#' indicates process is done
+  Serial.println(F("#"));  // '#' indicates process is done
 }
 
 float read_sample_temperature(int sensor) {
@@ -474,21 +926,21 @@ float read_ambient_temperature(int sensor) {
 
 void write_to_lcd(float sample_temp0, float sample_temp1, double PIDoutput0, double PIDoutput1) {
   lcd.setCursor(0, 0);
-  lcd.print("0:");
+  lcd.print(F("0:"));
   lcd.print(sample_temp0);
-  lcd.print(" ");
+  lcd.print(F(" "));
   lcd.setCursor(9, 0);
-  lcd.print("1:");
+  lcd.print(F("1:"));
   lcd.print(sample_temp1);
-  lcd.print(" ");
+  lcd.print(F(" "));
   lcd.setCursor(0, 1);
-  lcd.print("P0:");
+  lcd.print(F("P0:"));
   lcd.print(round(PIDoutput0));
-  lcd.print(" ");
+  lcd.print(F(" "));
   lcd.setCursor(8, 1);
-  lcd.print("P1:");
+  lcd.print(F("P1:"));
   lcd.print(round(PIDoutput1));
-  lcd.print(" ");
+  lcd.print(F(" "));
 }
 
 void read_from_eeprom_setPoints() {
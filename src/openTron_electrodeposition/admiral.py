@@ -3,209 +3,741 @@
 # Author: Nis Fisker-Bødker
 # Date: 18-06-2024
 
-from PySide2.QtWidgets import QApplication
-from SquidstatPyLibrary import (
-    AisDeviceTracker,
-    AisExperiment,
-    AisEISPotentiostaticElement,
-    AisCyclicVoltammetryElement,
-    AisConstantCurrentElement,
-    AisConstantPotElement,
-    AisConstantPowerElement,
-    AisConstantResistanceElement,
-    AisDCCurrentSweepElement,
-    AisDCPotentialSweepElement,
-    AisDiffPulseVoltammetryElement,
-    AisNormalPulseVoltammetryElement,
-    AisSquareWaveVoltammetryElement,
-    AisEISGalvanostaticElement,
-    AisOpenCircuitElement,
-)
+import asyncio
+import concurrent.futures
+import copy
+import math
 import pandas as pd
+import queue
+import threading
 import time
+import types
 import warnings
+from openTron_electrodeposition.buffer import ColumnarBuffer
+from openTron_electrodeposition.monitors import OhmicInterceptEstimator
+from openTron_electrodeposition.reducers import Reducer
+from openTron_electrodeposition.sink import CsvChunkSink
+from openTron_electrodeposition.stats import StepStats
 
 # Suppress FutureWarning messages from Pandas
 warnings.simplefilter(action="ignore", category=FutureWarning)
 
+AC_COLUMNS = [
+    "Timestamp",
+    "Frequency [Hz]",
+    "Absolute Impedance",
+    "Phase Angle",
+    "Real Impedance",
+    "Imaginary Impedance",
+    "Total Harmonic Distortion",
+    "Number of Cycles",
+    "Working electrode DC Voltage [V]",
+    "DC Current [A]",
+    "Current Amplitude",
+    "Voltage Amplitude",
+]
+NEW_ELEMENT_COLUMNS = [
+    "Step Name",
+    "Step Number",
+    "Substep Number",
+    "DC Index",
+    "AC Index",
+]
+DC_COLUMNS = [
+    "Timestamp",
+    "Working Electrode Voltage [V]",
+    "Working Electrode Current [A]",
+    "Temperature [C]",
+]
+# Names of the Qt and Squidstat classes used by AdmiralSquidstatWrapper. Every
+# backend provides them.
+BACKEND_NAMES = [
+    "QApplication",
+    "QTimer",
+    "AisDeviceTracker",
+    "AisExperiment",
+    "AisEISPotentiostaticElement",
+    "AisCyclicVoltammetryElement",
+    "AisConstantCurrentElement",
+    "AisConstantPotElement",
+    "AisConstantPowerElement",
+    "AisConstantResistanceElement",
+    "AisDCCurrentSweepElement",
+    "AisDCPotentialSweepElement",
+    "AisDiffPulseVoltammetryElement",
+    "AisNormalPulseVoltammetryElement",
+    "AisSquareWaveVoltammetryElement",
+    "AisEISGalvanostaticElement",
+    "AisOpenCircuitElement",
+]
+
+
+def _load_squidstat() -> dict:
+    """Internal function, imports PySide2 and the Admiral Squidstat library."""
+    try:
+        from PySide2.QtCore import QTimer
+        from PySide2.QtWidgets import QApplication
+        import SquidstatPyLibrary
+    except ImportError as e:
+        raise ImportError(
+            "PySide2 and SquidstatPyLibrary are needed to use the potentiostat. "
+            f"Use simulated=True to run without them. ({e})"
+        )
+    classes = dict(vars(SquidstatPyLibrary))
+    classes.update(QApplication=QApplication, QTimer=QTimer)
+    return classes
+
+
+def _load_simulator() -> dict:
+    """Internal function, imports the simulated potentiostat."""
+    from openTron_electrodeposition import simulator
+
+    return vars(simulator)
+
+
+# Backends by name. The loaders run on the first connection to a device, so
+# importing this module does not import Qt or the vendor library.
+BACKENDS = {"squidstat": _load_squidstat, "simulated": _load_simulator}
+_loaded_backends = {}
+
+
+def register_backend(name: str, loader) -> None:
+    """Add a backend that AdmiralSquidstatWrapper(backend=name) can use.
+
+    Args:
+        name (str): Name of the backend
+        loader (callable): Function without arguments that imports the backend
+            and returns a dict with the classes named in BACKEND_NAMES
+    """
+    BACKENDS[name] = loader
+    _loaded_backends.pop(name, None)
+
+
+def get_backend(name: str = "squidstat") -> types.SimpleNamespace:
+    """The Qt and Squidstat classes of a backend, which is loaded on the first
+    call.
+
+    Args:
+        name (str, optional): Name of the backend in BACKENDS. Defaults to
+            "squidstat".
+
+    Returns:
+        types.SimpleNamespace: The classes, by the names in BACKEND_NAMES
+    """
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unknown potentiostat backend: {name}. Known are {sorted(BACKENDS)}."
+        )
+    if name not in _loaded_backends:
+        classes = BACKENDS[name]()
+        missing = [key for key in BACKEND_NAMES if key not in classes]
+        if missing:
+            raise ValueError(f"The backend {name} lacks {missing}.")
+        _loaded_backends[name] = types.SimpleNamespace(
+            **{key: classes[key] for key in BACKEND_NAMES}
+        )
+    return _loaded_backends[name]
+
+
+class ChannelState:
+    def __init__(self, channel: int):
+        """The samples, the monitors and the running experiment of one channel
+        of the potentiostat.
+
+        Args:
+            channel (int): The channel of the potentiostat
+        """
+        self.channel = channel
+        self.ac_buffer = ColumnarBuffer(AC_COLUMNS)
+        self.dc_buffer = ColumnarBuffer(DC_COLUMNS)
+        self.new_element_list = pd.DataFrame(columns=NEW_ELEMENT_COLUMNS)
+        self.step_monitors = [[]]
+        self.active_monitors = []
+        self.step_index = -1
+        self.last_step_number = None
+        self.step_summaries = []
+        self.running = False
+        self.experiment_future = None
+        self.on_stopped = None
+        # Reducer of the DC samples and the raw samples it replaces, if kept
+        self.dc_reducer = None
+        self.raw_dc_buffer = None
+        # Instrumentation of the data callbacks, per step, see stats.py
+        self.step_stats = [StepStats()]
+        self.stats = self.step_stats[0]
+        self.start_time = None
+        self.first_sample_delay = None
+
+
+class SampleStore:
+    """The samples of the channels of a potentiostat. Shared by
+    AdmiralSquidstatWrapper and worker.PotentiostatProcess, which set
+    self.channel, the default channel, and self._channels, the ChannelState
+    of each channel by number.
+    """
+
+    def channel_state(self, channel: int = None) -> ChannelState:
+        """The samples, monitors and running experiment of a channel.
+
+        Args:
+            channel (int, optional): The channel. Defaults to self.channel.
+
+        Returns:
+            ChannelState: The state of the channel
+        """
+        if channel is None:
+            channel = self.channel
+        if channel not in self._channels:
+            self._channels[channel] = ChannelState(channel)
+        return self._channels[channel]
+
+    @property
+    def dc_buffer(self) -> ColumnarBuffer:
+        """The DC samples of the default channel."""
+        return self.channel_state().dc_buffer
+
+    @property
+    def ac_buffer(self) -> ColumnarBuffer:
+        """The AC samples of the default channel."""
+        return self.channel_state().ac_buffer
+
+    @property
+    def new_element_list(self) -> pd.DataFrame:
+        """The elements started on the default channel."""
+        return self.channel_state().new_element_list
+
+    @property
+    def step_summaries(self) -> list:
+        """The summaries of the steps of the last experiment on the default channel."""
+        return self.channel_state().step_summaries
+
+    def get_data(self, channel: int = None):
+        """Return the AC and DC data as pandas dataframes. If no data is available, return None for the respective dataframe.
+
+        Args:
+            channel (int, optional): The channel. Defaults to self.channel.
+
+        Returns:
+            [pd.DataFrame, pd.DataFrame]: A list containing the two AC data and the DC data pandas dataframes.
+        """
+        print("Returning data")
+        state = self.channel_state(channel)
+        if len(state.ac_buffer) == 0:
+            print("No AC data available \n")
+            return None, state.dc_buffer.to_dataframe()
+        elif len(state.dc_buffer) == 0:
+            print("No DC data available \n")
+            return state.ac_buffer.to_dataframe(), None
+        else:
+            print("")
+            return state.ac_buffer.to_dataframe(), state.dc_buffer.to_dataframe()
+
+    def _buffer(self, kind: str, channel: int = None) -> ColumnarBuffer:
+        """Internal function, the buffer of a kind of samples of a channel."""
+        if kind not in ("dc", "ac"):
+            raise ValueError(f"Unknown kind of samples: {kind}")
+        state = self.channel_state(channel)
+        return state.dc_buffer if kind == "dc" else state.ac_buffer
+
+    def get_arrays(
+        self, kind: str = "dc", start: int = 0, stop: int = None, channel: int = None
+    ) -> dict:
+        """Return the samples as float64 NumPy views of the buffer, without
+        copying them like get_data() does. The views do not follow samples
+        recorded after the call.
+
+        Example:
+            dc = admiral.get_arrays("dc", *result["dc_range"])
+            voltage = dc["Working Electrode Voltage [V]"]
+
+        Args:
+            kind (str, optional): "dc" or "ac". Defaults to "dc".
+            start (int, optional): First sample. Defaults to 0.
+            stop (int, optional): Sample to stop before. Defaults to all.
+            channel (int, optional): The channel. Defaults to self.channel.
+
+        Returns:
+            dict: Read-only array per column name
+        """
+        return self._buffer(kind, channel).arrays(start, stop)
+
+    def get_record_batch(
+        self, kind: str = "dc", start: int = 0, stop: int = None, channel: int = None
+    ):
+        """Same as get_arrays(), as an Arrow record batch. Needs pyarrow.
+
+        Returns:
+            pyarrow.RecordBatch: One float64 column per column of the data
+        """
+        return self._buffer(kind, channel).to_record_batch(start, stop)
+
+    def clear_data(self, channel: int = None):
+        """Clear the AC and DC data buffers.
+
+        Args:
+            channel (int, optional): The channel. Defaults to self.channel.
+        """
+        state = self.channel_state(channel)
+        state.ac_buffer.clear()
+        state.dc_buffer.clear()
+        if state.raw_dc_buffer is not None:
+            state.raw_dc_buffer.clear()
+        if state.dc_reducer is not None:
+            state.dc_reducer.reset()
+        # self.new_element_list = pd.DataFrame(
+        #     columns=["Step Name", "Step Number", "Substep Number"]
+        # )
+        time.sleep(1)
+
+    def attach_sinks(
+        self, dc_sink=None, ac_sink=None, chunk_size: int = 256, channel: int = None
+    ):
+        """Stream the DC and/or AC data to sinks while the experiment runs.
+        The data is still available through get_data().
+
+        Args:
+            dc_sink (optional): Sink for the DC data, eg. a CsvChunkSink with
+                the columns DC_COLUMNS. Defaults to None.
+            ac_sink (optional): Sink for the AC data, eg. a CsvChunkSink with
+                the columns AC_COLUMNS. Defaults to None.
+            chunk_size (int, optional): Number of samples written per chunk.
+                Defaults to 256.
+            channel (int, optional): The channel. Defaults to self.channel.
+        """
+        state = self.channel_state(channel)
+        if dc_sink is not None:
+            state.dc_buffer.attach_sink(dc_sink, chunk_size)
+        if ac_sink is not None:
+            state.ac_buffer.attach_sink(ac_sink, chunk_size)
+
+    def stream_to_csv(self, file_name: str, chunk_size: int = 256, channel: int = None):
+        """Stream the DC and AC data to '<file_name> dc_data.csv' and
+        '<file_name> ac_data.csv' while the experiment runs. The files can be
+        read back with sink.load_sink_file().
 
-class AdmiralSquidstatWrapper:
-    def __init__(self, port="COM5", instrument_name="Plus1894"):
+        Args:
+            file_name (str): Name of the files without the file extension
+            chunk_size (int, optional): Number of samples written per chunk.
+                Defaults to 256.
+            channel (int, optional): The channel. Defaults to self.channel.
+        """
+        self.attach_sinks(
+            dc_sink=CsvChunkSink(file_name + " dc_data.csv", DC_COLUMNS),
+            ac_sink=CsvChunkSink(file_name + " ac_data.csv", AC_COLUMNS),
+            chunk_size=chunk_size,
+            channel=channel,
+        )
+
+    def detach_sinks(self, channel: int = None):
+        """Write the remaining data to the sinks, close and detach them.
+
+        Args:
+            channel (int, optional): The channel. Defaults to self.channel.
+
+        Raises:
+            IOError: A sink failed to write its data.
+        """
+        state = self.channel_state(channel)
+        error = None
+        for buffer in (state.dc_buffer, state.ac_buffer):
+            sink = buffer.detach_sink()
+            if sink is not None and hasattr(sink, "close"):
+                # Close both sinks before raising the error of a failed write
+                try:
+                    sink.close()
+                except Exception as e:
+                    error = error or e
+        if error is not None:
+            raise error
+
+    async def iter_samples(
+        self, kind: str = "dc", interval: float = 0.1, channel: int = None
+    ):
+        """Asynchronously iterate over the samples of the running experiment
+        in batches, until the experiment has stopped.
+
+        Example:
+            future = admiral.submit_protocol(protocol)
+            async for batch in admiral.iter_samples("dc"):
+                print(batch["Working Electrode Voltage [V]"].iloc[-1])
+
+        Args:
+            kind (str, optional): "dc" or "ac". Defaults to "dc".
+            interval (float, optional): Seconds between checks for new
+                samples. Defaults to 0.1.
+            channel (int, optional): The channel. Defaults to self.channel.
+
+        Yields:
+            pd.DataFrame: The samples recorded since the previous batch
+        """
+        state = self.channel_state(channel)
+        buffer = self._buffer(kind, channel)
+        start = 0
+        while True:
+            # Check for the end before reading the length, so the samples
+            # recorded just before the experiment stopped are included
+            future = state.experiment_future
+            done = future is None or future.done()
+            stop = len(buffer)
+            if stop > start:
+                yield buffer.to_dataframe(start, stop)
+                start = stop
+            elif done:
+                return
+            else:
+                await asyncio.sleep(interval)
+
+
+class AdmiralSquidstatWrapper(SampleStore):
+    def __init__(
+        self,
+        port="COM5",
+        instrument_name="Plus1894",
+        threaded=False,
+        simulated=False,
+        backend=None,
+    ):
         """Initialize the AdmiralWrapper class. This class is used to interface with the Admiral potentiostat.
 
         Args:
             port (str, optional): The COM port to which the potentiostat is connected. Defaults to "COM5".
             instrument_name (str, optional): The name of the instrument. Defaults to "Plus1894".
+            threaded (bool, optional): Run the Qt event loop on a dedicated thread, so experiments can be started with submit_protocol() without blocking the calling thread. Defaults to False.
+            simulated (bool, optional): Run on the simulated potentiostat of simulator.py instead of an instrument, eg. for development and benchmarks without the vendor libraries. The simulated cell is configured with handler.cell_settings and the pace with handler.speed. Same as backend="simulated". Defaults to False.
+            backend (str, optional): Name of the backend in BACKENDS, which is imported when connecting to the device. Defaults to "squidstat", or "simulated" if simulated is True.
         """
 
-        self.app = QApplication()
-        self.tracker = AisDeviceTracker.Instance()
+        self.threaded = threaded
+        if backend is None:
+            backend = "simulated" if simulated else "squidstat"
+        self.backend_name = backend
+        self.simulated = backend == "simulated"
+        # The classes of the backend, loaded by _setup_qt()
+        self.backend = None
         self.handler = None
+        # Channel used when no channel is given, eg. by the setup_*() functions
         self.channel = 0
 
-        self.ac_data_list = pd.DataFrame(
-            columns=[
-                "Timestamp",
-                "Frequency [Hz]",
-                "Absolute Impedance",
-                "Phase Angle",
-                "Real Impedance",
-                "Imaginary Impedance",
-                "Total Harmonic Distortion",
-                "Number of Cycles",
-                "Working electrode DC Voltage [V]",
-                "DC Current [A]",
-                "Current Amplitude",
-                "Voltage Amplitude",
-            ]
-        )
-        self.dc_data_list = pd.DataFrame(
-            columns=[
-                "Timestamp",
-                "Working Electrode Voltage [V]",
-                "Working Electrode Current [A]",
-                "Temperature [C]",
-            ]
-        )
-        self.new_element_list = pd.DataFrame(
-            columns=["Step Name", "Step Number", "Substep Number"]
+        self._channels = {}
+        self._protocol = None
+
+        if not self.threaded:
+            self._setup_qt(port, instrument_name)
+            return
+        # The QApplication, the device tracker and the handler live on the Qt
+        # thread. Calls from other threads are queued and run there by a timer.
+        self._calls = queue.Queue()
+        self._ready = threading.Event()
+        self._init_error = None
+        self._qt_thread = threading.Thread(
+            target=self._qt_main,
+            args=(port, instrument_name),
+            name="AdmiralQt",
+            daemon=True,
         )
+        self._qt_thread.start()
+        self._ready.wait()
+        if self._init_error is not None:
+            raise self._init_error
+
+    def _setup_qt(self, port, instrument_name):
+        """Internal function, creates the Qt application and connects to the potentiostat."""
+        self.backend = get_backend(self.backend_name)
+        self.app = self.backend.QApplication()
+        self.tracker = self.backend.AisDeviceTracker.Instance()
         self.connect_to_device(port=port, instrument_name=instrument_name)
         self.setup_data_handlers()
 
+    def _qt_main(self, port, instrument_name):
+        """Internal function, the body of the Qt thread in threaded mode."""
+        try:
+            self._setup_qt(port, instrument_name)
+            self._timer = self.backend.QTimer()
+            self._timer.timeout.connect(self._process_calls)
+            self._timer.start(10)
+        except Exception as e:
+            self._init_error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        self.app.exec_()
+
+    def _process_calls(self):
+        """Internal function, runs the calls queued by _invoke() on the Qt thread."""
+        while True:
+            try:
+                function, args, future = self._calls.get_nowait()
+            except queue.Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _invoke(self, function, *args) -> concurrent.futures.Future:
+        """Internal function, runs a function on the Qt thread.
+
+        Returns:
+            concurrent.futures.Future: Resolved with the return value of the function
+        """
+        future = concurrent.futures.Future()
+        if not self.threaded or threading.current_thread() is self._qt_thread:
+            future.set_result(function(*args))
+        else:
+            self._calls.put((function, args, future))
+        return future
+
     def __del__(self):
         """Close the experiment on the potentiostat and release the Qt application. Remember to call get_data() before calling this function to retrieve the data."""
+        if not hasattr(self, "app"):
+            return
+        if self.threaded and not self._qt_thread.is_alive():
+            return
         try:
-            self.app.shutdown()
+            self._invoke(self.app.shutdown).result(timeout=10)
         except Exception:
             print("Error: Could not shutdown() the QApplication.")
         try:
-            self.app.quit()
+            self._invoke(self.app.quit).result(timeout=10)
         except Exception:
             print("Error: Could not quit() the QApplication.")
+        if self.threaded:
+            self._qt_thread.join(timeout=10)
         time.sleep(1)
 
-    def get_data(self):
-        """Return the AC and DC data as pandas dataframes. If no data is available, return None for the respective dataframe.
+    def stats(self, channel: int = None) -> dict:
+        """Instrumentation of the data path for the last experiment on a
+        channel: the samples received, the time spent in the data callbacks,
+        the gaps between the instrument timestamps and the time from starting
+        the experiment to its first sample. Use it to check that the callbacks
+        keep up with the sampling interval.
+
+        Args:
+            channel (int, optional): The channel. Defaults to self.channel.
 
         Returns:
-            [pd.DataFrame, pd.DataFrame]: A list containing the two AC data and the DC data pandas dataframes.
+            dict: "dc" and "ac" with the samples, the total callback time, the
+                callback duration percentiles in us, the timestamp gap
+                percentiles in s and the number of gaps longer than twice the
+                median; "time_to_first_sample [s]" and "steps" with the same
+                "dc" and "ac" counters per step.
         """
-        print("Returning data")
-        if self.ac_data_list.empty is True:
-            print("No AC data available \n")
+        state = self.channel_state(channel)
+        total = StepStats()
+        for stats in state.step_stats:
+            total.merge(stats)
+        summary = total.summary()
+        summary["time_to_first_sample [s]"] = (
+            math.nan if state.first_sample_delay is None else state.first_sample_delay
+        )
+        summary["steps"] = [stats.summary() for stats in state.step_stats]
+        # The sampling interval differs between steps, so long gaps are found
+        # per step
+        for kind in ("dc", "ac"):
+            summary[kind]["long_gaps"] = sum(
+                step[kind]["long_gaps"] for step in summary["steps"]
+            )
+        return summary
 
-            # Reset index to avoid issues with concatenation
-            self.dc_data_list.reset_index(drop=True, inplace=True)
+    def set_reducer(
+        self, reducer: Reducer = None, keep_raw: bool = False, channel: int = None
+    ):
+        """Reduce the DC samples while they are measured, eg. to one mean per
+        block of samples, see reducers.py. The reduced samples replace the raw
+        samples in the DC data, the split steps and the sinks. Monitors are
+        still fed every raw sample.
 
-            return None, self.dc_data_list
-        elif self.dc_data_list.empty is True:
-            print("No DC data available \n")
+        Example:
+            admiral.set_reducer(BlockAverage(size=10))
 
-            # Reset index to avoid issues with concatenation
-            self.ac_data_list.reset_index(drop=True, inplace=True)
+        Args:
+            reducer (Reducer, optional): The reducer. Defaults to None, which
+                keeps every raw sample again.
+            keep_raw (bool, optional): Keep the raw samples as well, see
+                get_raw_data(). Defaults to False.
+            channel (int, optional): The channel. Defaults to self.channel.
+        """
+        state = self.channel_state(channel)
+        if state.running:
+            raise ValueError(
+                f"Can't change the reducer while channel {state.channel} runs."
+            )
+        state.dc_reducer = reducer
+        if reducer is not None:
+            reducer.reset()
+        state.raw_dc_buffer = (
+            ColumnarBuffer(DC_COLUMNS) if reducer is not None and keep_raw else None
+        )
 
-            return self.ac_data_list, None
-        else:
-            print("")
+    def get_raw_data(self, channel: int = None) -> pd.DataFrame:
+        """Return the raw DC samples kept by set_reducer(keep_raw=True).
 
-            # Reset index to avoid issues with concatenation
-            self.ac_data_list.reset_index(drop=True, inplace=True)
-
-            # Reset index to avoid issues with concatenation
-            self.dc_data_list.reset_index(drop=True, inplace=True)
-
-            return self.ac_data_list, self.dc_data_list
-
-    def clear_data(self):
-        """Clear the AC and DC data dataframes."""
-        self.ac_data_list = pd.DataFrame(
-            columns=[
-                "Timestamp",
-                "Frequency [Hz]",
-                "Absolute Impedance",
-                "Phase Angle",
-                "Real Impedance",
-                "Imaginary Impedance",
-                "Total Harmonic Distortion",
-                "Number of Cycles",
-                "Working electrode DC Voltage [V]",
-                "DC Current [A]",
-                "Current Amplitude",
-                "Voltage Amplitude",
-            ]
-        )
-        self.dc_data_list = pd.DataFrame(
-            columns=[
-                "Timestamp",
-                "Working Electrode Voltage [V]",
-                "Working Electrode Current [A]",
-                "Temperature [C]",
-            ]
-        )
-        # self.new_element_list = pd.DataFrame(
-        #     columns=["Step Name", "Step Number", "Substep Number"]
-        # )
-        time.sleep(1)
+        Args:
+            channel (int, optional): The channel. Defaults to self.channel.
+
+        Returns:
+            pd.DataFrame: The raw DC data or None if no raw samples are kept
+        """
+        state = self.channel_state(channel)
+        if state.raw_dc_buffer is None:
+            return None
+        return state.raw_dc_buffer.to_dataframe()
 
     def handle_dc_data(self, channel, data):
         if data.timestamp is not None:
-            self.dc_data_list = pd.concat(
-                [
-                    self.dc_data_list,
-                    pd.DataFrame(
-                        {
-                            "Timestamp": [data.timestamp],
-                            "Working Electrode Voltage [V]": [
-                                data.workingElectrodeVoltage
-                            ],
-                            "Working Electrode Current [A]": [data.current],
-                            "Temperature [C]": [data.temperature],
-                        }
-                    ),
-                ]
-            )
+            start = time.perf_counter()
+            state = self.channel_state(channel)
+            if state.first_sample_delay is None:
+                self._first_sample(state, start)
+            if state.dc_reducer is None:
+                state.dc_buffer.append(
+                    data.timestamp,
+                    data.workingElectrodeVoltage,
+                    data.current,
+                    data.temperature,
+                )
+            else:
+                values = tuple(
+                    math.nan if value is None else value
+                    for value in (
+                        data.timestamp,
+                        data.workingElectrodeVoltage,
+                        data.current,
+                        data.temperature,
+                    )
+                )
+                if state.raw_dc_buffer is not None:
+                    state.raw_dc_buffer.append(*values)
+                state.dc_reducer.add(values, state.dc_buffer)
+            for monitor in state.active_monitors:
+                if monitor.update_dc(
+                    data.timestamp, data.workingElectrodeVoltage, data.current
+                ):
+                    self.end_element(monitor, channel)
+                    break
+            state.stats.dc.add(data.timestamp, time.perf_counter() - start)
 
     def handle_ac_data(self, channel, data):
         if data.timestamp is not None:
-            self.ac_data_list = pd.concat(
-                [
-                    self.ac_data_list,
-                    pd.DataFrame(
-                        {
-                            "Timestamp": [data.timestamp],
-                            "Frequency [Hz]": [data.frequency],
-                            "Absolute Impedance": [data.absoluteImpedance],
-                            "Phase Angle": [data.phaseAngle],
-                            "Real Impedance": [data.realImpedance],
-                            "Imaginary Impedance": [data.imagImpedance],
-                            "Total Harmonic Distortion": [data.totalHarmonicDistortion],
-                            "Number of Cycles": [data.numberOfCycles],
-                            "Working electrode DC Voltage [V]": [
-                                data.workingElectrodeDCVoltage
-                            ],
-                            "DC Current [A]": [data.DCCurrent],
-                            "Current Amplitude": [data.currentAmplitude],
-                            "Voltage Amplitude": [data.voltageAmplitude],
-                        }
-                    ),
-                ]
+            start = time.perf_counter()
+            state = self.channel_state(channel)
+            if state.first_sample_delay is None:
+                self._first_sample(state, start)
+            state.ac_buffer.append(
+                data.timestamp,
+                data.frequency,
+                data.absoluteImpedance,
+                data.phaseAngle,
+                data.realImpedance,
+                data.imagImpedance,
+                data.totalHarmonicDistortion,
+                data.numberOfCycles,
+                data.workingElectrodeDCVoltage,
+                data.DCCurrent,
+                data.currentAmplitude,
+                data.voltageAmplitude,
             )
+            for monitor in state.active_monitors:
+                if monitor.update_ac(
+                    data.timestamp,
+                    data.frequency,
+                    data.realImpedance,
+                    data.imagImpedance,
+                ):
+                    self.end_element(monitor, channel)
+                    break
+            state.stats.ac.add(data.timestamp, time.perf_counter() - start)
+
+    def _first_sample(self, state: ChannelState, now: float):
+        """Internal function, records the time from the start of the
+        experiment to its first sample."""
+        if state.start_time is not None:
+            state.first_sample_delay = now - state.start_time
 
     def handle_new_element(self, channel, data):
-        self.new_element_list = pd.concat(
+        state = self.channel_state(channel)
+        if state.dc_reducer is not None:
+            state.dc_reducer.finish(state.dc_buffer)
+        # Repeats of an element report the same step number
+        if data.stepNumber != state.last_step_number:
+            state.last_step_number = data.stepNumber
+            self._start_step(state, state.step_index + 1)
+        state.new_element_list = pd.concat(
             [
-                self.new_element_list,
+                state.new_element_list,
                 pd.DataFrame(
                     {
                         "Step Name": [data.stepName],
                         "Step Number": [data.stepNumber],
                         "Substep Number": [data.substepNumber],
+                        "DC Index": [len(state.dc_buffer)],
+                        "AC Index": [len(state.ac_buffer)],
                     }
                 ),
             ]
         )
 
+    def _start_step(self, state: ChannelState, index: int):
+        """Internal function, activates the monitors of the step that starts."""
+        state.step_index = index
+        state.active_monitors = []
+        if index < len(state.step_monitors):
+            state.active_monitors = list(state.step_monitors[index])
+        for monitor in state.active_monitors:
+            monitor.reset()
+        while len(state.step_stats) <= index:
+            state.step_stats.append(StepStats())
+        state.stats = state.step_stats[index]
+
+    def end_element(self, monitor, channel: int = None):
+        """End the running element early, because a monitor asked for it. The
+        experiment continues with the next element, if there is one.
+
+        Args:
+            monitor (ElementMonitor): The monitor that ended the element
+            channel (int, optional): The channel. Defaults to self.channel.
+        """
+        state = self.channel_state(channel)
+        print(
+            f"Ending step {state.step_index} on channel {state.channel} early: "
+            f"{monitor.name}"
+        )
+        state.active_monitors = []
+        if state.step_index < len(state.step_summaries):
+            state.step_summaries[state.step_index]["termination"] = monitor.name
+        is_last_step = state.step_index >= len(state.step_monitors) - 1
+        if hasattr(self.handler, "skipExperimentStep") and not is_last_step:
+            error = self.handler.skipExperimentStep(state.channel)
+        elif is_last_step:
+            error = self.handler.stopExperiment(state.channel)
+        else:
+            print("Warning: The instrument cannot skip steps. Step is not ended.")
+            return
+        if error != 0:
+            print(error.message())
+
+    def _prepare_monitors(self, state: ChannelState, step_monitors: list):
+        """Internal function, to be run before an experiment is started with
+        one list of monitors per step of the experiment. The monitors are
+        copied, so the same protocol can run on several channels at once."""
+        state.step_monitors = [copy.deepcopy(monitors) for monitors in step_monitors]
+        state.active_monitors = []
+        state.step_index = -1
+        state.last_step_number = None
+        state.step_summaries = [{"termination": "completed"} for _ in step_monitors]
+        state.step_stats = [StepStats() for _ in step_monitors]
+        state.stats = state.step_stats[0]
+
+    def _collect_summaries(self, state: ChannelState) -> list:
+        """Internal function, adds the results of the monitors of each step to
+        step_summaries after the experiment has ended."""
+        for summary, monitors in zip(state.step_summaries, state.step_monitors):
+            for monitor in monitors:
+                summary.update(monitor.summary())
+        return state.step_summaries
+
     def on_device_connected(self, device_name):
         print(
             f"Device is connected as: {device_name} \nPlease use this name when loading the AdmiralWrapper."
@@ -213,7 +745,27 @@ class AdmiralSquidstatWrapper:
 
     def handle_experiment_stopped(self, channel):
         print("Experiment completed on channel: %d" % channel)
-        self.app.quit()
+        state = self.channel_state(channel)
+        state.running = False
+        if state.dc_reducer is not None:
+            state.dc_reducer.finish(state.dc_buffer)
+        state.dc_buffer.flush()
+        state.ac_buffer.flush()
+        if not self.threaded:
+            # Leave the event loop once the experiments on all channels stopped
+            if not any(other.running for other in self._channels.values()):
+                self.app.quit()
+            return
+        future = state.experiment_future
+        if future is None or future.done():
+            return
+        try:
+            self._collect_summaries(state)
+            result = state.on_stopped() if state.on_stopped is not None else None
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
 
     def connect_to_device(self, port, instrument_name="Plus1894"):
         self.tracker.newDeviceConnected.connect(self.on_device_connected)
@@ -226,26 +778,363 @@ class AdmiralSquidstatWrapper:
         self.handler.experimentNewElementStarting.connect(self.handle_new_element)
         self.handler.experimentStopped.connect(self.handle_experiment_stopped)
 
-    def upload_experiment(self, experiment):
+    def upload_experiment(self, experiment, channel: int = None):
         """Internal function, to be run after the element (measurement) has been appended to the experiment"""
-        print("Uploading experiment")
-        error = self.handler.uploadExperimentToChannel(self.channel, experiment)
+        channel = self.channel if channel is None else channel
+        print(f"Uploading experiment to channel {channel}")
+        error = self.handler.uploadExperimentToChannel(channel, experiment)
         if error != 0:
             print(error.message())
 
-    def start_experiment(self):
+    def start_experiment(self, channel: int = None):
         """Internal function, to be run after upload_experiment"""
-        print("Setting potentiostat in start experiment modus")
-        error = self.handler.startUploadedExperiment(self.channel)
+        channel = self.channel if channel is None else channel
+        print(f"Setting potentiostat in start experiment modus on channel {channel}")
+        state = self.channel_state(channel)
+        state.first_sample_delay = None
+        state.start_time = time.perf_counter()
+        error = self.handler.startUploadedExperiment(channel)
         if error != 0:
             print(error.message())
 
+    def stop_experiment(self, channel: int = None):
+        """Stop the experiment running on a channel.
+
+        Args:
+            channel (int, optional): The channel. Defaults to self.channel.
+        """
+        channel = self.channel if channel is None else channel
+        error = self._invoke(self.handler.stopExperiment, channel).result()
+        if error != 0:
+            print(error.message())
+
+    def _submit(self, element, repeats: int = 1, monitors: list = None):
+        """Internal function, to be run by the setup_*() functions with the
+        element they have created. The element is either uploaded and started
+        as an experiment of its own or, while a protocol is being built,
+        appended to the protocol. The monitors are fed the samples of the
+        element, see monitors.py. Returns the future of _start() in threaded
+        mode."""
+        monitors = list(monitors) if monitors is not None else []
+        if self._protocol is not None:
+            self._protocol.append(element, repeats, monitors)
+            return None
+        experiment = self.backend.AisExperiment()
+        experiment.appendElement(element, repeats)
+        return self._start(self.channel_state(), experiment, [monitors])
+
+    def _start(
+        self, state: ChannelState, experiment, step_monitors: list, on_stopped=None
+    ):
+        """Internal function, uploads and starts an experiment on a channel
+        with one list of monitors per element. In threaded mode the upload
+        runs on the Qt thread and a future is returned, which is resolved with
+        the return value of on_stopped() once the experiment has stopped."""
+        if state.running:
+            raise ValueError(
+                f"An experiment is already running on channel {state.channel}."
+            )
+
+        def start():
+            self._prepare_monitors(state, step_monitors)
+            state.on_stopped = on_stopped
+            state.running = True
+            self.upload_experiment(experiment, state.channel)
+            self.start_experiment(state.channel)
+
+        if not self.threaded:
+            start()
+            return None
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        state.experiment_future = future
+        try:
+            self._invoke(start).result()
+        except Exception as e:
+            state.running = False
+            future.set_exception(e)
+        return future
+
+    def new_protocol(self):
+        """Start a protocol of several elements that are uploaded and run as
+        one experiment. See ProtocolBuilder.
+
+        Returns:
+            ProtocolBuilder: An empty protocol.
+        """
+        return ProtocolBuilder(self)
+
+    def run_protocol(self, protocol, channel: int = None) -> list:
+        """Upload a protocol once, run it and split the collected data per
+        element, using the experimentNewElementStarting events.
+
+        Args:
+            protocol (ProtocolBuilder): The protocol to run
+            channel (int, optional): The channel. Defaults to self.channel.
+
+        Returns:
+            list: One dictionary per step of the protocol with the keys
+                "label", "technique", "ac_data", "dc_data", "dc_range",
+                "ac_range", "summary" and "stats". The data is None if the step did not
+                produce any data of that kind. The ranges are the [start, stop]
+                samples of the step for get_arrays(), or None like the data.
+                The stats are the counters of the step, see stats(). The summary holds how the step terminated ("completed"
+                or the name of the monitor that ended it) and the results of
+                the monitors of the step.
+        """
+        if self.threaded:
+            return self.submit_protocol(protocol, channel).result()
+        return self.run_protocols({channel: protocol})[channel]
+
+    def run_protocols(self, protocols: dict) -> dict:
+        """Run protocols on several channels at the same time and wait for all
+        of them to finish.
+
+        Args:
+            protocols (dict): The protocol (ProtocolBuilder) to run on each
+                channel, eg. {0: protocol_a, 1: protocol_b}. The channel None
+                is self.channel.
+
+        Returns:
+            dict: The results of run_protocol() for each channel
+        """
+        if self.threaded:
+            futures = {
+                channel: self.submit_protocol(protocol, channel)
+                for channel, protocol in protocols.items()
+            }
+            return {channel: future.result() for channel, future in futures.items()}
+        first_events = self._run_blocking(protocols)
+        return {
+            channel: self._protocol_results(
+                self.channel_state(channel), protocol, first_events[channel]
+            )
+            for channel, protocol in protocols.items()
+        }
+
+    def _run_blocking(self, protocols: dict) -> dict:
+        """Internal function, runs a protocol on each channel in the calling
+        thread and returns the index of the first event of each run in the
+        new_element_list of its channel."""
+        first_events = {}
+        for channel, protocol in protocols.items():
+            state = self.channel_state(channel)
+            first_events[channel] = self._prepare_run(state, protocol)
+            self._start(
+                state,
+                protocol.experiment,
+                [step["monitors"] for step in protocol.steps],
+            )
+        self.run_experiment()
+        return first_events
+
+    def _prepare_run(self, state: ChannelState, protocol) -> int:
+        """Internal function, clears the buffers of a channel before a
+        protocol runs on it and returns the index of its first event."""
+        if state.running:
+            raise ValueError(
+                f"An experiment is already running on channel {state.channel}."
+            )
+        state.ac_buffer.clear()
+        state.dc_buffer.clear()
+        if state.raw_dc_buffer is not None:
+            state.raw_dc_buffer.clear()
+        print(
+            f"\n*** Running protocol with {len(protocol.steps)} steps on channel "
+            f"{state.channel}"
+        )
+        return len(state.new_element_list)
+
+    def _protocol_results(
+        self, state: ChannelState, protocol, first_event: int
+    ) -> list:
+        """Internal function, splits the data of a finished protocol run."""
+        results = self.split_data(
+            protocol, state.new_element_list.iloc[first_event:], state.channel
+        )
+        for result, summary, stats in zip(
+            results, state.step_summaries, state.step_stats
+        ):
+            result["summary"] = summary
+            result["stats"] = stats.summary()
+        return results
+
+    def submit_protocol(
+        self, protocol, channel: int = None
+    ) -> concurrent.futures.Future:
+        """Upload and start a protocol without waiting for it to finish. Only
+        available in threaded mode. Data of the running protocol can be
+        followed with iter_samples(). Protocols can run on several channels
+        at the same time.
+
+        Args:
+            protocol (ProtocolBuilder): The protocol to run
+            channel (int, optional): The channel. Defaults to self.channel.
+
+        Returns:
+            concurrent.futures.Future: Resolved with the results of
+                run_protocol() once the protocol has finished
+        """
+        if not self.threaded:
+            raise ValueError(
+                "submit_protocol() needs an AdmiralSquidstatWrapper with threaded=True."
+            )
+        state = self.channel_state(channel)
+        first_event = self._prepare_run(state, protocol)
+        return self._start(
+            state,
+            protocol.experiment,
+            [step["monitors"] for step in protocol.steps],
+            on_stopped=lambda: self._protocol_results(state, protocol, first_event),
+        )
+
+    def submit_plan(
+        self, plan, sample_surface_area: float, channel: int = None
+    ) -> concurrent.futures.Future:
+        """Start a protocol plan without waiting for it to finish, see
+        submit_protocol() and run_plan()."""
+        return self.submit_protocol(plan.build(self, sample_surface_area), channel)
+
+    async def run_protocol_async(self, protocol, channel: int = None) -> list:
+        """Run a protocol from an asyncio event loop, see submit_protocol().
+
+        Returns:
+            list: See run_protocol()
+        """
+        return await asyncio.wrap_future(self.submit_protocol(protocol, channel))
+
+    def run_plan(self, plan, sample_surface_area: float, channel: int = None) -> list:
+        """Run a protocol plan loaded with protocol.load_protocol().
+
+        Args:
+            plan (ProtocolPlan): The plan to run
+            sample_surface_area (float): Sample surface area in cm^2, used for
+                the parameters the plan gives per area.
+            channel (int, optional): The channel. Defaults to self.channel.
+
+        Returns:
+            list: See run_protocol()
+        """
+        return self.run_protocol(plan.build(self, sample_surface_area), channel)
+
+    def split_data(self, protocol, events: pd.DataFrame, channel: int = None) -> list:
+        """Split the AC and DC data of a protocol run per step.
+
+        Args:
+            protocol (ProtocolBuilder): The protocol that was run
+            events (pd.DataFrame): The rows of new_element_list recorded
+                during the run
+            channel (int, optional): The channel. Defaults to self.channel.
+
+        Returns:
+            list: See run_protocol()
+        """
+        state = self.channel_state(channel)
+        results = []
+        for step, dc_range, ac_range in zip(
+            protocol.steps, *self.step_ranges(protocol, events, channel)
+        ):
+            dc_start, dc_stop = dc_range or (None, None)
+            ac_start, ac_stop = ac_range or (None, None)
+            result = {
+                "label": step["label"],
+                "technique": step["technique"],
+                "ac_data": None,
+                "dc_data": None,
+                "dc_range": None,
+                "ac_range": None,
+            }
+            if dc_start is not None and dc_stop > dc_start:
+                result["dc_data"] = state.dc_buffer.to_dataframe(dc_start, dc_stop)
+                result["dc_range"] = [dc_start, dc_stop]
+            if ac_start is not None and ac_stop > ac_start:
+                result["ac_data"] = state.ac_buffer.to_dataframe(ac_start, ac_stop)
+                result["ac_range"] = [ac_start, ac_stop]
+            results.append(result)
+        return results
+
+    def step_ranges(self, protocol, events: pd.DataFrame, channel: int = None) -> tuple:
+        """Find the samples of each step of a protocol run in the buffers.
+
+        Args:
+            protocol (ProtocolBuilder): The protocol that was run
+            events (pd.DataFrame): The rows of new_element_list recorded
+                during the run
+            channel (int, optional): The channel. Defaults to self.channel.
+
+        Returns:
+            tuple: The DC and the AC ranges, each a list with one [start, stop]
+                pair of sample indices per step. Both are None for a step that
+                did not start.
+        """
+        if events.empty:
+            # No element started, eg. the run failed before the first step
+            return [None] * len(protocol.steps), [None] * len(protocol.steps)
+
+        # A new segment starts every time the step number changes
+        step_numbers = events["Step Number"].to_numpy()
+        is_new = [True] + list(step_numbers[1:] != step_numbers[:-1])
+        segments = events[is_new]
+        dc_starts = [0] + list(segments["DC Index"].astype(int))[1:]
+        ac_starts = [0] + list(segments["AC Index"].astype(int))[1:]
+        state = self.channel_state(channel)
+        dc_stops = dc_starts[1:] + [len(state.dc_buffer)]
+        ac_stops = ac_starts[1:] + [len(state.ac_buffer)]
+        number_of_segments = len(dc_starts)
+
+        # Depending on the instrument firmware a repeated element either
+        # reports one or one step number per repeat
+        if number_of_segments == len(protocol.steps):
+            owners = list(range(len(protocol.steps)))
+        elif number_of_segments == sum(
+            max(step["repeats"], 1) for step in protocol.steps
+        ):
+            owners = [
+                i
+                for i, step in enumerate(protocol.steps)
+                for _ in range(max(step["repeats"], 1))
+            ]
+        else:
+            print(
+                f"Warning: {len(segments)} elements started, but the protocol has "
+                f"{len(protocol.steps)} steps. Data is assigned in order."
+            )
+            owners = [
+                min(i, len(protocol.steps) - 1) for i in range(number_of_segments)
+            ]
+
+        dc_ranges = [[None, None] for _ in protocol.steps]
+        ac_ranges = [[None, None] for _ in protocol.steps]
+        for owner, dc_start, dc_stop, ac_start, ac_stop in zip(
+            owners, dc_starts, dc_stops, ac_starts, ac_stops
+        ):
+            if dc_ranges[owner][0] is None:
+                dc_ranges[owner][0] = dc_start
+                ac_ranges[owner][0] = ac_start
+            dc_ranges[owner][1] = dc_stop
+            ac_ranges[owner][1] = ac_stop
+        dc_ranges = [
+            None if start is None else [start, stop] for start, stop in dc_ranges
+        ]
+        ac_ranges = [
+            None if start is None else [start, stop] for start, stop in ac_ranges
+        ]
+        return dc_ranges, ac_ranges
+
     def run_experiment(self):
         """Run an experiment on the potentiostat. Remember to define the experiment first,
         for instance using setup_potentiostaticEIS() or setup_CV().
 
         """
-        self.app.exec_()
+        states = [state for state in self._channels.values() if state.running]
+        if self.threaded:
+            for state in states:
+                state.experiment_future.result()
+            return
+        if states:
+            self.app.exec_()
+        for state in states:
+            self._collect_summaries(state)
 
     def close_experiment(self):
         """Close the experiment on the potentiostat and release the Qt application.
@@ -262,8 +1151,13 @@ class AdmiralSquidstatWrapper:
         voltage_bias: float = 0.0,
         voltage_amplitude: float = 0.1,
         number_of_runs: int = 1,
+        ohmic_only: bool = False,
+        ohmic_points: int = 10,
     ):
-        """Perform an potentiostatic EIS experiment on the potentiostat
+        """Perform an potentiostatic EIS experiment on the potentiostat. The
+        ohmic resistance is estimated while the sweep runs, see
+        monitors.OhmicInterceptEstimator, and is reported in the summary of
+        the step by run_protocol().
 
         Args:
             start_frequency (float): The start frequency of the EIS experiment
@@ -271,20 +1165,29 @@ class AdmiralSquidstatWrapper:
             points_per_decade (int): The number of points per decade
             voltage_bias (float): The bias voltage of the EIS experiment
             voltage_amplitude (float): The amplitude of the voltage signal
+            ohmic_only (bool): End the sweep as soon as the ohmic resistance
+                is found, skipping the lower frequencies
+            ohmic_points (int): Number of frequencies from the start of the
+                sweep to look for the ohmic resistance in
+
+        Returns:
+            concurrent.futures.Future: In threaded mode, resolved once the
+                experiment has stopped. None otherwise or while a protocol is
+                being built.
         """
 
         print("\n*** Preparing EIS experiment")
-        experiment = AisExperiment()
-        element = AisEISPotentiostaticElement(
+        element = self.backend.AisEISPotentiostaticElement(
             start_frequency,
             end_frequency,
             points_per_decade,
             voltage_bias,
             voltage_amplitude,
         )
-        experiment.appendElement(element, number_of_runs)
-        self.upload_experiment(experiment)
-        self.start_experiment()
+        estimator = OhmicInterceptEstimator(
+            max_points=ohmic_points, truncate=ohmic_only
+        )
+        return self._submit(element, number_of_runs, monitors=[estimator])
 
     def setup_cyclic_voltammetry(
         self,
@@ -311,11 +1214,15 @@ class AdmiralSquidstatWrapper:
                 experiment in V/s
             samplingInterval (float): The sampling interval in seconds
             cycles (int): The number of cycles to perform
+
+        Returns:
+            concurrent.futures.Future: In threaded mode, resolved once the
+                experiment has stopped. None otherwise or while a protocol is
+                being built.
         """
 
         print("\n*** Preparing CV experiment")
-        experiment = AisExperiment()
-        element = AisCyclicVoltammetryElement(
+        element = self.backend.AisCyclicVoltammetryElement(
             startVoltage,
             firstVoltageLimit,
             secondVoltageLimit,
@@ -323,9 +1230,7 @@ class AdmiralSquidstatWrapper:
             scanRate,
             samplingInterval,
         )
-        experiment.appendElement(element, cycles)
-        self.upload_experiment(experiment)
-        self.start_experiment()
+        return self._submit(element, cycles)
 
     def setup_constant_current(
         self,
@@ -339,14 +1244,18 @@ class AdmiralSquidstatWrapper:
             holdAtCurrent (float): The current to hold at in A
             samplingInterval (float): The sampling interval in seconds
             duration (float): The duration of the experiment in seconds
+
+        Returns:
+            concurrent.futures.Future: In threaded mode, resolved once the
+                experiment has stopped. None otherwise or while a protocol is
+                being built.
         """
 
         print("\n*** Preparing CP experiment")
-        experiment = AisExperiment()
-        element = AisConstantCurrentElement(holdAtCurrent, samplingInterval, duration)
-        experiment.appendElement(element)
-        self.upload_experiment(experiment)
-        self.start_experiment()
+        element = self.backend.AisConstantCurrentElement(
+            holdAtCurrent, samplingInterval, duration
+        )
+        return self._submit(element)
 
     def setup_constant_potential(
         self,
@@ -360,14 +1269,18 @@ class AdmiralSquidstatWrapper:
             holdAtVoltage (float): The voltage to hold at in V
             samplingInterval (float): The sampling interval in seconds
             duration (float): The duration of the experiment in seconds
+
+        Returns:
+            concurrent.futures.Future: In threaded mode, resolved once the
+                experiment has stopped. None otherwise or while a protocol is
+                being built.
         """
 
         print("\n*** Preparing CP experiment")
-        experiment = AisExperiment()
-        element = AisConstantPotElement(holdAtVoltage, samplingInterval, duration)
-        experiment.appendElement(element)
-        self.upload_experiment(experiment)
-        self.start_experiment()
+        element = self.backend.AisConstantPotElement(
+            holdAtVoltage, samplingInterval, duration
+        )
+        return self._submit(element)
 
     def setup_constant_power(
         self,
@@ -383,16 +1296,18 @@ class AdmiralSquidstatWrapper:
             powerVal (float): The power value in W
             duration (float): The duration of the experiment in seconds
             samplingInterval (float): The sampling interval in seconds
+
+        Returns:
+            concurrent.futures.Future: In threaded mode, resolved once the
+                experiment has stopped. None otherwise or while a protocol is
+                being built.
         """
 
         print("\n*** Preparing CP experiment")
-        experiment = AisExperiment()
-        element = AisConstantPowerElement(
+        element = self.backend.AisConstantPowerElement(
             isCharge, powerVal, duration, samplingInterval
         )
-        experiment.appendElement(element)
-        self.upload_experiment(experiment)
-        self.start_experiment()
+        return self._submit(element)
 
     def setup_constant_resistance(
         self,
@@ -406,16 +1321,18 @@ class AdmiralSquidstatWrapper:
             resistanceVal (float): The resistance value in Ohm
             duration (float): The duration of the experiment in seconds
             samplingInterval (float): The sampling interval in seconds
+
+        Returns:
+            concurrent.futures.Future: In threaded mode, resolved once the
+                experiment has stopped. None otherwise or while a protocol is
+                being built.
         """
 
         print("\n*** Preparing CP experiment")
-        experiment = AisExperiment()
-        element = AisConstantResistanceElement(
+        element = self.backend.AisConstantResistanceElement(
             resistanceVal, duration, samplingInterval
         )
-        experiment.appendElement(element)
-        self.upload_experiment(experiment)
-        self.start_experiment()
+        return self._submit(element)
 
     def setup_DC_current_sweep(
         self,
@@ -431,16 +1348,18 @@ class AdmiralSquidstatWrapper:
             endCurrent (float): The end current in A
             scanRate (float): The scan rate in A/s
             samplingInterval (float): The sampling interval in seconds
+
+        Returns:
+            concurrent.futures.Future: In threaded mode, resolved once the
+                experiment has stopped. None otherwise or while a protocol is
+                being built.
         """
 
         print("\n*** Preparing DC current sweep experiment")
-        experiment = AisExperiment()
-        element = AisDCCurrentSweepElement(
+        element = self.backend.AisDCCurrentSweepElement(
             startCurrent, endCurrent, scanRate, samplingInterval
         )
-        experiment.appendElement(element)
-        self.upload_experiment(experiment)
-        self.start_experiment()
+        return self._submit(element)
 
     def setup_DC_potential_sweep(
         self,
@@ -456,16 +1375,18 @@ class AdmiralSquidstatWrapper:
             endPotential (float): The end potential in V
             scanRate (float): The scan rate in V/s
             samplingInterval (float): The sampling interval in seconds
+
+        Returns:
+            concurrent.futures.Future: In threaded mode, resolved once the
+                experiment has stopped. None otherwise or while a protocol is
+                being built.
         """
 
         print("\n*** Preparing DC potential sweep experiment")
-        experiment = AisExperiment()
-        element = AisDCPotentialSweepElement(
+        element = self.backend.AisDCPotentialSweepElement(
             startPotential, endPotential, scanRate, samplingInterval
         )
-        experiment.appendElement(element)
-        self.upload_experiment(experiment)
-        self.start_experiment()
+        return self._submit(element)
 
     def setup_diff_pulse_voltammetry(
         self,
@@ -485,11 +1406,15 @@ class AdmiralSquidstatWrapper:
             pulseHeight (float): The pulse height in V
             pulseWidth (float): The pulse width in s
             pulsePeriod (float): The pulse period in s
+
+        Returns:
+            concurrent.futures.Future: In threaded mode, resolved once the
+                experiment has stopped. None otherwise or while a protocol is
+                being built.
         """
 
         print("\n*** Preparing DPV experiment")
-        experiment = AisExperiment()
-        element = AisDiffPulseVoltammetryElement(
+        element = self.backend.AisDiffPulseVoltammetryElement(
             startPotential,
             endPotential,
             potentialStep,
@@ -497,9 +1422,7 @@ class AdmiralSquidstatWrapper:
             pulseWidth,
             pulsePeriod,
         )
-        experiment.appendElement(element)
-        self.upload_experiment(experiment)
-        self.start_experiment()
+        return self._submit(element)
 
     def setup_normal_pulse_voltammetry(
         self,
@@ -517,20 +1440,22 @@ class AdmiralSquidstatWrapper:
             potentialStep (float): The potential step in V
             pulseWidth (float): The pulse width in s
             pulsePeriod (float): The pulse period in s
+
+        Returns:
+            concurrent.futures.Future: In threaded mode, resolved once the
+                experiment has stopped. None otherwise or while a protocol is
+                being built.
         """
 
         print("\n*** Preparing NPV experiment")
-        experiment = AisExperiment()
-        element = AisNormalPulseVoltammetryElement(
+        element = self.backend.AisNormalPulseVoltammetryElement(
             startPotential,
             endPotential,
             potentialStep,
             pulseWidth,
             pulsePeriod,
         )
-        experiment.appendElement(element)
-        self.upload_experiment(experiment)
-        self.start_experiment()
+        return self._submit(element)
 
     def setup_square_wave(
         self,
@@ -552,11 +1477,15 @@ class AdmiralSquidstatWrapper:
             scanRate (float): The scan rate in V/s
             samplingInterval (float): The sampling interval in s
             cycles (int): The number of cycles to perform
+
+        Returns:
+            concurrent.futures.Future: In threaded mode, resolved once the
+                experiment has stopped. None otherwise or while a protocol is
+                being built.
         """
 
         print("\n*** Preparing SWV experiment")
-        experiment = AisExperiment()
-        element = AisSquareWaveVoltammetryElement(
+        element = self.backend.AisSquareWaveVoltammetryElement(
             startPotential,
             firstVoltageLimit,
             secondVoltageLimit,
@@ -564,9 +1493,7 @@ class AdmiralSquidstatWrapper:
             scanRate,
             samplingInterval,
         )
-        experiment.appendElement(element, cycles)
-        self.upload_experiment(experiment)
-        self.start_experiment()
+        return self._submit(element, cycles)
 
     def setup_EIS_Galvanostatic(
         self,
@@ -585,31 +1512,99 @@ class AdmiralSquidstatWrapper:
             points_per_decade (int): The number of points per decade
             current_bias (float): The bias current of the EIS experiment
             current_amplitude (float): The amplitude of the current signal
+
+        Returns:
+            concurrent.futures.Future: In threaded mode, resolved once the
+                experiment has stopped. None otherwise or while a protocol is
+                being built.
         """
 
         print("\n*** Preparing EIS experiment")
-        experiment = AisExperiment()
-        element = AisEISGalvanostaticElement(
+        element = self.backend.AisEISGalvanostaticElement(
             start_frequency,
             end_frequency,
             points_per_decade,
             current_bias,
             current_amplitude,
         )
-        experiment.appendElement(element, number_of_runs)
-        self.upload_experiment(experiment)
-        self.start_experiment()
+        return self._submit(element, number_of_runs)
 
     def setup_OCP(self, duration: float = 10, samplingInterval: float = 0.01):
         """Perform an open circuit potential experiment on the potentiostat
 
         Args:
             duration (float): The duration of the experiment in seconds
-            samplingInterval (float): The sampling interval in seconds"""
+            samplingInterval (float): The sampling interval in seconds
+
+        Returns:
+            concurrent.futures.Future: In threaded mode, resolved once the
+                experiment has stopped. None otherwise or while a protocol is
+                being built.
+        """
 
         print("\n*** Preparing OCP experiment")
-        experiment = AisExperiment()
-        element = AisOpenCircuitElement(duration, samplingInterval)
-        experiment.appendElement(element)
-        self.upload_experiment(experiment)
-        self.start_experiment()
+        element = self.backend.AisOpenCircuitElement(duration, samplingInterval)
+        return self._submit(element)
+
+
+class ProtocolBuilder:
+    def __init__(self, wrapper: AdmiralSquidstatWrapper):
+        """A protocol of several elements (measurements) that are appended to
+        one AisExperiment, so the potentiostat only needs a single upload and
+        a single run of the Qt event loop for the whole protocol.
+
+        Example:
+            protocol = admiral.new_protocol()
+            protocol.add("constant_current", "0 CP", holdAtCurrent=0.05)
+            protocol.add("OCP", "1 OCP", duration=60)
+            results = admiral.run_protocol(protocol)
+
+        Args:
+            wrapper (AdmiralSquidstatWrapper): The potentiostat that creates the
+                elements and runs the protocol
+        """
+        self.wrapper = wrapper
+        self.experiment = wrapper.backend.AisExperiment()
+        self.steps = []
+
+    def add(
+        self, technique: str, label: str = None, monitors: list = None, **params
+    ) -> int:
+        """Append an element to the protocol.
+
+        Args:
+            technique (str): Name of the technique as in the setup_*()
+                functions of AdmiralSquidstatWrapper, eg. "constant_current"
+                for setup_constant_current().
+            label (str, optional): Name of the step. Defaults to technique.
+            monitors (list, optional): Monitors fed the samples of the step,
+                eg. a monitors.SteadyStateDetector. Defaults to None.
+            **params: Parameters passed to the setup_*() function.
+
+        Returns:
+            int: Index of the step in the protocol
+        """
+        setup = getattr(self.wrapper, "setup_" + technique, None)
+        if setup is None:
+            raise ValueError(f"Unknown technique: {technique}")
+        self.wrapper._protocol = self
+        try:
+            setup(**params)
+        finally:
+            self.wrapper._protocol = None
+        self.steps[-1]["technique"] = technique
+        self.steps[-1]["label"] = label if label is not None else technique
+        self.steps[-1]["monitors"].extend(monitors or [])
+        return len(self.steps) - 1
+
+    def append(self, element, repeats: int = 1, monitors: list = None):
+        """Internal function, called by AdmiralSquidstatWrapper._submit()"""
+        self.experiment.appendElement(element, repeats)
+        self.steps.append(
+            {
+                "label": None,
+                "technique": None,
+                "repeats": repeats,
+                "monitors": list(monitors or []),
+            }
+        )
@@ -1,10 +1,65 @@
+import atexit
+import collections
+import concurrent.futures
+import itertools
 import logging
+import os
+import struct
+import threading
 import time
 import serial
 import serial.tools.list_ports
+from openTron_electrodeposition import calibration, framing
 
 LOGGER = logging.getLogger(__name__)
 
+# Lines the firmware prints that are not responses to a command
+NOISE_PREFIXES = ("Unknown command", "Check connections", "Temperature sensor")
+# Limits of a relay program in the firmware, PROGRAM_STEPS and buff_size
+MAX_PROGRAM_STEPS = 12
+MAX_COMMAND_LENGTH = 158
+# Columns of the telemetry frames "T,..." the firmware sends every second once
+# telemetry is on. Time [s] is the time.time() the frame was received.
+TELEMETRY_COLUMNS = (
+    "Time [s]",
+    "Arduino time [s]",
+    "Temperature 0 [C]",
+    "Temperature 1 [C]",
+    "Ambient temperature 0 [C]",
+    "Ambient temperature 1 [C]",
+    "Setpoint 0 [C]",
+    "Setpoint 1 [C]",
+    "Duty cycle 0",
+    "Duty cycle 1",
+)
+# The telemetry column of the temperature read by a command
+TELEMETRY_COMMANDS = {
+    "read_temp0": "Temperature 0 [C]",
+    "read_temp1": "Temperature 1 [C]",
+    "read_temp0_ambient": "Ambient temperature 0 [C]",
+    "read_temp1_ambient": "Ambient temperature 1 [C]",
+}
+# Line the firmware sends at the end of setup()
+READY_BANNER = "Ready"
+# Seconds for the bootloader and setup() after opening the port resets the
+# board, and for the answer to a ping of a running firmware
+BOOT_TIMEOUT = 5
+PING_TIMEOUT = 0.5
+
+# USB identity (VID, PID, serial number) of the Arduino found for a search
+# string, which stays the same when the port name changes
+_port_identities = {}
+# Connections shared by the whole process by port, see Arduino.shared()
+_connections = {}
+_connections_lock = threading.RLock()
+
+
+@atexit.register
+def _close_connections() -> None:
+    with _connections_lock:
+        for arduino in list(_connections.values()):
+            arduino.disconnect()
+
 
 class Arduino:
     """Class for the arduino robot relate activities for the openTron setup."""
@@ -17,6 +72,11 @@ class Arduino:
         list_of_ultrasonic_relays: list = [6, 7],
         pump_slope: dict = {0: 1.0, 1: 1.0, 2: 1.0, 3: 1.0, 4: 1.0, 5: 1.0},
         pump_intercept: dict = {0: 0.0, 1: 0.0, 2: 0.0, 3: 0.0, 4: 0.0, 5: 0.0},
+        telemetry: bool = False,
+        telemetry_size: int = 14400,
+        protocol: str = "text",
+        port: str = None,
+        calibration_file: str = None,
     ):
         """Initialize the arduino robotic parts. The robot consist of
         cartridges that are inserted into the openTron robot. Each cartridge
@@ -32,10 +92,10 @@ class Arduino:
         while cartridge 1 is connected to ultrasonic relay 7.
 
         The pump calibration is done by a linear calibration, by the following
-        equation: volume = pump_slope * relay_time_on + pump_intercept
+        equation: relay_time_on = pump_slope * volume + pump_intercept
         It can be measured by running the pump while measuring the weight
         dispensed, at eg. 0.5 seconds, 1 seconds, 2 seconds, 5 seconds,
-        10 seconds, 20 seconds.
+        10 seconds, 20 seconds, see calibration.py.
 
         Args:
             arduino_search_string (str, optional): _description_. Defaults to
@@ -53,10 +113,139 @@ class Arduino:
             pump_intercept (dict, optional): Dictionary with pump number as
                 key and intercept as value.
                 Defaults to {0: 0.0, 1: 0.0, 2: 0.0, 3: 0.0, 4: 0.0, 5: 0.0}.
+            telemetry (bool, optional): Let the firmware send the temperatures
+                every second. Temperature reads then return the latest values
+                without asking the Arduino, see temperature_trace() for the
+                history. Defaults to False.
+            telemetry_size (int, optional): Number of telemetry frames kept,
+                4 hours at one frame per second. Defaults to 14400.
+            protocol (str, optional): "binary" for frames with sequence
+                numbers and CRC, see framing.py, or "text" for "<command>"
+                lines. Both need the firmware of src/arduino/main, which
+                reports the end of the timed relay pulses. Defaults to "text".
+            port (str, optional): Serial port of the Arduino, eg. the port of
+                an emulator.ArduinoEmulator. Defaults to None, which searches
+                for arduino_search_string.
+            calibration_file (str, optional): Calibration file of
+                calibration.save_calibration(), its pump coefficients replace
+                pump_slope and pump_intercept. Defaults to None.
         """
-        self.SERIAL_PORT = self.define_arduino_port(arduino_search_string)
+        if port is None:
+            port = self.define_arduino_port(arduino_search_string)
+        self.SERIAL_PORT = port
         self.BAUD_RATE = 115200
         self.CONNECTION_TIMEOUT = 30  # seconds
+        self.configure(
+            list_of_cartridges,
+            list_of_pump_relays,
+            list_of_ultrasonic_relays,
+            pump_slope,
+            pump_intercept,
+            calibration_file,
+        )
+        if protocol not in ("text", "binary"):
+            raise ValueError(f"Unknown protocol {protocol}, use text or binary.")
+        self.protocol = protocol
+        self.telemetry = telemetry
+        self._telemetry = collections.deque(maxlen=telemetry_size)
+        self.setpoints = {}  # The last setpoint sent to each cartridge
+        self.connect()
+
+    @classmethod
+    def shared(
+        cls,
+        arduino_search_string: str = "CH340",
+        list_of_cartridges: list = [0, 1],
+        list_of_pump_relays: list = [0, 1, 2, 3, 4, 5],
+        list_of_ultrasonic_relays: list = [6, 7],
+        pump_slope: dict = {0: 1.0, 1: 1.0, 2: 1.0, 3: 1.0, 4: 1.0, 5: 1.0},
+        pump_intercept: dict = {0: 0.0, 1: 0.0, 2: 0.0, 3: 0.0, 4: 0.0, 5: 0.0},
+        telemetry: bool = False,
+        telemetry_size: int = 14400,
+        protocol: str = "text",
+        port: str = None,
+        calibration_file: str = None,
+    ) -> "Arduino":
+        """The connection to the Arduino shared by the whole process, so the
+        experiments of a session connect only once. The first call connects,
+        later calls return the same connection with the relays and pump
+        calibration of the call, as long as the firmware answers a ping.
+        Otherwise, or if the protocol or telemetry differ, they reconnect.
+        The shared connections are closed when the process exits.
+
+        Args:
+            See Arduino().
+
+        Returns:
+            Arduino: The connection.
+        """
+        if port is None:
+            port = cls.define_arduino_port(arduino_search_string)
+        with _connections_lock:
+            arduino = _connections.get(port)
+            if arduino is not None:
+                if (
+                    (arduino.protocol, arduino.telemetry) == (protocol, telemetry)
+                    and arduino._telemetry.maxlen == telemetry_size
+                    and arduino.ping()
+                ):
+                    LOGGER.info(f"Reusing the connection to the Arduino on {port}")
+                    arduino.configure(
+                        list_of_cartridges,
+                        list_of_pump_relays,
+                        list_of_ultrasonic_relays,
+                        pump_slope,
+                        pump_intercept,
+                        calibration_file,
+                    )
+                    return arduino
+                LOGGER.info(f"Reconnecting to the Arduino on {port}")
+                arduino.disconnect()
+            arduino = cls(
+                list_of_cartridges=list_of_cartridges,
+                list_of_pump_relays=list_of_pump_relays,
+                list_of_ultrasonic_relays=list_of_ultrasonic_relays,
+                pump_slope=pump_slope,
+                pump_intercept=pump_intercept,
+                telemetry=telemetry,
+                telemetry_size=telemetry_size,
+                protocol=protocol,
+                port=port,
+                calibration_file=calibration_file,
+            )
+            _connections[port] = arduino
+            return arduino
+
+    def configure(
+        self,
+        list_of_cartridges: list,
+        list_of_pump_relays: list,
+        list_of_ultrasonic_relays: list,
+        pump_slope: dict,
+        pump_intercept: dict,
+        calibration_file: str = None,
+    ) -> None:
+        """Set the relays of the robot and the pump calibration, see
+        Arduino()."""
+        if calibration_file is not None:
+            if os.path.exists(calibration_file):
+                slopes, intercepts = calibration.load_calibration(calibration_file)
+                pump_slope = {
+                    pump: slopes.get(pump, slope) for pump, slope in pump_slope.items()
+                }
+                pump_intercept = {
+                    pump: intercepts.get(pump, intercept)
+                    for pump, intercept in pump_intercept.items()
+                }
+                LOGGER.info(
+                    f"Loaded the calibration of pumps {sorted(slopes)} "
+                    f"from {calibration_file}"
+                )
+            else:
+                LOGGER.warning(
+                    f"No pump calibration {calibration_file}, using the "
+                    "default pump coefficients"
+                )
         self.list_of_cartridges = list_of_cartridges
         self.list_of_pump_relays = list_of_pump_relays
         self.list_of_ultrasonic_relays = list_of_ultrasonic_relays
@@ -65,93 +254,487 @@ class Arduino:
         self._check_pump_coefficients()
         self._check_catridges_vs_ultrasonic()
         self._check_ultrasound_pump_relays_dont_overlap()
-        self.connect()
 
     def connect(
         self,
     ) -> None:
-        """Connects to serial port of arduino"""
-        # Connection to arduino
+        """Connects to serial port of arduino and starts the thread that reads
+        its responses"""
+        # Connection to arduino. The short timeout only bounds how long the
+        # reader thread blocks, the commands have their own timeouts.
         self.connection = serial.Serial(
             port=self.SERIAL_PORT,
             baudrate=self.BAUD_RATE,
-            timeout=self.CONNECTION_TIMEOUT,
+            timeout=0.1,
+        )
+        # Commands waiting for a response by sequence number, in the order
+        # they were sent. Text responses go to the oldest text command.
+        self._pending = collections.OrderedDict()
+        self._sequence = 0
+        self._text_sequence = itertools.count(256)  # Never a binary sequence
+        self._binary = False
+        self._parser = framing.StreamParser()
+        # Futures of the timed relay pulses, by relay. The firmware runs the
+        # pulses on a timer and reports the end of each with "#<relay>".
+        self._relay_pulses = {}
+        # Future and steps of the running relay program
+        self._program = None
+        self._lock = threading.Lock()
+        self._sequence_free = threading.Condition(self._lock)
+        self._write_lock = threading.Lock()
+        self._closing = False
+        self._reader = threading.Thread(
+            target=self._read_responses, name="ArduinoReader", daemon=True
         )
-        time.sleep(1)  # initialization loadtime needs to be > 2 seconds
+        self._ready = threading.Event()
+        self._reader.start()
+        self._wait_until_ready()
+        if self.protocol == "binary":
+            # Switched in the text protocol, after that everything is framed
+            self.send_command("binary,1")
+            self._binary = True
+        if self.telemetry:
+            self.set_telemetry(True)
+
+    def _wait_until_ready(self) -> None:
+        """Internal function, waits until the firmware runs. A board that was
+        not reset by opening the port, eg. with the capacitor between RESET
+        and GND, answers a ping right away. Otherwise the firmware sends the
+        boot banner at the end of setup()."""
+        if self.ping():
+            return
+        if self._ready.wait(BOOT_TIMEOUT) or self.ping():
+            LOGGER.debug("The Arduino has booted")
+            return
+        LOGGER.warning(
+            "The Arduino sent no boot banner and does not answer a ping. "
+            "Upload the latest firmware."
+        )
+
+    def ping(self, timeout: float = PING_TIMEOUT) -> bool:
+        """Check that the firmware runs and answers. The ping is a binary
+        frame in both protocols, so a late answer is never taken for the
+        response of another command.
+
+        Args:
+            timeout (float, optional): Seconds to wait for the answer.
+                Defaults to PING_TIMEOUT.
+
+        Returns:
+            bool: The firmware answered.
+        """
+        if not self._reader.is_alive():
+            return False
+        future = concurrent.futures.Future()
+        try:
+            with self._write_lock:
+                with self._lock:
+                    sequence = self._next_sequence()
+                    self._pending[sequence] = ("done", future, True)
+                self.connection.write(framing.encode_frame(sequence, framing.PING))
+            future.result(timeout=timeout)
+            return True
+        except ValueError:
+            # Rejected by firmware without the ping, which still runs
+            return True
+        except concurrent.futures.TimeoutError:
+            with self._lock:
+                if sequence in self._pending and self._pending[sequence][1] is future:
+                    del self._pending[sequence]
+                    self._sequence_free.notify()
+            return False
+        except (serial.SerialException, IOError):
+            return False
 
     def disconnect(self) -> None:
         """Disconnects from serial port of arduino"""
+        with _connections_lock:
+            if _connections.get(self.SERIAL_PORT) is self:
+                del _connections[self.SERIAL_PORT]
+        self._closing = True
+        self._reader.join()
         self.connection.close()
-        time.sleep(31)
 
-    def get_temperature0(self) -> float:
+    def _read_responses(self) -> None:
+        """Internal function, the body of the reader thread. Splits the serial
+        stream into frames and lines and resolves the pending commands with
+        them."""
+        while not self._closing:
+            try:
+                data = self.connection.read(max(1, self.connection.in_waiting))
+            except (serial.SerialException, OSError) as e:
+                if not self._closing:
+                    LOGGER.error(f"Reading from the Arduino failed: {e}")
+                break
+            if not data:
+                continue
+            for message in self._parser.feed(data):
+                if isinstance(message, str):
+                    self._handle_line(message)
+                else:
+                    self._handle_frame(*message)
+
+        # Fail the commands that will never get a response
+        with self._lock:
+            pending = [future for _, future, _ in self._pending.values()]
+            self._pending.clear()
+            for pulses in self._relay_pulses.values():
+                pending.extend(pulses)
+            self._relay_pulses.clear()
+            if self._program is not None:
+                pending.append(self._program[0])
+                self._program = None
+        for future in pending:
+            if not future.done():
+                future.set_exception(
+                    IOError("The connection to the Arduino was closed.")
+                )
+
+    def _handle_line(self, line: str) -> None:
+        """Internal function, resolves the oldest pending command with a line
+        from the Arduino, if the line is the kind of response it waits for."""
+        if not line:
+            return
+        if line.startswith(NOISE_PREFIXES):
+            LOGGER.debug(f"Arduino: {line}")
+            return
+        if line == READY_BANNER:
+            self._ready.set()
+            return
+        if line.startswith("#") and line[1:].isdigit():
+            self._finish_pulse(int(line[1:]))
+            return
+        try:
+            if line.startswith("T,"):
+                self._add_telemetry([float(value) for value in line.split(",")[1:]])
+                return
+            if line == "P" or line.startswith("P,"):
+                self._finish_program([int(value) for value in line.split(",")[1:]])
+                return
+        except ValueError:
+            LOGGER.debug(f"Ignoring event from the Arduino: {line}")
+            return
+        with self._lock:
+            # The oldest text command, a ping may be in flight before it
+            sequence = next(
+                (key for key, (_, _, binary) in self._pending.items() if not binary),
+                None,
+            )
+            if sequence is None:
+                LOGGER.debug(f"Unexpected response from the Arduino: {line}")
+                return
+            response, future, _ = self._pending[sequence]
+            try:
+                if response == "done":
+                    if line != "#":
+                        raise ValueError(line)
+                    value = None
+                elif response == "state":
+                    value = bool(int(float(line)))
+                else:
+                    value = float(line)
+            except ValueError:
+                LOGGER.debug(f"Ignoring response from the Arduino: {line}")
+                return
+            del self._pending[sequence]
+        future.set_result(value)
+
+    def _handle_frame(self, sequence: int, opcode: int, payload: bytes) -> None:
+        """Internal function, resolves the command of a binary reply, or
+        handles an event of the firmware."""
+        try:
+            if sequence == 0:
+                if opcode == framing.RELAY_DONE:
+                    self._finish_pulse(payload[0])
+                elif opcode == framing.PROGRAM_DONE:
+                    self._finish_program(
+                        struct.unpack(f"<{len(payload) // 4}I", payload)
+                    )
+                elif opcode == framing.TELEMETRY_FRAME:
+                    self._add_telemetry(list(struct.unpack("<I8f", payload)))
+                else:
+                    LOGGER.debug(f"Unknown event {opcode} from the Arduino")
+                return
+            with self._lock:
+                if sequence not in self._pending:
+                    LOGGER.debug(f"Unexpected reply {sequence} from the Arduino")
+                    return
+                response, future, _ = self._pending.pop(sequence)
+                self._sequence_free.notify()
+            if opcode == framing.ERROR:
+                if not future.done():
+                    future.set_exception(
+                        ValueError("The Arduino rejected the command.")
+                    )
+                return
+            value = framing.decode_response(response, payload)
+        except (IndexError, struct.error):
+            LOGGER.debug(f"Malformed frame {opcode} from the Arduino: {payload}")
+            return
+        if not future.done():
+            future.set_result(value)
+
+    def _finish_pulse(self, relay_num: int) -> None:
+        """Internal function, resolves the pulses of a relay once the firmware
+        has switched it off."""
+        with self._lock:
+            pulses = self._relay_pulses.pop(relay_num, [])
+        if not pulses:
+            LOGGER.debug(f"Unexpected end of a pulse of relay {relay_num}")
+        for future in pulses:
+            future.set_result(None)
+
+    def _add_telemetry(self, values: list) -> None:
+        """Internal function, stores a telemetry frame in the ring buffer."""
+        if len(values) != len(TELEMETRY_COLUMNS) - 1:
+            LOGGER.debug(f"Ignoring telemetry from the Arduino: {values}")
+            return
+        values[0] /= 1000
+        with self._lock:
+            self._telemetry.append((time.time(), *values))
+
+    def _finish_program(self, times: list) -> None:
+        """Internal function, resolves the running program with the timings
+        the firmware reports once all its steps are done, in ms."""
+        with self._lock:
+            program, self._program = self._program, None
+        if program is None:
+            LOGGER.debug(f"Unexpected end of a program: {times}")
+            return
+        future, steps = program
+        times = [value / 1000 for value in times]
+        timings = [
+            {"relay": relay, "start [s]": on, "end [s]": off}
+            for (relay, _, _), on, off in zip(steps, times[::2], times[1::2])
+        ]
+        future.set_result(timings)
+
+    def send_command(
+        self,
+        command: str,
+        response: str = "done",
+        wait: bool = True,
+        timeout: float = None,
+    ):
+        """Send a command to the Arduino. The response is read by a background
+        thread, so several commands can be in flight at once. With the binary
+        protocol the command is sent as a frame, see framing.encode_command().
+
+        Args:
+            command (str): The command without the start and end markers, eg.
+                "set_relay_on,3".
+            response (str, optional): The response the command gives: "done"
+                for "#" once the command has finished, "value" for a number,
+                "state" for the state of a relay or None if the command gives
+                no response. Defaults to "done".
+            wait (bool, optional): Wait for the response. Defaults to True.
+            timeout (float, optional): Seconds to wait for the response.
+                Defaults to CONNECTION_TIMEOUT.
+
+        Raises:
+            RuntimeWarning: Arduino did not respond in the given time.
+
+        Returns:
+            The response, or a concurrent.futures.Future of it if wait is
+            False. "done" commands give None.
+        """
+        future = concurrent.futures.Future()
+        # The write lock keeps the commands in the order of the pending
+        # responses. The write itself is outside of the lock of the reader
+        # thread, which has to keep reading while a long write blocks.
+        with self._write_lock:
+            with self._lock:
+                if response is None:
+                    future.set_result(None)
+                if self._binary:
+                    # Binary commands are always answered, eg. setpoints with
+                    # an acknowledgement, so the reply is matched even if unused
+                    opcode, payload = framing.encode_command(command)
+                    sequence = self._next_sequence()
+                    data = framing.encode_frame(sequence, opcode, payload)
+                    self._pending[sequence] = (response, future, True)
+                else:
+                    data = f"<{command}>".encode()
+                    if response is not None:
+                        sequence = next(self._text_sequence)
+                        self._pending[sequence] = (response, future, False)
+            self.connection.write(data)
+        if not wait:
+            return future
+        return self._result(future, timeout)
+
+    def _next_sequence(self) -> int:
+        """Internal function, a free sequence number for a binary command.
+        Waits for a reply if all 255 are in flight. Call with the lock held."""
+        while True:
+            for _ in range(255):
+                self._sequence = self._sequence % 255 + 1
+                if self._sequence not in self._pending:
+                    return self._sequence
+            if not self._reader.is_alive():
+                raise IOError("The connection to the Arduino was closed.")
+            self._sequence_free.wait(1)
+
+    def _result(self, future: concurrent.futures.Future, timeout: float = None):
+        """Internal function, waits for the response of a command."""
+        timeout = self.CONNECTION_TIMEOUT if timeout is None else timeout
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            raise RuntimeWarning(
+                "Arduino did not finish the job.",
+                "Check arduino IDE or increase the value of max_wait_time.",
+            )
+
+    def get_temperature0(self, wait: bool = True, max_age: float = 2.0) -> float:
         """Measure the temeprature of the temperature sensor 0
 
+        Args:
+            wait (bool, optional): Wait for the measurement, otherwise a
+                future of it is returned. Defaults to True.
+            max_age (float, optional): With telemetry on, the latest reading
+                is returned if it is at most max_age seconds old. Defaults to
+                2.0.
+
         Returns:
             float: The measured temperature of the system in degree celsius.
         """
         LOGGER.info("Reading sample temperature sensor 0")
-        self.connection.write("<read_temp0>".encode())
-        temperature = self._read_temperature()
-        return temperature
+        return self._read_temperature("read_temp0", wait, max_age)
 
-    def get_temperature0_ambient(self) -> float:
+    def get_temperature0_ambient(
+        self, wait: bool = True, max_age: float = 2.0
+    ) -> float:
         """Measure the ambient temperature of the temperature sensor 0
 
+        Args:
+            wait (bool, optional): Wait for the measurement, otherwise a
+                future of it is returned. Defaults to True.
+            max_age (float, optional): With telemetry on, the latest reading
+                is returned if it is at most max_age seconds old. Defaults to
+                2.0.
+
         Returns:
             float: The measured temperature of the system in degree celsius.
         """
 
         LOGGER.info("Reading ambient temperature sensor 0")
-        self.connection.write("<read_temp0_ambient>".encode())
-        temperature = self._read_temperature()
-        return temperature
+        return self._read_temperature("read_temp0_ambient", wait, max_age)
 
-    def get_temperature1(self) -> float:
+    def get_temperature1(self, wait: bool = True, max_age: float = 2.0) -> float:
         """Measure the temeprature of the temperature sensor 1
 
+        Args:
+            wait (bool, optional): Wait for the measurement, otherwise a
+                future of it is returned. Defaults to True.
+            max_age (float, optional): With telemetry on, the latest reading
+                is returned if it is at most max_age seconds old. Defaults to
+                2.0.
+
         Returns:
             float: The measured temperature of the system in degree celsius.
         """
 
         LOGGER.info("Reading sample temperature sensor 1")
-        self.connection.write("<read_temp1>".encode())
-        temperature = self._read_temperature()
-        return temperature
+        return self._read_temperature("read_temp1", wait, max_age)
 
-    def get_temperature1_ambient(self) -> float:
+    def get_temperature1_ambient(
+        self, wait: bool = True, max_age: float = 2.0
+    ) -> float:
         """Measure the ambient temperature of the temperature sensor 1
 
+        Args:
+            wait (bool, optional): Wait for the measurement, otherwise a
+                future of it is returned. Defaults to True.
+            max_age (float, optional): With telemetry on, the latest reading
+                is returned if it is at most max_age seconds old. Defaults to
+                2.0.
+
         Returns:
             float: The measured temperature of the system in degree celsius.
         """
 
         LOGGER.info("Reading ambient temperature sensor 1")
-        self.connection.write("<read_temp1_ambient>".encode())
-        temperature = self._read_temperature()
-        return temperature
+        return self._read_temperature("read_temp1_ambient", wait, max_age)
 
-    def _read_temperature(self):
-        """Read the temperature from the arduino.
+    def _read_temperature(self, command: str, wait: bool = True, max_age: float = None):
+        """Read the temperature from the arduino, or from the telemetry if a
+        recent enough frame was received.
+
+        Args:
+            command (str): The command that reads the temperature.
+            wait (bool, optional): Wait for the temperature. Defaults to True.
+            max_age (float, optional): Maximum age of the telemetry in
+                seconds. Defaults to None, which always asks the Arduino.
 
         Returns:
             float: The measured temperature of the system in degree celsius.
         """
-
-        received_response = False
-        while received_response is False:
-            try:
-                temperature = self.connection.readline().decode()
-                LOGGER.debug(f"Returned raw temperature: {temperature}")
-                temperature = float(temperature)
-                received_response = True
-            except Exception:
-                LOGGER.info("Waiting for arduino to respond")
-                time.sleep(1)
-
+        column = TELEMETRY_COMMANDS[command]
+        latest = self.latest_telemetry()
+        if (
+            max_age is not None
+            and latest is not None
+            and time.time() - latest["Time [s]"] <= max_age
+        ):
+            temperature = latest[column]
+            if not wait:
+                future = concurrent.futures.Future()
+                future.set_result(temperature)
+                return future
+            LOGGER.info(f"Temperature sensor: {temperature} C (telemetry)")
+            return temperature
+
+        future = self.send_command(command, response="value", wait=False)
+        if not wait:
+            return future
+        temperature = self._result(future)
         LOGGER.info(f"Temperature sensor: {temperature} C")
         return temperature
 
+    def set_telemetry(self, enabled: bool = True) -> None:
+        """Switch the telemetry frames of the firmware on or off.
+
+        Args:
+            enabled (bool, optional): Send a frame every second. Defaults to
+                True.
+        """
+        LOGGER.info(f"Switching telemetry {'on' if enabled else 'off'}")
+        self.send_command(f"telemetry,{int(enabled)}")
+        self.telemetry = enabled
+
+    def latest_telemetry(self) -> dict:
+        """The latest telemetry frame.
+
+        Returns:
+            dict: The values of the frame by TELEMETRY_COLUMNS, or None if no
+            frame was received.
+        """
+        with self._lock:
+            if not self._telemetry:
+                return None
+            return dict(zip(TELEMETRY_COLUMNS, self._telemetry[-1]))
+
+    def temperature_trace(self, since: float = None) -> dict:
+        """The telemetry frames in the ring buffer, eg. to store the
+        temperatures during a run.
+
+        Args:
+            since (float, optional): Only frames received after this
+                time.time(). Defaults to None.
+
+        Returns:
+            dict: A list of values for each of TELEMETRY_COLUMNS.
+        """
+        with self._lock:
+            frames = [
+                frame for frame in self._telemetry if since is None or frame[0] > since
+            ]
+        return {
+            column: [frame[index] for frame in frames]
+            for index, column in enumerate(TELEMETRY_COLUMNS)
+        }
+
     def set_temperature(self, cartridge: int, temperature: float) -> None:
         """Set the temperature setpoint for a specific cartridge for the PID
         controller.
@@ -168,10 +751,155 @@ class Arduino:
 
         temp = temperature * 10
 
-        self.connection.write(f"<setpoint{cartridge},{temp}>".encode())
-        self.connection.readline().decode()
+        # The firmware does not respond to setpoints
+        self.send_command(f"setpoint{cartridge},{temp}", response=None)
+        self.setpoints[cartridge] = temperature
         LOGGER.info(f"Set temperature to {temperature} C")
 
+    def _setpoint(self, cartridge: int) -> float:
+        """Internal function, the setpoint of a cartridge, as last set or
+        else as reported by the telemetry."""
+        if cartridge in self.setpoints:
+            return self.setpoints[cartridge]
+        latest = self.latest_telemetry() if self.telemetry else None
+        if latest is not None and cartridge in (0, 1):
+            return latest[f"Setpoint {cartridge} [C]"]
+        raise ValueError(f"The setpoint of cartridge {cartridge} is unknown.")
+
+    def wait_until_setpoint(
+        self,
+        cartridge: int,
+        tolerance: float = 2.0,
+        hold_time: float = 60,
+        timeout: float = 1800,
+        setpoint: float = None,
+    ) -> float:
+        """Wait until the PID loop of a cartridge has settled: the
+        temperature has stayed within tolerance of the setpoint for hold_time.
+        With telemetry the temperatures received before the call count, so a
+        cartridge that is already at the setpoint returns right away.
+
+        Args:
+            cartridge (int): Cartridge number
+            tolerance (float, optional): Maximum deviation from the setpoint
+                in degree celsius. Defaults to 2.0, the band of the firmware
+                in which the PID controller regulates instead of heating at
+                full power or not at all.
+            hold_time (float, optional): Seconds the temperature must stay
+                within the tolerance. Defaults to 60.
+            timeout (float, optional): Maximum seconds to wait.
+                Defaults to 1800.
+            setpoint (float, optional): Temperature to wait for. Defaults to
+                None, which uses the setpoint of the cartridge.
+
+        Raises:
+            RuntimeWarning: The temperature did not settle in the given time,
+                also if no telemetry arrived.
+
+        Returns:
+            float: Seconds waited.
+        """
+        self._check_number_of_cartridges(cartridge)
+        if setpoint is None:
+            setpoint = self._setpoint(cartridge)
+        LOGGER.info(f"Waiting for cartridge {cartridge} to settle at {setpoint} C")
+        command = f"read_temp{cartridge}"
+        start = time.time()
+        samples = []  # (time.time(), temperature)
+        last_estimate = start
+        while True:
+            if self.telemetry:
+                since = samples[-1][0] if samples else start - 2 * hold_time
+                trace = self.temperature_trace(since=since)
+                samples += zip(trace["Time [s]"], trace[TELEMETRY_COMMANDS[command]])
+            else:
+                temperature = self.send_command(command, response="value")
+                samples.append((time.time(), temperature))
+            now = time.time()
+            # The time since the temperature is within the tolerance
+            settled_since = now
+            for sample_time, temperature in reversed(samples):
+                if abs(temperature - setpoint) > tolerance:
+                    break
+                settled_since = sample_time
+            if samples and samples[-1][0] - settled_since >= hold_time:
+                LOGGER.info(
+                    f"Cartridge {cartridge} settled at {samples[-1][1]} C after "
+                    f"{now - start:.0f} s"
+                )
+                return now - start
+            # Without telemetry frames yet there is no temperature to report
+            reading = f"it is at {samples[-1][1]} C" if samples else "no reading yet"
+            if now - start > timeout:
+                raise RuntimeWarning(
+                    f"Cartridge {cartridge} did not settle at {setpoint} C "
+                    f"within {timeout} s, {reading}."
+                )
+            if now - last_estimate >= 30:
+                last_estimate = now
+                recent = [sample for sample in samples if sample[0] >= now - 30]
+                remaining = self._time_to_setpoint(recent, setpoint)
+                LOGGER.info(
+                    f"Cartridge {cartridge}: {reading}"
+                    + (
+                        f", about {remaining:.0f} s to {setpoint} C"
+                        if remaining
+                        else ""
+                    )
+                )
+            # Keep what the hold time and the estimate need
+            while samples and samples[0][0] < now - max(hold_time, 30):
+                samples.pop(0)
+            time.sleep(1)
+
+    def time_to_setpoint(
+        self, cartridge: int, setpoint: float = None, window: float = 30
+    ) -> float:
+        """Predict the seconds until a cartridge reaches its setpoint, from
+        the slope of the telemetry temperatures. Needs telemetry.
+
+        Args:
+            cartridge (int): Cartridge number
+            setpoint (float, optional): Temperature to reach. Defaults to None,
+                which uses the setpoint of the cartridge.
+            window (float, optional): Seconds of telemetry the slope is fitted
+                to. Defaults to 30.
+
+        Returns:
+            float: The seconds, 0 if the temperature is at the setpoint, or
+            None if it does not approach the setpoint.
+        """
+        if setpoint is None:
+            setpoint = self._setpoint(cartridge)
+        trace = self.temperature_trace(since=time.time() - window)
+        samples = list(
+            zip(trace["Time [s]"], trace[TELEMETRY_COMMANDS[f"read_temp{cartridge}"]])
+        )
+        return self._time_to_setpoint(samples, setpoint)
+
+    def _time_to_setpoint(self, samples: list, setpoint: float) -> float:
+        """Internal function, the time until a least squares line through
+        the samples (time, temperature) reaches the setpoint."""
+        if len(samples) < 2:
+            return None
+        times, temperatures = zip(*samples)
+        mean_time = sum(times) / len(times)
+        mean_temperature = sum(temperatures) / len(temperatures)
+        spread = sum((t - mean_time) ** 2 for t in times)
+        if spread == 0:
+            return None
+        slope = (
+            sum(
+                (t - mean_time) * (temperature - mean_temperature)
+                for t, temperature in samples
+            )
+            / spread
+        )
+        difference = setpoint - temperatures[-1]
+        if difference * slope < 0 or slope == 0:
+            return 0 if difference == 0 else None
+        return difference / slope
+
     def _check_number_of_cartridges(self, cartridge: int) -> None:
         """Check if the cartridge number is within the range.
 
@@ -243,44 +971,77 @@ class Arduino:
         ):
             raise ValueError("Pump intercepts should be floats.")
 
-    def set_ultrasound_on(self, cartridge: int, time: float):
+    def set_ultrasound_on(self, cartridge: int, time: float, wait: bool = True):
         """Turns on the ultrasound for the given time.
 
         Args:
             cartridge (int): Cartridge number
             time (float): Time in seconds which ultrasound should turned on.
+            wait (bool, optional): Wait until the ultrasound is off again,
+                otherwise a future is returned. Defaults to True.
         """
         self._check_number_of_cartridges(cartridge)
 
-        # Find the index number of the cartridge
-        cartridge_index = self.list_of_cartridges.index(cartridge)
-        ultrasound_relay = self.list_of_ultrasonic_relays[cartridge_index]
-
         LOGGER.info(
             f"Turning on ultrasound for {time} seconds on cartridge {cartridge}."
         )
 
-        self.set_relay_on_time(ultrasound_relay, time)
+        return self.set_relay_on_time(self.ultrasound_relay(cartridge), time, wait)
+
+    def ultrasound_relay(self, cartridge: int) -> int:
+        """The relay of the ultrasound of a cartridge.
+
+        Args:
+            cartridge (int): Cartridge number
+
+        Returns:
+            int: Number of the relay.
+        """
+        self._check_number_of_cartridges(cartridge)
+
+        # Find the index number of the cartridge
+        cartridge_index = self.list_of_cartridges.index(cartridge)
+        return self.list_of_ultrasonic_relays[cartridge_index]
 
-    def set_pump_on(self, pump: int, time: float):
+    def set_pump_on(self, pump: int, time: float, wait: bool = True):
         """Turns on the pump for the given time.
 
         Args:
             pump (int): Pump number
             time (float): Time in seconds which pump should turned on.
+            wait (bool, optional): Wait until the pump is off again,
+                otherwise a future is returned. Defaults to True.
         """
         self._check_pump_number(pump)
 
         LOGGER.info(f"Turning on pump {pump} for {time} seconds.")
 
-        self.set_relay_on_time(pump, time)
+        return self.set_relay_on_time(pump, time, wait)
 
-    def dispense_ml(self, pump: int, volume: float):
+    def dispense_ml(self, pump: int, volume: float, wait: bool = True):
         """Dispense the given volume in ml.
 
         Args:
             pump (int): Pump number
             volume (float): Volume in ml to be dispensed.
+            wait (bool, optional): Wait until the volume is dispensed,
+                otherwise a future is returned. Defaults to True.
+        """
+        time_on = self.pump_time(pump, volume)
+
+        LOGGER.info(f"Dispensing {volume} ml from pump {pump}.")
+
+        return self.set_pump_on(pump, time_on, wait)
+
+    def pump_time(self, pump: int, volume: float) -> float:
+        """Time the pump has to run to dispense a volume.
+
+        Args:
+            pump (int): Pump number
+            volume (float): Volume in ml to be dispensed.
+
+        Returns:
+            float: Time in seconds, rounded to 0.1 s.
         """
         self._check_pump_number(pump)
 
@@ -288,40 +1049,92 @@ class Arduino:
         time_on = self.pump_slope[pump] * volume + self.pump_intercept[pump]
 
         # Round to the nearest 0.1 second
-        time_on = round(time_on, 1)
+        return round(time_on, 1)
 
-        LOGGER.info(f"Dispensing {volume} ml from pump {pump}.")
+    def run_program(self, steps: list, wait: bool = True):
+        """Run a program of timed relay pulses. The whole program is sent in
+        one command and timed by the firmware, which reports once when all
+        steps are done. Pulses may overlap.
 
-        self.set_pump_on(pump, time_on)
+        Args:
+            steps (list): Tuples (relay_num, start, duration) with the start
+                relative to the start of the program and the duration in
+                seconds, eg. [(0, 0, 1.5), (7, 0, 5), (2, 5, 2)]. At most
+                MAX_PROGRAM_STEPS steps.
+            wait (bool, optional): Wait until the program is done, otherwise
+                a future is returned. Defaults to True.
+
+        Raises:
+            ValueError: The program is invalid or another program is running.
+            RuntimeWarning: Arduino did not finish the program in time.
+
+        Returns:
+            list: The measured timings of the steps, dicts with the relay and
+            the "start [s]" and "end [s]" relative to the start of the
+            program, or a future of them if wait is False.
+        """
+        if len(steps) > MAX_PROGRAM_STEPS:
+            raise ValueError(
+                f"A program can have at most {MAX_PROGRAM_STEPS} steps, "
+                f"not {len(steps)}."
+            )
+        if any(start < 0 or duration < 0 for _, start, duration in steps):
+            raise ValueError("Start and duration of the steps can't be negative.")
+        command = ",".join(
+            ["program"]
+            + [
+                f"{relay_num},{round(start * 1000)},{round(duration * 1000)}"
+                for relay_num, start, duration in steps
+            ]
+        )
+        if len(command) > MAX_COMMAND_LENGTH:
+            raise ValueError("The program is too long for the Arduino.")
+        end = max([start + duration for _, start, duration in steps], default=0)
+
+        LOGGER.info(f"Running a program of {len(steps)} steps in {end} seconds")
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._program is not None:
+                raise ValueError("Another program is running.")
+            self._program = (future, list(steps))
+        try:
+            # The firmware answers as soon as the program has started
+            self.send_command(command)
+        except RuntimeWarning:
+            with self._lock:
+                self._program = None
+            raise
+        if not wait:
+            return future
+        return self._result(future, end + self.CONNECTION_TIMEOUT)
 
     def wait_for_arduino(self, max_wait_time: int = 2000):
-        """To make sure arduino completed the particular task.
+        """To make sure arduino completed all the tasks sent so far.
 
         Args:
             max_wait_time (int, optional): Maximum wait time to get response
-            from arduino in seconds. Defaults to 30.
+            from arduino in seconds. Defaults to 2000.
 
         Raises:
             RuntimeWarning: Arduino did not finish the job in given time.
         """
-        max_try = (1 / self.CONNECTION_TIMEOUT) * max_wait_time
-        count = 0
-        while count < max_try:
-            LOGGER.debug("waiting for arduino to finish the task")
-            state = self.connection.read().decode()
-            if state == "#":
-                LOGGER.debug("Arduino finished the task")
-                break
-            count += 1
-            time.sleep(0.1)
-        else:
-            raise RuntimeWarning(
-                "Arduino did not finish the job.",
-                "Check arduino IDE or increase the value of max_wait_time.",
-            )
-
-    def define_arduino_port(self, search_string: str) -> str:
-        """Find the port of the Arduino.
+        LOGGER.debug("waiting for arduino to finish the task")
+        with self._lock:
+            futures = [future for _, future, _ in self._pending.values()]
+            for pulses in self._relay_pulses.values():
+                futures.extend(pulses)
+            if self._program is not None:
+                futures.append(self._program[0])
+        deadline = time.monotonic() + max_wait_time
+        for future in futures:
+            self._result(future, max(deadline - time.monotonic(), 0))
+        LOGGER.debug("Arduino finished the task")
+
+    @staticmethod
+    def define_arduino_port(search_string: str) -> str:
+        """Find the port of the Arduino. The USB identity of the Arduino is
+        cached, so later calls find it again without a search, even if it got
+        another port after being plugged in again.
 
         Args:
             search_string (str, optional): Name of the Arduino.
@@ -329,35 +1142,101 @@ class Arduino:
         Returns:
             str: Port of the Arduino.
         """
+        ports = list(serial.tools.list_ports.comports())
+        identity = _port_identities.get(search_string)
+        for p in ports:
+            if identity is not None and (p.vid, p.pid, p.serial_number) == identity:
+                return p.device
 
         # List Arduinos on computer
-        ports = list(serial.tools.list_ports.comports())
         logging.info("List of USB ports:")
         for p in ports:
             logging.info(f"{p}")
-        arduino_ports = [p.device for p in ports if search_string in p.description]
+        arduino_ports = [p for p in ports if search_string in p.description]
         if not arduino_ports:
             logging.error("No Arduino found")
             raise IOError("No Arduino found")
         if len(arduino_ports) > 1:
             logging.warning("Multiple Arduinos found - using the first")
 
-        # Automatically find Arduino
-        arduino = str(serial.Serial(arduino_ports[0]).port)
-        logging.info(f"Arduino found on port: {arduino}")
-        return arduino
+        arduino = arduino_ports[0]
+        if arduino.vid is not None:
+            _port_identities[search_string] = (
+                arduino.vid,
+                arduino.pid,
+                arduino.serial_number,
+            )
+        logging.info(f"Arduino found on port: {arduino.device}")
+        return arduino.device
 
-    def set_relay_on_time(self, relay_num: int, time_on: float) -> None:
-        """Turn on the relay for the given time.
+    def set_relay_on_time(
+        self, relay_num: int, time_on: float, wait: bool = True
+    ) -> None:
+        """Turn on the relay for the given time. The firmware switches the
+        relay off on a timer, so pulses of several relays can run at once.
 
         Args:
             relay_num (int): Number of the relay.
             time_on (float): Time in seconds which relay should turned on.
+            wait (bool, optional): Wait until the relay is off again,
+                otherwise a future is returned, which is done once the relay
+                is off. Defaults to True.
+
+        Raises:
+            RuntimeWarning: The firmware did not report that the relay is off,
+                eg. firmware older than this driver.
         """
         LOGGER.info(f"Switching relay {relay_num} on for {time_on} seconds")
         time_ms = round(time_on * 1000, 0)
-        self.connection.write(f"<set_relay_on_time,{relay_num},{time_ms}>".encode())
-        self.wait_for_arduino()
+        pulse = concurrent.futures.Future()
+        with self._lock:
+            self._relay_pulses.setdefault(relay_num, []).append(pulse)
+        try:
+            # The firmware answers as soon as the relay is on
+            self.send_command(f"set_relay_on_time,{relay_num},{time_ms}")
+        except RuntimeWarning:
+            with self._lock:
+                self._relay_pulses.get(relay_num, []).remove(pulse)
+            raise
+        if not wait:
+            return pulse
+        try:
+            return self._result(pulse, time_on + self.CONNECTION_TIMEOUT)
+        except RuntimeWarning:
+            # The end of the pulse will not come, so the relay is not busy
+            with self._lock:
+                pulses = self._relay_pulses.get(relay_num, [])
+                if pulse in pulses:
+                    pulses.remove(pulse)
+            raise
+
+    def relay_busy(self, relay_num: int) -> bool:
+        """Check if a timed pulse of the relay is running.
+
+        Args:
+            relay_num (int): Number of the relay.
+
+        Returns:
+            bool: True until the firmware has switched the relay off.
+        """
+        with self._lock:
+            return bool(self._relay_pulses.get(relay_num))
+
+    def wait_for_relay(self, relay_num: int, timeout: float = None) -> None:
+        """Wait until the timed pulses of a relay are done.
+
+        Args:
+            relay_num (int): Number of the relay.
+            timeout (float, optional): Seconds to wait. Defaults to
+                CONNECTION_TIMEOUT.
+
+        Raises:
+            RuntimeWarning: The relay was not switched off in the given time.
+        """
+        with self._lock:
+            pulses = list(self._relay_pulses.get(relay_num, []))
+        for future in pulses:
+            self._result(future, timeout)
 
     def get_relay_status(self, relay_num: int) -> bool:
         """Get the status of the relay.
@@ -370,31 +1249,32 @@ class Arduino:
         """
 
         LOGGER.info(f"Getting status of relay {relay_num}")
-        self.connection.write(f"<get_relay_{relay_num}_state>".encode())
-        status = self.connection.readline().decode()
-        if status == "True":
+        status = self.send_command(f"get_relay_{relay_num}_state", response="state")
+        if status:
             LOGGER.info(f"Status of relay {relay_num}: High / On")
             return True
         else:
             LOGGER.info(f"Status of relay {relay_num}: Low / Off")
             return False
 
-    def set_relay_on(self, relay_num: int) -> None:
+    def set_relay_on(self, relay_num: int, wait: bool = True) -> None:
         """Turn on the relay.
 
         Args:
             relay_num (int): Number of the relay.
+            wait (bool, optional): Wait until the relay is on, otherwise a
+                future is returned. Defaults to True.
         """
         LOGGER.info(f"Switching relay {relay_num} on")
-        self.connection.write(f"<set_relay_on,{relay_num}>".encode())
-        self.wait_for_arduino()
+        return self.send_command(f"set_relay_on,{relay_num}", wait=wait)
 
-    def set_relay_off(self, relay_num: int) -> None:
+    def set_relay_off(self, relay_num: int, wait: bool = True) -> None:
         """Turn off the relay.
 
         Args:
             relay_num (int): Number of the relay.
+            wait (bool, optional): Wait until the relay is off, otherwise a
+                future is returned. Defaults to True.
         """
         LOGGER.info(f"Switching relay {relay_num} off")
-        self.connection.write(f"<set_relay_off,{relay_num}>".encode())
-        self.wait_for_arduino()
+        return self.send_command(f"set_relay_off,{relay_num}", wait=wait)
@@ -0,0 +1,194 @@
+# Growable columnar sample buffer used by the potentiostat data callbacks.
+#
+# Every call to append() writes one value into each column, so the cost per
+# sample is constant. When the buffer is full the capacity is doubled, which
+# keeps the amortised cost of growing the buffer constant as well.
+# A sink can be attached to receive the samples in fixed-size chunks while
+# they are being recorded.
+
+import numpy as np
+import pandas as pd
+
+
+class ColumnarBuffer:
+    def __init__(self, columns: list, initial_capacity: int = 1024):
+        """Initialize an empty buffer with one float64 array per column.
+
+        Args:
+            columns (list): Names of the columns, in the order the values are
+                passed to append().
+            initial_capacity (int, optional): Number of samples that can be
+                stored before the buffer grows. Defaults to 1024.
+        """
+        if initial_capacity < 1:
+            raise ValueError("initial_capacity must be at least 1.")
+        self.columns = list(columns)
+        self._initial_capacity = initial_capacity
+        self._data = np.empty((len(self.columns), initial_capacity), dtype=np.float64)
+        self._length = 0
+        self.sink = None
+        self.chunk_size = 0
+        self._flushed = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def capacity(self) -> int:
+        """Number of samples that fit in the buffer before it grows."""
+        return self._data.shape[1]
+
+    def append(self, *values) -> None:
+        """Append one sample. None values are stored as NaN.
+
+        Args:
+            *values: One value per column, in the order of self.columns.
+        """
+        if self._length == self._data.shape[1]:
+            self._grow()
+        try:
+            self._data[:, self._length] = values
+        except TypeError:
+            self._data[:, self._length] = [
+                np.nan if value is None else value for value in values
+            ]
+        self._length += 1
+        if self.sink is not None and self._length - self._flushed >= self.chunk_size:
+            self.flush()
+
+    def extend(self, chunk: np.ndarray) -> None:
+        """Append several samples at once.
+
+        Args:
+            chunk (np.ndarray): Array of shape (number of columns, samples).
+        """
+        count = chunk.shape[1]
+        while self._length + count > self._data.shape[1]:
+            self._grow()
+        self._data[:, self._length : self._length + count] = chunk
+        self._length += count
+        if self.sink is not None and self._length - self._flushed >= self.chunk_size:
+            self.flush()
+
+    def _grow(self) -> None:
+        """Double the capacity of the buffer."""
+        data = np.empty((self._data.shape[0], 2 * self._data.shape[1]), np.float64)
+        data[:, : self._length] = self._data[:, : self._length]
+        self._data = data
+
+    def attach_sink(self, sink, chunk_size: int = 256) -> None:
+        """Send samples to a sink in chunks of chunk_size samples. Only the
+        samples appended after the sink is attached are sent.
+
+        Args:
+            sink: Object with a write(chunk) method, eg. a CsvChunkSink. The
+                chunk is an array of shape (number of columns, samples).
+            chunk_size (int, optional): Number of samples per chunk.
+                Defaults to 256.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1.")
+        self.sink = sink
+        self.chunk_size = chunk_size
+        self._flushed = self._length
+
+    def detach_sink(self):
+        """Send the remaining samples to the sink and detach it.
+
+        Returns:
+            The detached sink or None if no sink was attached.
+        """
+        sink = self.sink
+        if sink is not None:
+            self.flush()
+            self.sink = None
+        return sink
+
+    def flush(self) -> None:
+        """Send the samples that have not been sent yet to the sink."""
+        if self.sink is not None and self._length > self._flushed:
+            self.sink.write(self._data[:, self._flushed : self._length].copy())
+            self._flushed = self._length
+
+    def column(self, name: str) -> np.ndarray:
+        """Return the filled part of a column as a view of the buffer.
+
+        Args:
+            name (str): Name of the column.
+
+        Returns:
+            np.ndarray: Float64 array with one value per sample.
+        """
+        return self._data[self.columns.index(name), : self._length]
+
+    def arrays(self, start: int = 0, stop: int = None) -> dict:
+        """Return the samples as views of the buffer, without copying. The
+        views show the samples at the time of the call; once the buffer grows
+        or is cleared they keep the old values and no longer follow it.
+
+        Args:
+            start (int, optional): First sample to include. Defaults to 0.
+            stop (int, optional): Sample to stop before. Defaults to the
+                number of samples in the buffer.
+
+        Returns:
+            dict: Read-only float64 array per column name.
+        """
+        stop = self._length if stop is None else min(stop, self._length)
+        arrays = {}
+        for i, name in enumerate(self.columns):
+            view = self._data[i, start:stop]
+            view.flags.writeable = False
+            arrays[name] = view
+        return arrays
+
+    def to_record_batch(self, start: int = 0, stop: int = None):
+        """Return the samples as an Arrow record batch. The batch shares the
+        memory of the buffer like arrays() does. Needs pyarrow.
+
+        Args:
+            start (int, optional): First sample to include. Defaults to 0.
+            stop (int, optional): Sample to stop before. Defaults to the
+                number of samples in the buffer.
+
+        Returns:
+            pyarrow.RecordBatch: One float64 column per buffer column.
+        """
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("pyarrow is needed to export Arrow record batches.")
+        arrays = self.arrays(start, stop)
+        return pa.RecordBatch.from_arrays(
+            [pa.array(values) for values in arrays.values()], names=list(arrays)
+        )
+
+    def to_dataframe(self, start: int = 0, stop: int = None) -> pd.DataFrame:
+        """Copy the samples into a pandas dataframe.
+
+        Args:
+            start (int, optional): First sample to include. Defaults to 0.
+            stop (int, optional): Sample to stop before. Defaults to the
+                number of samples in the buffer.
+
+        Returns:
+            pd.DataFrame: Dataframe with one column per buffer column.
+        """
+        stop = self._length if stop is None else min(stop, self._length)
+        return pd.DataFrame(
+            {
+                name: self._data[i, start:stop].copy()
+                for i, name in enumerate(self.columns)
+            }
+        )
+
+    def clear(self) -> None:
+        """Remove all samples and release memory beyond the initial capacity.
+        Samples not yet sent to an attached sink are sent first."""
+        self.flush()
+        self._flushed = 0
+        # Always new memory, so the views of arrays() keep the old samples
+        self._data = np.empty(
+            (len(self.columns), self._initial_capacity), dtype=np.float64
+        )
+        self._length = 0
@@ -0,0 +1,304 @@
+# Calibration of the peristaltic pumps.
+#
+# A pump is calibrated by weighing the water it dispenses in a given time.
+# The measurements (pump, time, mass, temperature) come from measure_pumps(),
+# which runs the pumps on the Arduino and reads a scale, or from a CSV file.
+# The mass is converted to a volume with the density of water at the measured
+# temperature, and fit_pumps() fits the model of Arduino.pump_time()
+#     time_on = slope * volume + intercept
+# to the measurements of all pumps at once by least squares.
+#
+# The calibration file holds the latest model of each pump and the models it
+# replaced, so the drift of the pumps can be followed:
+#     {"version": 1,
+#      "pumps": {"0": {"slope [s/ml]": 2.05, "intercept [s]": 0.08, ...}},
+#      "history": {"0": [earlier models of pump 0, oldest first]}}
+# Arduino(calibration_file=...) loads it at startup.
+
+import json
+import logging
+import os
+import random
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+LOGGER = logging.getLogger(__name__)
+
+CALIBRATION_VERSION = 1
+MEASUREMENT_COLUMNS = ("Pump", "Time [s]", "Mass [g]", "Temperature [C]")
+# Relative change of the slope between two calibrations that is logged as a
+# warning, eg. a worn pump tube
+MAX_DRIFT = 0.1
+
+
+def water_density(temperature: np.ndarray) -> np.ndarray:
+    """Density of air-free water between 0 and 40 C by Tanaka et al.,
+    Metrologia 38 (2001) 301.
+
+    Args:
+        temperature (np.ndarray): Temperature in degree celsius.
+
+    Returns:
+        np.ndarray: Density in g/ml.
+    """
+    temperature = np.asarray(temperature, dtype=float)
+    return 0.99997495 * (
+        1
+        - (temperature - 3.983035) ** 2
+        * (temperature + 301.797)
+        / (522528.9 * (temperature + 69.34881))
+    )
+
+
+def load_measurements(path: str) -> pd.DataFrame:
+    """Read measurements from a CSV file with the MEASUREMENT_COLUMNS.
+
+    Args:
+        path (str): Path of the CSV file.
+
+    Raises:
+        ValueError: A column is missing.
+
+    Returns:
+        pd.DataFrame: The measurements.
+    """
+    measurements = pd.read_csv(path)
+    missing = [column for column in MEASUREMENT_COLUMNS if column not in measurements]
+    if missing:
+        raise ValueError(f"{path} has no column {', '.join(missing)}.")
+    return measurements[list(MEASUREMENT_COLUMNS)]
+
+
+def manual_scale(pump: int, seconds: float) -> float:
+    """Ask for the weight read on the scale.
+
+    Args:
+        pump (int): Pump number
+        seconds (float): Time the pump ran.
+
+    Returns:
+        float: Mass in g.
+    """
+    return float(input(f"Weight dispensed by pump {pump} in {seconds} s [g]: "))
+
+
+class SimulatedScale:
+    def __init__(
+        self,
+        pump_slope: dict,
+        pump_intercept: dict,
+        noise: float = 0.01,
+        temperature: float = 22.0,
+        seed: int = None,
+    ):
+        """Stand-in for a scale, which weighs what pumps with a known model
+        dispense, eg. to test the calibration without the robot.
+
+        Args:
+            pump_slope (dict): True slope of each pump in s/ml.
+            pump_intercept (dict): True intercept of each pump in s.
+            noise (float, optional): Standard deviation of the scale in g.
+                Defaults to 0.01.
+            temperature (float, optional): Temperature of the water in C.
+                Defaults to 22.0.
+            seed (int, optional): Seed of the noise. Defaults to None.
+        """
+        self.pump_slope = pump_slope
+        self.pump_intercept = pump_intercept
+        self.noise = noise
+        self.temperature = temperature
+        self.random = random.Random(seed)
+
+    def __call__(self, pump: int, seconds: float) -> float:
+        volume = max(seconds - self.pump_intercept[pump], 0) / self.pump_slope[pump]
+        mass = volume * float(water_density(self.temperature))
+        return mass + self.random.gauss(0, self.noise)
+
+
+def measure_pumps(
+    arduino,
+    pumps: list,
+    times: list = [0.5, 1, 2, 5, 10, 15],
+    repeats: int = 3,
+    scale=manual_scale,
+    temperature: float = None,
+) -> pd.DataFrame:
+    """Run each pump for each time and weigh what it dispensed. Tare the
+    scale before each run.
+
+    Args:
+        arduino (Arduino): The Arduino the pumps are connected to.
+        pumps (list): Pump numbers
+        times (list, optional): Times in seconds to run the pumps.
+            Defaults to [0.5, 1, 2, 5, 10, 15].
+        repeats (int, optional): Runs of each time. Defaults to 3.
+        scale (callable, optional): Called with the pump and the time after
+            each run, returns the mass in g. Defaults to manual_scale.
+        temperature (float, optional): Temperature of the water in C.
+            Defaults to None, which reads the ambient temperature of
+            cartridge 0.
+
+    Returns:
+        pd.DataFrame: The measurements with the MEASUREMENT_COLUMNS.
+    """
+    rows = []
+    for pump in pumps:
+        for seconds in times:
+            for _ in range(repeats):
+                arduino.set_pump_on(pump, seconds)
+                mass = scale(pump, seconds)
+                if temperature is None:
+                    water_temperature = arduino.get_temperature0_ambient()
+                else:
+                    water_temperature = temperature
+                rows.append((pump, seconds, mass, water_temperature))
+                LOGGER.info(f"Pump {pump} dispensed {mass} g in {seconds} s")
+    return pd.DataFrame(rows, columns=list(MEASUREMENT_COLUMNS))
+
+
+def fit_pumps(measurements: pd.DataFrame) -> dict:
+    """Fit time_on = slope * volume + intercept for each pump by least
+    squares. All pumps are fitted at once from the sums of their
+    measurements.
+
+    Args:
+        measurements (pd.DataFrame): Measurements with the
+            MEASUREMENT_COLUMNS.
+
+    Raises:
+        ValueError: A pump has measurements of less than two times.
+
+    Returns:
+        dict: Model of each pump: "slope [s/ml]", "intercept [s]", and the
+        residual diagnostics "rmse [s]", "max residual [s]", "r2" and
+        "measurements".
+    """
+    pumps, index = np.unique(measurements["Pump"].to_numpy(), return_inverse=True)
+    time_on = measurements["Time [s]"].to_numpy(dtype=float)
+    volume = measurements["Mass [g]"].to_numpy(dtype=float) / water_density(
+        measurements["Temperature [C]"].to_numpy(dtype=float)
+    )
+
+    def sums(values: np.ndarray) -> np.ndarray:
+        return np.bincount(index, weights=values, minlength=len(pumps))
+
+    count = np.bincount(index, minlength=len(pumps))
+    mean_volume = sums(volume) / count
+    mean_time = sums(time_on) / count
+    volume_deviation = volume - mean_volume[index]
+    time_deviation = time_on - mean_time[index]
+    times = measurements.groupby(index)["Time [s]"].nunique().to_numpy()
+    if np.any(times < 2):
+        bad = ", ".join(str(pump) for pump in pumps[times < 2])
+        raise ValueError(f"Pump {bad} needs measurements of at least two times.")
+    spread = sums(volume_deviation**2)
+    slope = sums(volume_deviation * time_deviation) / spread
+    intercept = mean_time - slope * mean_volume
+
+    residual = time_on - (slope[index] * volume + intercept[index])
+    squared_residuals = sums(residual**2)
+    total = sums(time_deviation**2)
+    max_residual = np.zeros(len(pumps))
+    np.maximum.at(max_residual, index, np.abs(residual))
+    # Degrees of freedom of a line, a perfect fit if there are only two points
+    rmse = np.sqrt(squared_residuals / np.maximum(count - 2, 1))
+    r2 = 1 - squared_residuals / np.where(total > 0, total, np.inf)
+
+    return {
+        int(pump): {
+            "slope [s/ml]": float(slope[i]),
+            "intercept [s]": float(intercept[i]),
+            "rmse [s]": float(rmse[i]),
+            "max residual [s]": float(max_residual[i]),
+            "r2": float(r2[i]),
+            "measurements": int(count[i]),
+        }
+        for i, pump in enumerate(pumps)
+    }
+
+
+def read_calibration(path: str) -> dict:
+    """Read a calibration file.
+
+    Args:
+        path (str): Path of the calibration file.
+
+    Raises:
+        ValueError: The file is of a newer version.
+
+    Returns:
+        dict: The content, with "version", "pumps" and "history".
+    """
+    with open(path, "r") as f:
+        calibration = json.load(f)
+    if calibration.get("version", 0) > CALIBRATION_VERSION:
+        raise ValueError(
+            f"{path} has calibration version {calibration['version']}, "
+            f"this version reads up to {CALIBRATION_VERSION}."
+        )
+    return calibration
+
+
+def load_calibration(path: str) -> tuple:
+    """The pump coefficients of a calibration file, as used by Arduino.
+
+    Args:
+        path (str): Path of the calibration file.
+
+    Returns:
+        tuple: The dicts pump_slope and pump_intercept, by pump number.
+    """
+    pumps = read_calibration(path)["pumps"]
+    # A coefficient stored as a JSON integer, eg. edited by hand, is read as int
+    pump_slope = {
+        int(pump): float(model["slope [s/ml]"]) for pump, model in pumps.items()
+    }
+    pump_intercept = {
+        int(pump): float(model["intercept [s]"]) for pump, model in pumps.items()
+    }
+    return pump_slope, pump_intercept
+
+
+def save_calibration(models: dict, path: str) -> dict:
+    """Store the models of fit_pumps() in a calibration file. The models they
+    replace are moved to the history, and a change of the slope by more than
+    MAX_DRIFT is logged as a warning.
+
+    Args:
+        models (dict): Models by pump number, from fit_pumps().
+        path (str): Path of the calibration file, created if it does not
+            exist.
+
+    Returns:
+        dict: The content of the file.
+    """
+    if os.path.exists(path):
+        calibration = read_calibration(path)
+    else:
+        calibration = {"pumps": {}, "history": {}}
+    calibration["version"] = CALIBRATION_VERSION
+    calibrated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    for pump, model in models.items():
+        key = str(pump)
+        previous = calibration["pumps"].get(key)
+        model = dict(model, calibrated=calibrated, revision=1)
+        if previous is not None:
+            calibration["history"].setdefault(key, []).append(previous)
+            model["revision"] = previous.get("revision", 0) + 1
+            drift = model["slope [s/ml]"] / previous["slope [s/ml]"] - 1
+            message = (
+                f"Pump {pump}: slope {model['slope [s/ml]']:.4g} s/ml, "
+                f"{drift:+.1%} since {previous.get('calibrated')}"
+            )
+            if abs(drift) > MAX_DRIFT:
+                LOGGER.warning(message)
+            else:
+                LOGGER.info(message)
+        calibration["pumps"][key] = model
+
+    with open(path, "w") as f:
+        json.dump(calibration, f, indent=4)
+    LOGGER.info(f"Saved the calibration of pumps {list(models)} to {path}")
+    return calibration
@@ -0,0 +1,467 @@
+# Emulated Arduino firmware.
+#
+# ArduinoEmulator serves the command set of src/arduino/main/main.ino on a
+# pseudo-terminal, so ardu.Arduino can run without the robot:
+#
+#     with ArduinoEmulator(speed=10) as emulator:
+#         arduino = Arduino(port=emulator.port)
+#
+# Both the text protocol and the binary frames of framing.py are served, with
+# the relays, timed relay pulses, relay programs, setpoints, telemetry and the
+# temperature reads of the firmware. Each cartridge is a lumped thermal mass
+# heated through the solid state relay, which is driven by the same bang-bang
+# and PID rules as AutoPID in the firmware.
+#
+# Bytes are sent and received at the rate of the baud rate, like on the USB
+# serial adapter. speed runs the firmware clock faster than real time, eg. a
+# 5 s relay pulse takes 0.5 s at speed 10, while the serial timing stays real.
+# Linux and macOS only, as it needs the pty module.
+
+import os
+import random
+import select
+import struct
+import threading
+import time
+from openTron_electrodeposition import framing
+
+SENSOR_INTERVAL = 1.0  # s between temperature and PID updates
+PID_TIME_STEP = 1.2  # s, PID0.setTimeStep(1200)
+BANG_BANG = 2.0  # C, PID0.setBangBang(2)
+OUTPUT_MAX = 255
+TIMED_RELAYS = 9
+PROGRAM_STEPS = 12
+BUFFER_SIZE = 160
+
+
+class EmulatedCartridge:
+    def __init__(
+        self,
+        ambient_temperature: float = 22.0,
+        heater_power: float = 30.0,
+        heat_capacity: float = 150.0,
+        thermal_resistance: float = 1.5,
+        kp: float = 0.12,
+        ki: float = 0.5,
+        kd: float = 1.0,
+        noise: float = 0.02,
+        seed: int = None,
+    ):
+        """A heated cartridge with its PID controller.
+
+        Args:
+            ambient_temperature (float, optional): In C. Defaults to 22.0.
+            heater_power (float, optional): Power at 100 % duty cycle in W.
+                Defaults to 30.0.
+            heat_capacity (float, optional): Of the cartridge and the liquid
+                in J/K. Defaults to 150.0.
+            thermal_resistance (float, optional): To the ambient in K/W.
+                Defaults to 1.5.
+            kp (float, optional): As KP0 in the firmware. Defaults to 0.12.
+            ki (float, optional): As KI0 in the firmware. Defaults to 0.5.
+            kd (float, optional): As KD0 in the firmware. Defaults to 1.0.
+            noise (float, optional): Standard deviation of the sensor in C.
+                Defaults to 0.02.
+            seed (int, optional): Seed of the sensor noise. Defaults to None.
+        """
+        self.ambient_temperature = ambient_temperature
+        self.temperature = ambient_temperature
+        self.heater_power = heater_power
+        self.heat_capacity = heat_capacity
+        self.thermal_resistance = thermal_resistance
+        self.kp, self.ki, self.kd = kp, ki, kd
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.setpoint = 0.0
+        self.output = 0.0
+        self.duty_cycle = 0  # 120 = 100 %
+        self._integral = 0.0
+        self._previous_error = 0.0
+        self._last_step = 0.0
+
+    def heat(self, dt: float) -> None:
+        """Advance the temperature by dt seconds at the current duty cycle."""
+        power = self.heater_power * self.duty_cycle / 120
+        loss = (self.temperature - self.ambient_temperature) / self.thermal_resistance
+        self.temperature += (power - loss) * dt / self.heat_capacity
+
+    def run_pid(self, now: float, temperature: float) -> None:
+        """One update of AutoPID with bang-bang control, at the firmware time
+        now in s."""
+        if temperature < self.setpoint - BANG_BANG:
+            self.output = OUTPUT_MAX
+            self._last_step = now
+        elif temperature > self.setpoint + BANG_BANG:
+            self.output = 0
+            self._last_step = now
+        elif now - self._last_step >= PID_TIME_STEP:
+            dt = (now - self._last_step) * 1000
+            self._last_step = now
+            error = self.setpoint - temperature
+            self._integral += (error + self._previous_error) / 2 * dt / 1000
+            derivative = (error - self._previous_error) / dt / 1000
+            self._previous_error = error
+            pid = self.kp * error + self.ki * self._integral + self.kd * derivative
+            self.output = min(max(pid, 0), 1) * OUTPUT_MAX
+        self.duty_cycle = int(self.output / 255 * 120) if self.output > 0 else 0
+
+    def sample_temperature(self) -> float:
+        return self.temperature + self.random.gauss(0, self.noise)
+
+
+class ArduinoEmulator:
+    def __init__(
+        self,
+        baudrate: int = 115200,
+        speed: float = 1.0,
+        cartridges: list = None,
+    ):
+        """Emulated firmware on a pseudo-terminal.
+
+        Args:
+            baudrate (int, optional): Baud rate of the serial timing, 10 bits
+                per byte. None for no serial delay. Defaults to 115200.
+            speed (float, optional): Speed of the firmware clock relative to
+                real time. Defaults to 1.0.
+            cartridges (list, optional): The two EmulatedCartridge of the
+                firmware. Defaults to two with the default settings.
+        """
+        self.baudrate = baudrate
+        self.speed = speed
+        self.cartridges = cartridges or [EmulatedCartridge(), EmulatedCartridge()]
+        self.relays = [False] * 10
+        self.port = None
+        self.received = 0
+        self.sent = 0
+        self.commands = 0
+        self._thread = None
+        self._running = False
+        self._reset_requested = False
+
+    def __enter__(self) -> "ArduinoEmulator":
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def start(self) -> str:
+        """Open the pseudo-terminal and start the firmware.
+
+        Returns:
+            str: The port to connect to, eg. "/dev/pts/3".
+        """
+        import pty
+        import tty
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._start = time.monotonic()
+        self._reset()
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="ArduinoEmulator", daemon=True
+        )
+        self._thread.start()
+        return self.port
+
+    def stop(self) -> None:
+        """Stop the firmware and close the pseudo-terminal."""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            os.close(self._master)
+            os.close(self._slave)
+
+    def reset(self) -> None:
+        """Reset the firmware, like opening the port of a board without the
+        capacitor between RESET and GND. Relay pulses, programs and the mode
+        are lost and the boot banner is sent again."""
+        self._reset_requested = True
+
+    def millis(self) -> int:
+        """The firmware clock in ms."""
+        return int((time.monotonic() - self._start) * self.speed * 1000)
+
+    def _reset(self) -> None:
+        self.binary_mode = False
+        self.telemetry = False
+        self._text = None
+        self._frame = None
+        self._frame_started = 0.0
+        self._pulses = {}  # relay: (start, duration) in ms
+        self._program = None
+        self._last_sensor_update = 0
+        self._last_heat = 0
+        self._input = b""
+        self._input_budget = 0.0
+        self._output = b""
+        self._output_budget = 0.0
+        self._last_io = time.monotonic()
+        # Like the globals of the firmware until the first sensor update
+        self.temperatures = [0.0, 0.0]
+        self._println("Ready")
+
+    def _run(self) -> None:
+        while self._running:
+            if self._reset_requested:
+                self._reset_requested = False
+                self._reset()
+            self._transfer()
+            now = self.millis()
+            if now - self._last_sensor_update >= SENSOR_INTERVAL * 1000:
+                self._last_sensor_update = now
+                self._update_sensors(now)
+            self._update_relay_timers(now)
+            self._update_program(now)
+
+    def _transfer(self) -> None:
+        """Move bytes between the pseudo-terminal and the firmware at the rate
+        of the baud rate."""
+        readable, _, _ = select.select([self._master], [], [], 0.0005)
+        if readable:
+            try:
+                self._input += os.read(self._master, 4096)
+            except OSError:
+                return
+        now = time.monotonic()
+        elapsed, self._last_io = now - self._last_io, now
+        if self.baudrate is None:
+            count, sent = len(self._input), len(self._output)
+        else:
+            # 10 bits per byte. The line can't save up time while it is idle.
+            credit = elapsed * self.baudrate / 10
+            self._input_budget = min(self._input_budget + credit, len(self._input))
+            self._output_budget = min(self._output_budget + credit, len(self._output))
+            count, sent = int(self._input_budget), int(self._output_budget)
+            self._input_budget -= count
+            self._output_budget -= sent
+        data, self._input = self._input[:count], self._input[count:]
+        for byte in data:
+            self._receive(byte)
+        self.received += len(data)
+        if self._output and sent:
+            data, self._output = self._output[:sent], self._output[sent:]
+            os.write(self._master, data)
+            self.sent += len(data)
+
+    def _write(self, data: bytes) -> None:
+        self._output += data
+
+    def _println(self, text) -> None:
+        self._write(f"{text}\r\n".encode())
+
+    def _receive(self, byte: int) -> None:
+        """get_data_from_pc() of the firmware, for one byte."""
+        if self._frame is not None and time.monotonic() - self._frame_started > 0.1:
+            self._frame = None
+        if self._frame is not None:
+            self._frame.append(byte)
+            if len(self._frame) == 3 and self._frame[2] > BUFFER_SIZE - 4:
+                self._frame = None
+            elif len(self._frame) >= 3 and len(self._frame) == self._frame[2] + 4:
+                frame, self._frame = bytes(self._frame), None
+                self._parse_frame(frame)
+            return
+        if self._text is None and byte == framing.SYNC:
+            self._frame = bytearray()
+            self._frame_started = time.monotonic()
+            return
+        if byte == ord(">") and self._text is not None:
+            text, self._text = self._text, None
+            self._parse_data(text.decode(errors="replace"))
+        elif self._text is not None:
+            if len(self._text) < BUFFER_SIZE - 1:
+                self._text += bytes([byte])
+        if byte == ord("<"):
+            self._text = b""
+
+    def _update_sensors(self, now: int) -> None:
+        """update_sensors() of the firmware: heat the cartridges, run the PID
+        controllers and send the telemetry."""
+        dt = (now - self._last_heat) / 1000
+        self._last_heat = now
+        self.temperatures = []
+        for cartridge in self.cartridges:
+            cartridge.heat(dt)
+            temperature = cartridge.sample_temperature()
+            cartridge.run_pid(now / 1000, temperature)
+            self.temperatures.append(temperature)
+        if self.telemetry:
+            values = self.temperatures + [
+                cartridge.ambient_temperature for cartridge in self.cartridges
+            ]
+            values += [cartridge.setpoint for cartridge in self.cartridges]
+            values += [cartridge.duty_cycle for cartridge in self.cartridges]
+            if self.binary_mode:
+                payload = struct.pack("<I8f", now & 0xFFFFFFFF, *values)
+                self._write(framing.encode_frame(0, framing.TELEMETRY_FRAME, payload))
+            else:
+                text = ",".join(f"{value:.2f}" for value in values[:6])
+                duty = ",".join(str(int(value)) for value in values[6:])
+                self._println(f"T,{now},{text},{duty}")
+
+    def _temperature(self, sensor: int) -> float:
+        if sensor < 2:
+            return self.temperatures[sensor]
+        return self.cartridges[sensor - 2].ambient_temperature
+
+    def _switch_relay(self, relay_num: int, on: bool) -> None:
+        if 0 <= relay_num <= 8:
+            self.relays[relay_num] = on
+
+    def _relay_state(self, relay_num: int) -> int:
+        # Like the firmware, relay 8 and 9 report the solid state relays of
+        # the heaters
+        if relay_num in (8, 9):
+            return int(self.cartridges[relay_num - 8].duty_cycle > 0)
+        return int(0 <= relay_num <= 7 and self.relays[relay_num])
+
+    def _start_pulse(self, relay_num: int, time_ms: int) -> None:
+        if 0 <= relay_num < TIMED_RELAYS:
+            self._switch_relay(relay_num, True)
+            self._pulses[relay_num] = (self.millis(), time_ms)
+        else:
+            self._finish_pulse(relay_num)
+
+    def _finish_pulse(self, relay_num: int) -> None:
+        self._pulses.pop(relay_num, None)
+        if self.binary_mode:
+            payload = bytes([relay_num & 0xFF])
+            self._write(framing.encode_frame(0, framing.RELAY_DONE, payload))
+        else:
+            self._println(f"#{relay_num}")
+
+    def _update_relay_timers(self, now: int) -> None:
+        for relay_num, (start, duration) in list(self._pulses.items()):
+            if now - start >= duration:
+                self._switch_relay(relay_num, False)
+                self._finish_pulse(relay_num)
+
+    def _start_program(self, steps: list) -> None:
+        self._stop_program()
+        # [relay, start, duration, on at, off at]
+        self._program = (self.millis(), [[*step, None, None] for step in steps])
+
+    def _stop_program(self) -> None:
+        if self._program is not None:
+            for relay_num, _, _, on_at, off_at in self._program[1]:
+                if on_at is not None and off_at is None:
+                    self._switch_relay(relay_num, False)
+        self._program = None
+
+    def _update_program(self, now: int) -> None:
+        if self._program is None:
+            return
+        started, steps = self._program
+        elapsed = now - started
+        for step in steps:
+            relay_num, start, duration, on_at, off_at = step
+            if on_at is None and elapsed >= start:
+                self._switch_relay(relay_num, True)
+                step[3] = on_at = elapsed
+            if on_at is not None and off_at is None and elapsed - on_at >= duration:
+                self._switch_relay(relay_num, False)
+                step[4] = elapsed
+        if all(step[4] is not None for step in steps):
+            self._program = None
+            times = [value for step in steps for value in step[3:]]
+            if self.binary_mode:
+                payload = struct.pack(f"<{len(times)}I", *times)
+                self._write(framing.encode_frame(0, framing.PROGRAM_DONE, payload))
+            else:
+                self._println(",".join(["P"] + [str(value) for value in times]))
+
+    def _set_setpoint(self, cartridge: int, tenths: int) -> None:
+        if cartridge in (0, 1):
+            self.cartridges[cartridge].setpoint = tenths / 10
+
+    def _parse_data(self, text: str) -> None:
+        """parse_data() of the firmware, for the text protocol."""
+        self.commands += 1
+        name, *args = text.split(",")
+        try:
+            values = [int(float(value)) for value in args]
+        except ValueError:
+            values = []
+        if name == "set_relay_on_time" and len(values) >= 2:
+            self._println("#")
+            self._start_pulse(values[0], values[1])
+        elif name in ("set_relay_on", "set_relay_off") and values:
+            self._switch_relay(values[0], name == "set_relay_on")
+            if name == "set_relay_off" and values[0] in self._pulses:
+                self._finish_pulse(values[0])
+            self._println("#")
+        elif name == "program":
+            self._start_program(
+                [values[i : i + 3] for i in range(0, len(values) - 2, 3)][
+                    :PROGRAM_STEPS
+                ]
+            )
+            self._println("#")
+        elif name == "binary":
+            self._println("#")
+            self.binary_mode = bool(values and values[0])
+        elif name == "ping":
+            self._println("#")
+        elif name == "telemetry":
+            self.telemetry = bool(values and values[0])
+            self._println("#")
+        elif name in framing.TEMPERATURE_SENSORS:
+            sensor = framing.TEMPERATURE_SENSORS[name]
+            self._println(f"{self._temperature(sensor):.2f}")
+        elif name in ("setpoint0", "setpoint1") and values:
+            self._set_setpoint(int(name[-1]), values[0])
+        elif name.startswith("get_relay_") and name.endswith("_state"):
+            self._println(self._relay_state(int(name[10:-6])))
+        else:
+            self._println(f"Unknown command: {name}")
+
+    def _parse_frame(self, frame: bytes) -> None:
+        """parse_frame() of the firmware, for the binary protocol."""
+        sequence, opcode, length = frame[0], frame[1], frame[2]
+        payload = frame[3 : 3 + length]
+        if framing.crc8(frame[:-1]) != frame[-1]:
+            return
+        self.commands += 1
+        if len(payload) < framing.payload_length(opcode, payload):
+            self._write(framing.encode_frame(sequence, framing.ERROR, bytes([opcode])))
+            return
+        reply = b""
+        if opcode == framing.RELAY_ON:
+            self._switch_relay(payload[0], True)
+        elif opcode == framing.RELAY_OFF:
+            self._switch_relay(payload[0], False)
+            if payload[0] in self._pulses:
+                self._finish_pulse(payload[0])
+        elif opcode == framing.RELAY_ON_TIME:
+            relay_num, time_ms = struct.unpack("<BI", payload)
+            self._write(framing.encode_frame(sequence, opcode | framing.REPLY))
+            self._start_pulse(relay_num, time_ms)
+            return
+        elif opcode == framing.RELAY_STATE:
+            reply = bytes([self._relay_state(payload[0])])
+        elif opcode == framing.READ_TEMPERATURE:
+            reply = struct.pack("<f", self._temperature(payload[0]))
+        elif opcode == framing.SETPOINT:
+            self._set_setpoint(*struct.unpack("<Bh", payload))
+        elif opcode == framing.PROGRAM:
+            steps = [
+                list(struct.unpack("<BII", payload[1 + 9 * i : 10 + 9 * i]))
+                for i in range(min(payload[0], PROGRAM_STEPS))
+            ]
+            self._start_program(steps)
+        elif opcode == framing.TELEMETRY:
+            self.telemetry = bool(payload[0])
+        elif opcode == framing.MODE:
+            self._write(framing.encode_frame(sequence, opcode | framing.REPLY))
+            self.binary_mode = bool(payload[0])
+            return
+        elif opcode == framing.PING:
+            pass
+        else:
+            self._write(framing.encode_frame(sequence, framing.ERROR, bytes([opcode])))
+            return
+        self._write(framing.encode_frame(sequence, opcode | framing.REPLY, reply))
@@ -0,0 +1,239 @@
+# Binary framing of the serial protocol between ardu.Arduino and the firmware.
+#
+# A frame is
+#     0xA5 | sequence | opcode | length | payload (length bytes) | CRC-8
+# with the CRC-8 (polynomial 0x07, initial value 0) over sequence, opcode,
+# length and payload. Numbers in the payload are little endian, temperatures
+# are 32 bit floats. The Arduino answers a command with a frame of the same
+# sequence number and the opcode | REPLY, or with ERROR if it does not know
+# the command. Events, like the end of a relay pulse, have sequence number 0.
+#
+# The commands keep the names of the text protocol, eg. "set_relay_on,3", and
+# are translated by encode_command(), so the text protocol "<command>" remains
+# available as a compatibility mode. The firmware switches to binary events
+# after the text command "<binary,1>".
+
+import re
+import struct
+
+SYNC = 0xA5
+REPLY = 0x80
+MAX_PAYLOAD = 156  # Fits in the input buffer of the firmware
+
+# Commands
+RELAY_ON = 0x01
+RELAY_OFF = 0x02
+RELAY_ON_TIME = 0x03
+RELAY_STATE = 0x04
+READ_TEMPERATURE = 0x05
+SETPOINT = 0x06
+PROGRAM = 0x07
+TELEMETRY = 0x08
+MODE = 0x09
+PING = 0x0A
+# Events and errors
+RELAY_DONE = 0x41
+PROGRAM_DONE = 0x42
+TELEMETRY_FRAME = 0x43
+ERROR = 0x7F
+
+# Opcodes of the frames the firmware sends
+RECEIVED_OPCODES = {
+    opcode | REPLY
+    for opcode in (
+        RELAY_ON,
+        RELAY_OFF,
+        RELAY_ON_TIME,
+        RELAY_STATE,
+        READ_TEMPERATURE,
+        SETPOINT,
+        PROGRAM,
+        TELEMETRY,
+        MODE,
+        PING,
+    )
+} | {RELAY_DONE, PROGRAM_DONE, TELEMETRY_FRAME, ERROR}
+
+TEMPERATURE_SENSORS = {
+    "read_temp0": 0,
+    "read_temp1": 1,
+    "read_temp0_ambient": 2,
+    "read_temp1_ambient": 3,
+}
+
+
+def _crc8_table() -> list:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07 if crc & 0x80 else crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+
+CRC8_TABLE = _crc8_table()
+
+
+def crc8(data: bytes) -> int:
+    """CRC-8 with the polynomial 0x07 and initial value 0."""
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def encode_frame(sequence: int, opcode: int, payload: bytes = b"") -> bytes:
+    """Encode a frame.
+
+    Args:
+        sequence (int): Sequence number, 1-255 for commands
+        opcode (int): Opcode of the command
+        payload (bytes, optional): Payload. Defaults to b"".
+
+    Returns:
+        bytes: The frame
+    """
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"The payload can have at most {MAX_PAYLOAD} bytes.")
+    body = bytes([sequence, opcode, len(payload)]) + payload
+    return bytes([SYNC]) + body + bytes([crc8(body)])
+
+
+def encode_command(command: str) -> tuple:
+    """Translate a command of the text protocol to a binary command.
+
+    Args:
+        command (str): The command without the start and end markers, eg.
+            "set_relay_on_time,3,2100.0".
+
+    Raises:
+        ValueError: The command has no binary equivalent.
+
+    Returns:
+        tuple: The opcode and the payload.
+    """
+    name, *args = command.split(",")
+    if name == "set_relay_on":
+        return RELAY_ON, struct.pack("<B", int(args[0]))
+    if name == "set_relay_off":
+        return RELAY_OFF, struct.pack("<B", int(args[0]))
+    if name == "set_relay_on_time":
+        return RELAY_ON_TIME, struct.pack("<BI", int(args[0]), round(float(args[1])))
+    if name in TEMPERATURE_SENSORS:
+        return READ_TEMPERATURE, struct.pack("<B", TEMPERATURE_SENSORS[name])
+    if name.startswith("setpoint"):
+        return SETPOINT, struct.pack("<Bh", int(name[8:]), round(float(args[0])))
+    if name == "program":
+        values = [round(float(value)) for value in args]
+        steps = list(zip(values[0::3], values[1::3], values[2::3]))
+        return PROGRAM, struct.pack("<B", len(steps)) + b"".join(
+            struct.pack("<BII", *step) for step in steps
+        )
+    if name == "telemetry":
+        return TELEMETRY, struct.pack("<B", int(args[0]))
+    if name == "binary":
+        return MODE, struct.pack("<B", int(args[0]))
+    if name == "ping":
+        return PING, b""
+    match = re.fullmatch(r"get_relay_(\d+)_state", name)
+    if match:
+        return RELAY_STATE, struct.pack("<B", int(match.group(1)))
+    raise ValueError(f"No binary command for {command}")
+
+
+def payload_length(opcode: int, payload: bytes) -> int:
+    """The bytes of payload a command needs, as checked by the firmware
+    before it acts on a frame.
+
+    Args:
+        opcode (int): Opcode of the command
+        payload (bytes): Payload of the frame
+
+    Returns:
+        int: The minimum length of the payload.
+    """
+    if opcode == RELAY_ON_TIME:
+        return 5
+    if opcode == SETPOINT:
+        return 3
+    if opcode == PROGRAM:
+        return 1 + 9 * payload[0] if payload else 1
+    if opcode == PING:
+        return 0
+    return 1
+
+
+def decode_response(response: str, payload: bytes):
+    """Decode the payload of a reply.
+
+    Args:
+        response (str): The kind of response, as in Arduino.send_command()
+        payload (bytes): The payload of the reply
+
+    Returns:
+        None for "done", a float for "value" and a bool for "state".
+    """
+    if response == "value":
+        return struct.unpack("<f", payload)[0]
+    if response == "state":
+        return bool(payload[0])
+    return None
+
+
+class StreamParser:
+    def __init__(self):
+        """Split the bytes from the serial port into binary frames and text
+        lines. Frames with a wrong CRC are dropped and the parser resyncs on
+        the next sync byte, so stray text of the firmware never ends up in a
+        reply."""
+        self._buffer = bytearray()
+        self.dropped = 0
+
+    def feed(self, data: bytes) -> list:
+        """Add received bytes.
+
+        Args:
+            data (bytes): Bytes from the serial port
+
+        Returns:
+            list: The complete messages, tuples (sequence, opcode, payload)
+            for frames and str for text lines.
+        """
+        buffer = self._buffer
+        buffer += data
+        messages = []
+        while buffer:
+            if buffer[0] == SYNC:
+                if len(buffer) < 4:
+                    break
+                if buffer[2] not in RECEIVED_OPCODES or buffer[3] > MAX_PAYLOAD:
+                    # A sync byte in text or in a corrupted frame
+                    self.dropped += 1
+                    del buffer[0]
+                    continue
+                end = 5 + buffer[3]
+                if len(buffer) < end:
+                    break
+                if crc8(buffer[1 : end - 1]) != buffer[end - 1]:
+                    # Not a frame, or a corrupted one
+                    self.dropped += 1
+                    del buffer[0]
+                    continue
+                messages.append((buffer[1], buffer[2], bytes(buffer[4 : end - 1])))
+                del buffer[:end]
+            else:
+                newline = buffer.find(b"\n")
+                sync = buffer.find(SYNC)
+                if 0 <= sync and (newline < 0 or sync < newline):
+                    # Text interrupted by a frame
+                    end, skip = sync, 0
+                elif newline >= 0:
+                    end, skip = newline, 1
+                else:
+                    break
+                line = buffer[:end].decode(errors="replace").strip()
+                if line:
+                    messages.append(line)
+                del buffer[: end + skip]
+        return messages
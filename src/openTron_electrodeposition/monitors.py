@@ -0,0 +1,305 @@
+# Online monitors for the elements (measurements) of a potentiostat experiment.
+#
+# A monitor is fed every sample of the element it is attached to from the
+# AdmiralSquidstatWrapper data callbacks. Returning True from update_dc() or
+# update_ac() ends the element early. All monitors do a constant amount of work
+# per sample.
+
+import collections
+import math
+
+
+class ElementMonitor:
+    """Base class of the monitors. A monitor is reset when its element starts."""
+
+    name = "monitor"
+
+    def reset(self) -> None:
+        """Forget all samples of a previous element."""
+
+    def update_dc(self, timestamp: float, voltage: float, current: float) -> bool:
+        """Feed a DC sample.
+
+        Returns:
+            bool: True if the element should be ended.
+        """
+        return False
+
+    def update_ac(
+        self, timestamp: float, frequency: float, real: float, imaginary: float
+    ) -> bool:
+        """Feed an AC sample.
+
+        Returns:
+            bool: True if the element should be ended.
+        """
+        return False
+
+    def summary(self) -> dict:
+        """Results of the monitor for the metadata."""
+        return {}
+
+
+class RollingLinearFit:
+    def __init__(self, window: float):
+        """Least squares line through the samples of the last window seconds,
+        updated with running sums.
+
+        Args:
+            window (float): Length of the rolling window in seconds.
+        """
+        self.window = window
+        self.reset()
+
+    def reset(self) -> None:
+        self._samples = collections.deque()
+        self._t0 = None
+        self._v0 = None
+        self._sums = [0.0, 0.0, 0.0, 0.0, 0.0]  # t, v, t*t, t*v, v*v
+        self.elapsed = 0.0
+        self.slope = math.nan
+        self.std = math.nan
+
+    def add(self, timestamp: float, value: float) -> bool:
+        """Add a sample and update the fit.
+
+        Returns:
+            bool: True if the window is filled and the fit was updated.
+        """
+        if self._t0 is None:
+            self._t0 = timestamp
+            self._v0 = value
+        # Shift the samples to the first sample to keep the sums accurate
+        t = timestamp - self._t0
+        v = value - self._v0
+        self._add(t, v, 1)
+        self._samples.append((t, v))
+        while t - self._samples[0][0] > self.window:
+            self._add(*self._samples.popleft(), -1)
+        self.elapsed = t
+
+        n = len(self._samples)
+        if n < 3 or t - self._samples[0][0] < 0.9 * self.window:
+            return False
+        sum_t, sum_v, sum_tt, sum_tv, sum_vv = self._sums
+        denominator = n * sum_tt - sum_t * sum_t
+        if denominator <= 0:
+            return False
+        self.slope = (n * sum_tv - sum_t * sum_v) / denominator
+        self.std = math.sqrt(max(sum_vv / n - (sum_v / n) ** 2, 0.0))
+        return True
+
+    def _add(self, t: float, v: float, sign: int) -> None:
+        self._sums[0] += sign * t
+        self._sums[1] += sign * v
+        self._sums[2] += sign * t * t
+        self._sums[3] += sign * t * v
+        self._sums[4] += sign * v * v
+
+
+class SteadyStateDetector(ElementMonitor):
+    name = "steady_state"
+
+    def __init__(
+        self,
+        window: float = 15,
+        max_slope: float = 2e-4,
+        max_std: float = 2e-3,
+        min_duration: float = 30,
+    ):
+        """Detect that the potential of a constant current step is stable, by
+        a least squares fit of the potential over a rolling time window.
+
+        Args:
+            window (float, optional): Length of the rolling window in seconds.
+                Defaults to 15.
+            max_slope (float, optional): Largest absolute slope of the
+                potential in V/s that counts as stable. Defaults to 2e-4.
+            max_std (float, optional): Largest standard deviation of the
+                potential in V within the window that counts as stable.
+                Defaults to 2e-3.
+            min_duration (float, optional): The element is never ended before
+                this many seconds. Defaults to 30.
+        """
+        self.fit = RollingLinearFit(window)
+        self.max_slope = max_slope
+        self.max_std = max_std
+        self.min_duration = min_duration
+
+    def reset(self) -> None:
+        self.fit.reset()
+
+    def update_dc(self, timestamp: float, voltage: float, current: float) -> bool:
+        if not self.fit.add(timestamp, voltage):
+            return False
+        return (
+            self.fit.elapsed >= self.min_duration
+            and abs(self.fit.slope) <= self.max_slope
+            and self.fit.std <= self.max_std
+        )
+
+    def summary(self) -> dict:
+        return {
+            "duration [s]": self.fit.elapsed,
+            "slope [V/s]": self.fit.slope,
+            "std [V]": self.fit.std,
+        }
+
+
+class DriftDetector(ElementMonitor):
+    name = "drift"
+
+    def __init__(
+        self,
+        max_drift: float = 1e-4,
+        window: float = 10,
+        min_duration: float = 30,
+        max_duration: float = 120,
+    ):
+        """Detect that the open circuit potential has stabilised, ie. that its
+        drift rate dV/dt over a rolling time window is below a threshold.
+
+        Args:
+            max_drift (float, optional): Largest absolute drift rate in V/s
+                that counts as stable. Defaults to 1e-4.
+            window (float, optional): Length of the rolling window in seconds.
+                Defaults to 10.
+            min_duration (float, optional): The element is never ended before
+                this many seconds. Defaults to 30.
+            max_duration (float, optional): Duration of the element in
+                seconds, which ends it even if the potential still drifts.
+                Used to report the time saved. Defaults to 120.
+        """
+        self.fit = RollingLinearFit(window)
+        self.max_drift = max_drift
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+
+    def reset(self) -> None:
+        self.fit.reset()
+
+    def update_dc(self, timestamp: float, voltage: float, current: float) -> bool:
+        if not self.fit.add(timestamp, voltage):
+            return False
+        return (
+            self.min_duration <= self.fit.elapsed < self.max_duration
+            and abs(self.fit.slope) <= self.max_drift
+        )
+
+    def summary(self) -> dict:
+        return {
+            "duration [s]": self.fit.elapsed,
+            "drift [V/s]": self.fit.slope,
+            "time saved [s]": max(self.max_duration - self.fit.elapsed, 0.0),
+        }
+
+
+class ChargeCounter(ElementMonitor):
+    name = "charge"
+
+    def __init__(self, target_charge: float = None):
+        """Integrate the absolute current over time with the trapezoidal rule
+        to count the charge passed during the element.
+
+        Args:
+            target_charge (float, optional): Charge in C that ends the element
+                once it has been passed. Defaults to None, which only counts.
+        """
+        self.target_charge = target_charge
+        self.reset()
+
+    def reset(self) -> None:
+        self.charge = 0.0
+        self.duration = 0.0
+        self._t0 = None
+        self._last = None
+
+    def update_dc(self, timestamp: float, voltage: float, current: float) -> bool:
+        if current is None or math.isnan(current):
+            return False
+        current = abs(current)
+        if self._last is None:
+            self._t0 = timestamp
+        else:
+            last_timestamp, last_current = self._last
+            self.charge += 0.5 * (current + last_current) * (timestamp - last_timestamp)
+        self._last = (timestamp, current)
+        self.duration = timestamp - self._t0
+        return self.target_charge is not None and self.charge >= self.target_charge
+
+    def summary(self) -> dict:
+        return {"charge [C]": self.charge, "duration [s]": self.duration}
+
+
+class OhmicInterceptEstimator(ElementMonitor):
+    name = "ohmic_intercept"
+
+    def __init__(self, max_points: int = 10, truncate: bool = False):
+        """Estimate the ohmic resistance from the high frequency end of an EIS
+        sweep while it is measured. The estimate is the real impedance where
+        the imaginary impedance crosses zero, interpolated linearly between
+        the two points around the crossing. Without a crossing within the
+        first max_points frequencies, the point with the smallest absolute
+        imaginary impedance is used, like Experiment.find_ohmic_resistance().
+        Points with a zero real or imaginary impedance are skipped, as there.
+
+        Args:
+            max_points (int, optional): Number of frequencies, from the start
+                of the sweep, to look for the intercept in. Defaults to 10.
+            truncate (bool, optional): End the sweep as soon as the ohmic
+                resistance is found. Defaults to False.
+        """
+        self.max_points = max_points
+        self.truncate = truncate
+        self.reset()
+
+    def reset(self) -> None:
+        self.points = 0
+        self.ohmic_resistance = math.nan
+        self.frequency = math.nan
+        self.method = None
+        self._last = None
+        self._smallest = None
+
+    def update_ac(
+        self, timestamp: float, frequency: float, real: float, imaginary: float
+    ) -> bool:
+        # Skipped like the rows with a zero in find_ohmic_resistance()
+        if self.method is not None or real == 0 or imaginary == 0:
+            return False
+        self.points += 1
+        if self._smallest is None or abs(imaginary) < abs(self._smallest[2]):
+            self._smallest = (frequency, real, imaginary)
+        if self._last is not None and self._last[2] * imaginary <= 0:
+            last_frequency, last_real, last_imaginary = self._last
+            if imaginary == last_imaginary:
+                fraction = 0.0
+            else:
+                fraction = last_imaginary / (last_imaginary - imaginary)
+            self.ohmic_resistance = last_real + fraction * (real - last_real)
+            self.frequency = last_frequency + fraction * (frequency - last_frequency)
+            self.method = "crossing"
+        elif self.points >= self.max_points:
+            self.frequency, self.ohmic_resistance, _ = self._smallest
+            self.method = "minimum"
+        self._last = (frequency, real, imaginary)
+        return self.truncate and self.method is not None
+
+    def summary(self) -> dict:
+        if self.method is None and self._smallest is not None:
+            # The sweep had fewer than max_points frequencies
+            self.frequency, self.ohmic_resistance, _ = self._smallest
+            self.method = "minimum"
+        return {
+            "ohmic_resistance [ohm]": self.ohmic_resistance,
+            "intercept_frequency [Hz]": self.frequency,
+            "intercept_method": self.method,
+        }
+
+
+MONITORS = {
+    SteadyStateDetector.name: SteadyStateDetector,
+    DriftDetector.name: DriftDetector,
+    ChargeCounter.name: ChargeCounter,
+    OhmicInterceptEstimator.name: OhmicInterceptEstimator,
+}
@@ -1,3 +1,5 @@
+import os
+
 list_of_pump_relays = [0, 1, 2, 3, 4, 5]  # Pumps connected to which relays
 list_of_ultrasonic_relays = [6, 7]  # Ultrasonic connected to which relays
 OHMIC_CORRECTION_FACTOR = 0.9
@@ -112,3 +114,9 @@ pipette_tips = {
 
 pump_slope = {0: 2.05, 1: 2.13, 2: 1.93, 3: 2.24, 4: 1.86, 5: 1.85} # XXX
 pump_intercept = {0: 0.082, 1: 0.058, 2: 0.0686, 3: 0.0362, 4: 0.0356, 5: 0.0186} # XXX
+# Measured pump models by example/example_arduino_pump_calibration.py, which
+# replace the values above for the pumps it has calibrated. Next to this file,
+# so it does not depend on the working directory
+pump_calibration_file = os.path.join(
+    os.path.dirname(__file__), "pump_calibration.json"
+)
@@ -0,0 +1,184 @@
+# Declarative electrochemical test protocols.
+#
+# A protocol file (JSON, or YAML if PyYAML is installed) lists the
+# AdmiralSquidstatWrapper.setup_*() techniques to run, their parameters and
+# the post-processing of each step. The file is compiled once per session into
+# a ProtocolPlan, which is cached by the hash of the file content. The plan in
+# turn caches the potentiostat elements it builds, so repeated runs of the same
+# protocol don't rebuild them.
+#
+# Example of a protocol file:
+# {
+#     "name": "OER testing",
+#     "steps": [
+#         {
+#             "label": "3 EIS",
+#             "technique": "EIS_potentiostatic",
+#             "params": {"start_frequency": 500000, "end_frequency": 1},
+#             "find_ohmic_resistance": true
+#         },
+#         {
+#             "label": "7 CP 10 mA cm-2",
+#             "technique": "constant_current",
+#             "params": {"holdAtCurrent": 0.01, "duration": 70},
+#             "per_area": ["holdAtCurrent"],
+#             "ohmic_correction": true,
+#             "averages": [
+#                 {
+#                     "column": "Working Electrode Voltage [V]",
+#                     "tail_fraction": 0.3333333333333333,
+#                     "metadata": "potential_at_10mAcm2 [V]"
+#                 }
+#             ]
+#         }
+#     ]
+# }
+#
+# Parameters listed in "per_area" are given per cm^2 and are multiplied by the
+# sample surface area when the plan is built. "monitors" maps the name of a
+# monitor in monitors.MONITORS to its settings, eg.
+# "monitors": {"steady_state": {"window": 15, "min_duration": 30}}
+# ends a constant current step once the potential is stable. EIS steps estimate
+# the ohmic resistance while sweeping; "ohmic_only": true in their params ends
+# the sweep as soon as it is found.
+
+import copy
+import hashlib
+import json
+import os
+from openTron_electrodeposition.monitors import MONITORS
+
+DEFAULT_PROTOCOL = os.path.join(
+    os.path.dirname(__file__), "protocols", "electrochemical_testing.json"
+)
+# The default protocol with the CP steps ended by the steady state detector.
+# Opt-in, as the averages of the CP steps are then over a shorter window.
+STEADY_STATE_PROTOCOL = os.path.join(
+    os.path.dirname(__file__), "protocols", "electrochemical_testing_steady_state.json"
+)
+STEP_KEYS = [
+    "label",
+    "technique",
+    "params",
+    "per_area",
+    "find_ohmic_resistance",
+    "ohmic_correction",
+    "averages",
+    "monitors",
+]
+
+_PLAN_CACHE = {}
+
+
+class ProtocolPlan:
+    def __init__(self, spec: dict):
+        """A validated protocol that builds potentiostat protocols.
+
+        Args:
+            spec (dict): The content of a protocol file
+        """
+        self.spec = copy.deepcopy(spec)
+        self.name = self.spec.get("name", "")
+        self.steps = self.spec.get("steps")
+        self._check_steps()
+        self.hash = hashlib.sha256(
+            json.dumps(self.spec, sort_keys=True).encode()
+        ).hexdigest()
+
+    def _check_steps(self) -> None:
+        """Check that the steps of the protocol are valid."""
+        if not isinstance(self.steps, list) or len(self.steps) == 0:
+            raise ValueError("A protocol must have a non-empty list of steps.")
+        for number, step in enumerate(self.steps):
+            unknown = set(step) - set(STEP_KEYS)
+            if unknown:
+                raise ValueError(f"Unknown keys in step {number}: {sorted(unknown)}")
+            if "technique" not in step:
+                raise ValueError(f"Step {number} has no technique.")
+            step.setdefault("label", f"{number} {step['technique']}")
+            step.setdefault("params", {})
+            step.setdefault("per_area", [])
+            step.setdefault("averages", [])
+            step.setdefault("monitors", {})
+            for name in step["monitors"]:
+                if name not in MONITORS:
+                    raise ValueError(f"Unknown monitor in step {number}: {name}")
+            for name in step["per_area"]:
+                if name not in step["params"]:
+                    raise ValueError(
+                        f"Step {number} scales {name} by area, but has no such "
+                        "parameter."
+                    )
+            for average in step["averages"]:
+                if not {"column", "tail_fraction", "metadata"} <= set(average):
+                    raise ValueError(
+                        f"Averages in step {number} need a column, a "
+                        "tail_fraction and a metadata name."
+                    )
+
+    def params(self, step: dict, sample_surface_area: float) -> dict:
+        """Parameters of a step with the area specific parameters scaled.
+
+        Args:
+            step (dict): A step of the plan
+            sample_surface_area (float): Sample surface area in cm^2
+
+        Returns:
+            dict: Parameters for the setup_*() function of the step
+        """
+        params = dict(step["params"])
+        for name in step["per_area"]:
+            params[name] = params[name] * sample_surface_area
+        return params
+
+    def build(self, admiral, sample_surface_area: float):
+        """Build the potentiostat protocol of the plan. A new protocol is
+        built for every run, as the plan is shared by every potentiostat of
+        the session and holds no reference to them.
+
+        Args:
+            admiral (AdmiralSquidstatWrapper): The potentiostat to run on
+            sample_surface_area (float): Sample surface area in cm^2
+
+        Returns:
+            ProtocolBuilder: The protocol to pass to admiral.run_protocol()
+        """
+        protocol = admiral.new_protocol()
+        for step in self.steps:
+            protocol.add(
+                step["technique"],
+                label=step["label"],
+                monitors=[
+                    MONITORS[name](**settings)
+                    for name, settings in step["monitors"].items()
+                ],
+                **self.params(step, sample_surface_area),
+            )
+        return protocol
+
+
+def load_protocol(path: str = DEFAULT_PROTOCOL) -> ProtocolPlan:
+    """Load a protocol file. Files with the same content are only compiled
+    once per session.
+
+    Args:
+        path (str, optional): Path of a .json, .yaml or .yml protocol file.
+            Defaults to DEFAULT_PROTOCOL.
+
+    Returns:
+        ProtocolPlan: The compiled protocol
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+    key = hashlib.sha256(content).hexdigest()
+    if key not in _PLAN_CACHE:
+        if path.lower().endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("PyYAML is needed to read YAML protocol files.")
+            spec = yaml.safe_load(content)
+        else:
+            spec = json.loads(content)
+        _PLAN_CACHE[key] = ProtocolPlan(spec)
+    return _PLAN_CACHE[key]
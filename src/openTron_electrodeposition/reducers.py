@@ -0,0 +1,205 @@
+# Acquisition-side reducers for long potentiostat measurements.
+#
+# A reducer is fed every DC sample in the AdmiralSquidstatWrapper data callback
+# and appends fewer samples to the buffer, eg. one mean per block of samples.
+# Everything downstream of the buffer (step splitting, sinks, get_data()) then
+# only sees the reduced samples. All reducers do a constant amount of work per
+# sample, LTTB amortised over its buckets. finish() is called at the end of
+# every element, so blocks never mix samples of two elements.
+
+
+class Reducer:
+    """Base class of the reducers, which passes every sample through."""
+
+    name = "raw"
+
+    def reset(self) -> None:
+        """Forget the samples of an unfinished block."""
+
+    def add(self, values: tuple, buffer) -> None:
+        """Feed a sample.
+
+        Args:
+            values (tuple): One float per column of the buffer
+            buffer (ColumnarBuffer): Buffer the reduced samples are appended to
+        """
+        buffer.append(*values)
+
+    def finish(self, buffer) -> None:
+        """Append the reduced samples of an unfinished block, eg. at the end
+        of an element."""
+
+    def _column_index(self, buffer, column: str) -> int:
+        if self._index is None:
+            self._index = buffer.columns.index(column)
+        return self._index
+
+
+class BlockAverage(Reducer):
+    name = "block_average"
+
+    def __init__(self, size: int = 10):
+        """Replace every block of size samples by their mean.
+
+        Args:
+            size (int, optional): Number of samples per block. Defaults to 10.
+        """
+        if size < 1:
+            raise ValueError("size must be at least 1.")
+        self.size = size
+        self.reset()
+
+    def reset(self) -> None:
+        self._sums = None
+        self._count = 0
+
+    def add(self, values: tuple, buffer) -> None:
+        if self._sums is None:
+            self._sums = list(values)
+        else:
+            sums = self._sums
+            for i, value in enumerate(values):
+                sums[i] += value
+        self._count += 1
+        if self._count == self.size:
+            self.finish(buffer)
+
+    def finish(self, buffer) -> None:
+        if self._count:
+            buffer.append(*[value / self._count for value in self._sums])
+        self.reset()
+
+
+class MinMaxEnvelope(Reducer):
+    name = "min_max"
+
+    def __init__(self, size: int = 20, column: str = "Working Electrode Voltage [V]"):
+        """Replace every block of size samples by the samples with the smallest
+        and the largest value of a column, in the order they were measured.
+        Plots of the reduced samples keep the envelope of the raw samples.
+
+        Args:
+            size (int, optional): Number of samples per block. Defaults to 20.
+            column (str, optional): Column of the envelope. Defaults to
+                "Working Electrode Voltage [V]".
+        """
+        if size < 2:
+            raise ValueError("size must be at least 2.")
+        self.size = size
+        self.column = column
+        self._index = None
+        self.reset()
+
+    def reset(self) -> None:
+        self._count = 0
+        self._min = None
+        self._max = None
+
+    def add(self, values: tuple, buffer) -> None:
+        index = self._column_index(buffer, self.column)
+        value = values[index]
+        # The running minimum and maximum are kept with their order of arrival
+        if self._min is None or value < self._min[1][index]:
+            self._min = (self._count, values)
+        if self._max is None or value > self._max[1][index]:
+            self._max = (self._count, values)
+        self._count += 1
+        if self._count == self.size:
+            self.finish(buffer)
+
+    def finish(self, buffer) -> None:
+        if self._count:
+            first, second = sorted([self._min, self._max], key=lambda item: item[0])
+            buffer.append(*first[1])
+            if second[0] != first[0]:
+                buffer.append(*second[1])
+        self.reset()
+
+
+class LTTB(Reducer):
+    name = "lttb"
+
+    def __init__(self, bucket: int = 20, column: str = "Working Electrode Voltage [V]"):
+        """Streaming largest-triangle-three-buckets downsampling. Of every
+        bucket of samples the one is kept, that forms the largest triangle
+        with the sample kept from the previous bucket and the mean of the next
+        bucket, with the timestamp on the x axis and a column on the y axis.
+        The first and the last sample of every element are kept as well.
+
+        Args:
+            bucket (int, optional): Number of samples per bucket. Defaults to
+                20.
+            column (str, optional): Column on the y axis. Defaults to
+                "Working Electrode Voltage [V]".
+        """
+        if bucket < 1:
+            raise ValueError("bucket must be at least 1.")
+        self.bucket = bucket
+        self.column = column
+        self._index = None
+        self.reset()
+
+    def reset(self) -> None:
+        self._kept = None
+        self._pending = []
+        self._current = []
+        self._sum_t = 0.0
+        self._sum_y = 0.0
+
+    def add(self, values: tuple, buffer) -> None:
+        index = self._column_index(buffer, self.column)
+        if self._kept is None:
+            self._kept = values
+            buffer.append(*values)
+            return
+        self._current.append(values)
+        self._sum_t += values[0]
+        self._sum_y += values[index]
+        if len(self._current) == self.bucket:
+            count = len(self._current)
+            self._select(buffer, self._sum_t / count, self._sum_y / count)
+            self._pending = self._current
+            self._current = []
+            self._sum_t = 0.0
+            self._sum_y = 0.0
+
+    def _select(self, buffer, next_t: float, next_y: float) -> None:
+        """Keep the sample of the pending bucket with the largest triangle."""
+        if not self._pending:
+            return
+        index = self._index
+        kept_t, kept_y = self._kept[0], self._kept[index]
+        best, largest = None, -1.0
+        for values in self._pending:
+            area = abs(
+                (kept_t - next_t) * (values[index] - kept_y)
+                - (kept_t - values[0]) * (next_y - kept_y)
+            )
+            if area > largest:
+                best, largest = values, area
+        self._kept = best
+        buffer.append(*best)
+
+    def finish(self, buffer) -> None:
+        if self._kept is not None:
+            if self._current:
+                last = self._current[-1]
+                count = len(self._current)
+                self._select(buffer, self._sum_t / count, self._sum_y / count)
+                self._pending = self._current[:-1]
+                self._select(buffer, last[0], last[self._index])
+                buffer.append(*last)
+            elif self._pending:
+                # The last sample of the element is in the pending bucket
+                last = self._pending.pop()
+                self._select(buffer, last[0], last[self._index])
+                buffer.append(*last)
+        self.reset()
+
+
+REDUCERS = {
+    Reducer.name: Reducer,
+    BlockAverage.name: BlockAverage,
+    MinMaxEnvelope.name: MinMaxEnvelope,
+    LTTB.name: LTTB,
+}
@@ -0,0 +1,757 @@
+# Simulated Admiral Squidstat potentiostat.
+#
+# This module has the same names as the parts of PySide2 and SquidstatPyLibrary
+# that AdmiralSquidstatWrapper uses, so the wrapper can run without Windows, the
+# vendor wheel and an instrument: AdmiralSquidstatWrapper(simulated=True).
+# Samples are emitted through the same signals (activeDCDataReady,
+# activeACDataReady, experimentNewElementStarting, experimentStopped) with the
+# same data fields as the vendor library.
+#
+# The cell is a Randles circuit: the ohmic resistance in series with the double
+# layer capacitance, which is parallel to a Butler-Volmer charge transfer
+# reaction and a Warburg diffusion element. DC elements integrate the charging
+# of the double layer with the backward Euler method, so constant current steps
+# show the transient towards the Butler-Volmer overpotential and voltammograms
+# show a capacitive current. EIS elements use the small signal impedance of the
+# circuit at the bias point.
+#
+# By default the simulation runs as fast as possible. Set the speed of the
+# handler to 1 to emit the samples in real time, or to eg. 10 for ten times
+# real time: admiral.handler.speed = 1.
+
+import cmath
+import math
+import random
+import time
+
+FARADAY = 96485.33212
+GAS_CONSTANT = 8.314462618
+
+_application = None
+
+
+class SimulatedSignal:
+    def __init__(self):
+        """Minimal replacement of a Qt signal."""
+        self._slots = []
+
+    def connect(self, slot) -> None:
+        self._slots.append(slot)
+
+    def emit(self, *args) -> None:
+        for slot in self._slots:
+            slot(*args)
+
+
+class QApplication:
+    def __init__(self, *args):
+        """Event loop of the simulator. exec_() runs the experiments of all
+        simulated handlers and the timers until quit() is called."""
+        global _application
+        _application = self
+        self._quit = False
+        self._tasks = []
+        self._timers = []
+
+    def exec_(self) -> int:
+        self._quit = False
+        while not self._quit:
+            now = time.monotonic()
+            for timer in list(self._timers):
+                if timer.active and now >= timer.due:
+                    timer.due = now + timer.interval
+                    timer.timeout.emit()
+            wait = 0.01 if self._timers else 0.001
+            for task in list(self._tasks):
+                if self._quit:
+                    break
+                wait = min(wait, task.step())
+                if task.finished:
+                    self._tasks.remove(task)
+            if wait > 0:
+                time.sleep(wait)
+        return 0
+
+    def quit(self) -> None:
+        self._quit = True
+
+    def shutdown(self) -> None:
+        # Abandon the running experiments
+        self._tasks = []
+
+
+class QTimer:
+    def __init__(self):
+        """Timer of the simulated event loop."""
+        self.timeout = SimulatedSignal()
+        self.active = False
+        self.interval = 0.0
+        self.due = 0.0
+
+    def start(self, milliseconds: int) -> None:
+        self.interval = milliseconds / 1000
+        self.due = time.monotonic() + self.interval
+        self.active = True
+        if self not in _application._timers:
+            _application._timers.append(self)
+
+    def stop(self) -> None:
+        self.active = False
+
+
+class SimulatedCell:
+    def __init__(
+        self,
+        equilibrium_potential: float = 1.23,
+        ohmic_resistance: float = 2.0,
+        exchange_current: float = 1e-3,
+        transfer_coefficient: float = 0.5,
+        double_layer_capacitance: float = 1e-4,
+        warburg_coefficient: float = 0.5,
+        inductance: float = 2e-7,
+        limiting_current: float = 1.0,
+        temperature: float = 25.0,
+        voltage_noise: float = 1e-4,
+        current_noise: float = 1e-6,
+        seed: int = None,
+    ):
+        """Electrochemical cell of the simulator.
+
+        Args:
+            equilibrium_potential (float, optional): Equilibrium potential of
+                the reaction vs. the reference electrode in V. Defaults to 1.23.
+            ohmic_resistance (float, optional): Resistance of the electrolyte
+                and the contacts in ohm. Defaults to 2.0.
+            exchange_current (float, optional): Exchange current of the
+                Butler-Volmer reaction in A. Defaults to 1e-3.
+            transfer_coefficient (float, optional): Anodic transfer coefficient.
+                Defaults to 0.5.
+            double_layer_capacitance (float, optional): Double layer
+                capacitance in F. Defaults to 1e-4.
+            warburg_coefficient (float, optional): Warburg coefficient in
+                ohm s^-1/2. Defaults to 0.5.
+            inductance (float, optional): Inductance of the cables in H.
+                Defaults to 2e-7.
+            limiting_current (float, optional): Mass transport limited current
+                in A, which bounds the Butler-Volmer current. Defaults to 1.0.
+            temperature (float, optional): Temperature in degrees Celsius.
+                Defaults to 25.0.
+            voltage_noise (float, optional): Standard deviation of the noise
+                of the potential in V. Defaults to 1e-4.
+            current_noise (float, optional): Standard deviation of the noise
+                of the current in A. Defaults to 1e-6.
+            seed (int, optional): Seed of the noise. Defaults to None.
+        """
+        self.equilibrium_potential = equilibrium_potential
+        self.ohmic_resistance = ohmic_resistance
+        self.exchange_current = exchange_current
+        self.transfer_coefficient = transfer_coefficient
+        self.double_layer_capacitance = double_layer_capacitance
+        self.warburg_coefficient = warburg_coefficient
+        self.inductance = inductance
+        self.limiting_current = limiting_current
+        self.temperature = temperature
+        self.voltage_noise = voltage_noise
+        self.current_noise = current_noise
+        self.random = random.Random(seed)
+        self.f = FARADAY / (GAS_CONSTANT * (temperature + 273.15))
+        # Overpotential across the double layer
+        self.overpotential = 0.0
+
+    def faradaic_current(self, overpotential: float) -> tuple:
+        """Butler-Volmer current and its derivative at an overpotential."""
+        # Bounded exponents, beyond them the limiting current dominates
+        exponent = max(min(self.f * overpotential, 1000.0), -1000.0)
+        anodic = self.exchange_current * math.exp(self.transfer_coefficient * exponent)
+        cathodic = self.exchange_current * math.exp(
+            -(1 - self.transfer_coefficient) * exponent
+        )
+        derivative = self.f * (
+            self.transfer_coefficient * anodic
+            + (1 - self.transfer_coefficient) * cathodic
+        )
+        # Kinetic and mass transport resistances in series
+        kinetic = anodic - cathodic
+        limitation = 1 + abs(kinetic) / self.limiting_current
+        return kinetic / limitation, derivative / limitation**2
+
+    def _solve(self, function) -> None:
+        """Newton iterations for the overpotential at the end of a time step.
+        The function returns the residual and its derivative, which is
+        positive."""
+        overpotential = self.overpotential
+        for _ in range(50):
+            residual, derivative = function(overpotential)
+            step = max(min(residual / derivative, 0.1), -0.1)
+            overpotential -= step
+            if abs(step) < 1e-12:
+                break
+        self.overpotential = overpotential
+
+    def apply_current(self, current: float, dt: float) -> float:
+        """Pass a current for dt seconds.
+
+        Returns:
+            float: The potential of the working electrode in V
+        """
+        if dt <= 0:
+            return self.potential(current)
+        last = self.overpotential
+        capacitance = self.double_layer_capacitance / dt
+
+        def residual(overpotential):
+            faradaic, derivative = self.faradaic_current(overpotential)
+            return (
+                faradaic + capacitance * (overpotential - last) - current,
+                derivative + capacitance,
+            )
+
+        self._solve(residual)
+        return self.potential(current)
+
+    def apply_potential(self, voltage: float, dt: float) -> float:
+        """Hold the working electrode at a potential for dt seconds.
+
+        Returns:
+            float: The current in A
+        """
+        last = self.overpotential
+        capacitance = self.double_layer_capacitance / max(dt, 1e-9)
+        target = voltage - self.equilibrium_potential
+
+        def residual(overpotential):
+            faradaic, derivative = self.faradaic_current(overpotential)
+            current = faradaic + capacitance * (overpotential - last)
+            return (
+                overpotential + self.ohmic_resistance * current - target,
+                1 + self.ohmic_resistance * (derivative + capacitance),
+            )
+
+        self._solve(residual)
+        faradaic, _ = self.faradaic_current(self.overpotential)
+        return faradaic + capacitance * (self.overpotential - last)
+
+    def potential(self, current: float) -> float:
+        """Potential of the working electrode at the present overpotential."""
+        return (
+            self.equilibrium_potential
+            + self.overpotential
+            + self.ohmic_resistance * current
+        )
+
+    def impedance(self, frequency: float) -> complex:
+        """Small signal impedance of the cell at the present overpotential."""
+        omega = 2 * math.pi * frequency
+        _, derivative = self.faradaic_current(self.overpotential)
+        charge_transfer = 1 / derivative
+        warburg = self.warburg_coefficient * (1 - 1j) / math.sqrt(omega)
+        faradaic = charge_transfer + warburg
+        return (
+            self.ohmic_resistance
+            + 1j * omega * self.inductance
+            + faradaic / (1 + 1j * omega * self.double_layer_capacitance * faradaic)
+        )
+
+    def noisy(self, voltage: float, current: float) -> tuple:
+        """Add measurement noise to a potential and a current."""
+        return (
+            voltage + self.random.gauss(0.0, self.voltage_noise),
+            current + self.random.gauss(0.0, self.current_noise),
+        )
+
+
+class SimulatedDCData:
+    __slots__ = (
+        "timestamp",
+        "workingElectrodeVoltage",
+        "counterElectrodeVoltage",
+        "current",
+        "temperature",
+    )
+
+    def __init__(self, timestamp, voltage, current, temperature):
+        self.timestamp = timestamp
+        self.workingElectrodeVoltage = voltage
+        self.counterElectrodeVoltage = 0.0
+        self.current = current
+        self.temperature = temperature
+
+
+class SimulatedACData:
+    __slots__ = (
+        "timestamp",
+        "frequency",
+        "absoluteImpedance",
+        "phaseAngle",
+        "realImpedance",
+        "imagImpedance",
+        "totalHarmonicDistortion",
+        "numberOfCycles",
+        "workingElectrodeDCVoltage",
+        "DCCurrent",
+        "currentAmplitude",
+        "voltageAmplitude",
+    )
+
+    def __init__(
+        self, timestamp, frequency, impedance, cycles, voltage, current, amplitude
+    ):
+        self.timestamp = timestamp
+        self.frequency = frequency
+        self.absoluteImpedance = abs(impedance)
+        self.phaseAngle = math.degrees(cmath.phase(impedance))
+        self.realImpedance = impedance.real
+        self.imagImpedance = impedance.imag
+        self.totalHarmonicDistortion = 0.0
+        self.numberOfCycles = cycles
+        self.workingElectrodeDCVoltage = voltage
+        self.DCCurrent = current
+        self.currentAmplitude, self.voltageAmplitude = amplitude
+
+
+class SimulatedElementData:
+    __slots__ = ("stepName", "stepNumber", "substepNumber")
+
+    def __init__(self, name, step, substep):
+        self.stepName = name
+        self.stepNumber = step
+        self.substepNumber = substep
+
+
+class _Element:
+    name = "Element"
+
+    def samples(self, cell: SimulatedCell):
+        """Generator of the samples of the element, as tuples of the kind
+        ("dc" or "ac"), the time since the start of the element and the
+        values of the sample."""
+        return iter(())
+
+
+def _dc(cell, t, voltage, current):
+    voltage, current = cell.noisy(voltage, current)
+    return ("dc", t, voltage, current)
+
+
+def _galvanostatic(cell, currents, dt):
+    """Samples of a list of currents, one every dt seconds."""
+    for n, current in enumerate(currents, start=1):
+        yield _dc(cell, n * dt, cell.apply_current(current, dt), current)
+
+
+def _potentiostatic(cell, voltages, dt):
+    """Samples of a list of potentials, one every dt seconds."""
+    for n, voltage in enumerate(voltages, start=1):
+        yield _dc(cell, n * dt, voltage, cell.apply_potential(voltage, dt))
+
+
+def _ramp(start, end, rate, dt):
+    """Values from start to end at rate per second, one every dt seconds."""
+    count = max(int(round(abs(end - start) / max(abs(rate), 1e-12) / dt)), 1)
+    return (start + (end - start) * n / count for n in range(1, count + 1))
+
+
+def _steps(duration, dt):
+    return range(max(int(round(duration / dt)), 1))
+
+
+class AisConstantCurrentElement(_Element):
+    name = "Constant Current"
+
+    def __init__(self, current, samplingInterval, duration):
+        self.current = current
+        self.samplingInterval = samplingInterval
+        self.duration = duration
+
+    def samples(self, cell):
+        currents = (self.current for _ in _steps(self.duration, self.samplingInterval))
+        return _galvanostatic(cell, currents, self.samplingInterval)
+
+
+class AisConstantPotElement(_Element):
+    name = "Constant Potential"
+
+    def __init__(self, voltage, samplingInterval, duration):
+        self.voltage = voltage
+        self.samplingInterval = samplingInterval
+        self.duration = duration
+
+    def samples(self, cell):
+        voltages = (self.voltage for _ in _steps(self.duration, self.samplingInterval))
+        return _potentiostatic(cell, voltages, self.samplingInterval)
+
+
+class AisConstantPowerElement(_Element):
+    name = "Constant Power"
+
+    def __init__(self, isCharge, power, duration, samplingInterval):
+        self.isCharge = isCharge
+        self.power = power
+        self.duration = duration
+        self.samplingInterval = samplingInterval
+
+    def samples(self, cell):
+        dt = self.samplingInterval
+        sign = 1 if self.isCharge else -1
+        for n in _steps(self.duration, dt):
+            voltage = cell.potential(0.0)
+            current = sign * abs(self.power) / max(abs(voltage), 1e-3)
+            yield _dc(cell, (n + 1) * dt, cell.apply_current(current, dt), current)
+
+
+class AisConstantResistanceElement(_Element):
+    name = "Constant Resistance"
+
+    def __init__(self, resistance, duration, samplingInterval):
+        self.resistance = resistance
+        self.duration = duration
+        self.samplingInterval = samplingInterval
+
+    def samples(self, cell):
+        dt = self.samplingInterval
+        for n in _steps(self.duration, dt):
+            current = -cell.potential(0.0) / max(self.resistance, 1e-9)
+            yield _dc(cell, (n + 1) * dt, cell.apply_current(current, dt), current)
+
+
+class AisDCCurrentSweepElement(_Element):
+    name = "DC Current Sweep"
+
+    def __init__(self, startCurrent, endCurrent, scanRate, samplingInterval):
+        self.startCurrent = startCurrent
+        self.endCurrent = endCurrent
+        self.scanRate = scanRate
+        self.samplingInterval = samplingInterval
+
+    def samples(self, cell):
+        dt = self.samplingInterval
+        currents = _ramp(self.startCurrent, self.endCurrent, self.scanRate, dt)
+        return _galvanostatic(cell, currents, dt)
+
+
+class AisDCPotentialSweepElement(_Element):
+    name = "DC Potential Sweep"
+
+    def __init__(self, startPotential, endPotential, scanRate, samplingInterval):
+        self.startPotential = startPotential
+        self.endPotential = endPotential
+        self.scanRate = scanRate
+        self.samplingInterval = samplingInterval
+
+    def samples(self, cell):
+        dt = self.samplingInterval
+        voltages = _ramp(self.startPotential, self.endPotential, self.scanRate, dt)
+        return _potentiostatic(cell, voltages, dt)
+
+
+class AisCyclicVoltammetryElement(_Element):
+    name = "Cyclic Voltammetry"
+
+    def __init__(
+        self,
+        startVoltage,
+        firstVoltageLimit,
+        secondVoltageLimit,
+        endVoltage,
+        scanRate,
+        samplingInterval,
+    ):
+        self.vertices = [
+            startVoltage,
+            firstVoltageLimit,
+            secondVoltageLimit,
+            endVoltage,
+        ]
+        self.scanRate = scanRate
+        self.samplingInterval = samplingInterval
+
+    def _voltages(self):
+        dt = self.samplingInterval
+        for start, end in zip(self.vertices[:-1], self.vertices[1:]):
+            if end != start:
+                yield from _ramp(start, end, self.scanRate, dt)
+
+    def samples(self, cell):
+        return _potentiostatic(cell, self._voltages(), self.samplingInterval)
+
+
+class AisSquareWaveVoltammetryElement(AisCyclicVoltammetryElement):
+    name = "Square Wave Voltammetry"
+
+
+class AisDiffPulseVoltammetryElement(_Element):
+    name = "Differential Pulse Voltammetry"
+
+    def __init__(
+        self,
+        startPotential,
+        endPotential,
+        potentialStep,
+        pulseHeight,
+        pulseWidth,
+        pulsePeriod,
+    ):
+        self.startPotential = startPotential
+        self.endPotential = endPotential
+        self.potentialStep = potentialStep
+        self.pulseHeight = pulseHeight
+        self.pulseWidth = pulseWidth
+        self.pulsePeriod = pulsePeriod
+
+    def _pulses(self):
+        """Base potential and pulse potential of every period."""
+        count = int(
+            abs(self.endPotential - self.startPotential)
+            / max(abs(self.potentialStep), 1e-12)
+        )
+        direction = 1 if self.endPotential >= self.startPotential else -1
+        for n in range(count + 1):
+            base = self.startPotential + direction * n * abs(self.potentialStep)
+            yield base, base + self.pulseHeight
+
+    def samples(self, cell):
+        t = 0.0
+        rest = max(self.pulsePeriod - self.pulseWidth, 1e-6)
+        for base, pulse in self._pulses():
+            # One sample at the end of the base and one at the end of the pulse
+            current = cell.apply_potential(base, rest)
+            t += rest
+            yield _dc(cell, t, base, current)
+            current = cell.apply_potential(pulse, self.pulseWidth)
+            t += self.pulseWidth
+            yield _dc(cell, t, pulse, current)
+
+
+class AisNormalPulseVoltammetryElement(AisDiffPulseVoltammetryElement):
+    name = "Normal Pulse Voltammetry"
+
+    def __init__(
+        self, startPotential, endPotential, potentialStep, pulseWidth, pulsePeriod
+    ):
+        super().__init__(
+            startPotential, endPotential, potentialStep, 0.0, pulseWidth, pulsePeriod
+        )
+
+    def _pulses(self):
+        # The electrode returns to the start potential between the pulses
+        for base, pulse in super()._pulses():
+            yield self.startPotential, pulse
+
+
+class AisEISPotentiostaticElement(_Element):
+    name = "EIS Potentiostatic"
+    galvanostatic = False
+
+    def __init__(self, startFrequency, endFrequency, pointsPerDecade, bias, amplitude):
+        self.startFrequency = startFrequency
+        self.endFrequency = endFrequency
+        self.pointsPerDecade = pointsPerDecade
+        self.bias = bias
+        self.amplitude = amplitude
+
+    def frequencies(self) -> list:
+        decades = math.log10(self.endFrequency / self.startFrequency)
+        count = max(int(round(abs(decades) * self.pointsPerDecade)), 1)
+        return [
+            self.startFrequency * 10 ** (decades * n / count) for n in range(count + 1)
+        ]
+
+    def samples(self, cell):
+        # Settle at the bias before the sweep
+        if self.galvanostatic:
+            current = self.bias
+            voltage = cell.apply_current(current, 1.0)
+        else:
+            voltage = self.bias
+            current = cell.apply_potential(voltage, 1.0)
+        t = 0.0
+        for frequency in self.frequencies():
+            cycles = max(2, int(min(frequency, 100) * 0.2))
+            t += cycles / frequency + 0.05
+            impedance = cell.impedance(frequency)
+            if self.galvanostatic:
+                amplitude = (self.amplitude, self.amplitude * abs(impedance))
+            else:
+                amplitude = (self.amplitude / abs(impedance), self.amplitude)
+            yield ("ac", t, frequency, impedance, cycles, voltage, current, amplitude)
+
+
+class AisEISGalvanostaticElement(AisEISPotentiostaticElement):
+    name = "EIS Galvanostatic"
+    galvanostatic = True
+
+
+class AisOpenCircuitElement(_Element):
+    name = "Open Circuit Potential"
+
+    def __init__(self, duration, samplingInterval):
+        self.duration = duration
+        self.samplingInterval = samplingInterval
+
+    def samples(self, cell):
+        currents = (0.0 for _ in _steps(self.duration, self.samplingInterval))
+        return _galvanostatic(cell, currents, self.samplingInterval)
+
+
+class AisExperiment:
+    def __init__(self):
+        """List of elements that run one after another."""
+        self.elements = []
+
+    def appendElement(self, element, repeats: int = 1) -> bool:
+        self.elements.append((element, repeats))
+        return True
+
+
+class _ExperimentTask:
+    def __init__(self, handler, channel: int, experiment: AisExperiment):
+        """Internal class, the run of an experiment on a channel of a
+        simulated handler, which is stepped by the event loop."""
+        self.handler = handler
+        self.channel = channel
+        self.finished = False
+        self.stop_requested = False
+        self.skip_requested = False
+        self.time = 0.0
+        self._samples = self._run(experiment)
+        self._wall_start = time.monotonic()
+
+    def _run(self, experiment):
+        handler = self.handler
+        cell = handler.cells.setdefault(self.channel, handler.new_cell())
+        for step, (element, repeats) in enumerate(experiment.elements, start=1):
+            for substep in range(1, max(repeats, 1) + 1):
+                handler.experimentNewElementStarting.emit(
+                    self.channel, SimulatedElementData(element.name, step, substep)
+                )
+                start = self.time
+                for sample in element.samples(cell):
+                    if self.stop_requested or self.skip_requested:
+                        break
+                    self.time = start + sample[1]
+                    yield sample
+                if self.stop_requested:
+                    return
+                if self.skip_requested:
+                    self.skip_requested = False
+                    break
+
+    def step(self) -> float:
+        """Emit the samples that are due.
+
+        Returns:
+            float: Seconds until the next sample is due
+        """
+        handler = self.handler
+        for _ in range(handler.batch_size):
+            if handler.speed:
+                due = self._wall_start + self.time / handler.speed
+                wait = due - time.monotonic()
+                if wait > 0:
+                    return wait
+            try:
+                sample = next(self._samples)
+            except StopIteration:
+                self.finished = True
+                handler._finished(self.channel)
+                return 0.0
+            temperature = handler.cells[self.channel].temperature
+            if sample[0] == "dc":
+                handler.activeDCDataReady.emit(
+                    self.channel,
+                    SimulatedDCData(self.time, sample[2], sample[3], temperature),
+                )
+            else:
+                handler.activeACDataReady.emit(
+                    self.channel, SimulatedACData(self.time, *sample[2:])
+                )
+            if self.finished:
+                return 0.0
+        return 0.0
+
+
+class SimulatedHandler:
+    def __init__(self, name: str):
+        """Simulated instrument handler with the signals and the experiment
+        control functions of the vendor handler.
+
+        Args:
+            name (str): Name of the instrument
+        """
+        self.name = name
+        self.activeDCDataReady = SimulatedSignal()
+        self.activeACDataReady = SimulatedSignal()
+        self.experimentNewElementStarting = SimulatedSignal()
+        self.experimentStopped = SimulatedSignal()
+        # Simulated seconds per second, None runs as fast as possible
+        self.speed = None
+        # Samples emitted per channel before the event loop does other work
+        self.batch_size = 64
+        # Settings of the cell of each channel, see SimulatedCell
+        self.cell_settings = {}
+        self.cells = {}
+        self._uploaded = {}
+        self._tasks = {}
+
+    def new_cell(self) -> SimulatedCell:
+        return SimulatedCell(**self.cell_settings)
+
+    def uploadExperimentToChannel(self, channel: int, experiment: AisExperiment):
+        self._uploaded[channel] = experiment
+        return 0
+
+    def startUploadedExperiment(self, channel: int):
+        if channel not in self._uploaded:
+            return _Error(f"No experiment uploaded to channel {channel}.")
+        task = _ExperimentTask(self, channel, self._uploaded[channel])
+        self._tasks[channel] = task
+        _application._tasks.append(task)
+        return 0
+
+    def stopExperiment(self, channel: int):
+        if channel in self._tasks:
+            self._tasks[channel].stop_requested = True
+        return 0
+
+    def skipExperimentStep(self, channel: int):
+        if channel in self._tasks:
+            self._tasks[channel].skip_requested = True
+        return 0
+
+    def _finished(self, channel: int) -> None:
+        del self._tasks[channel]
+        self.experimentStopped.emit(channel)
+
+
+class _Error:
+    def __init__(self, message: str):
+        self._message = message
+
+    def message(self) -> str:
+        return self._message
+
+
+class AisDeviceTracker:
+    _instance = None
+
+    def __init__(self):
+        """Simulated device tracker. Every port has a simulated instrument.
+        There is one tracker per QApplication."""
+        self._application = _application
+        self.newDeviceConnected = SimulatedSignal()
+        self._handlers = {}
+
+    @classmethod
+    def Instance(cls):
+        if cls._instance is None or cls._instance._application is not _application:
+            cls._instance = cls()
+        return cls._instance
+
+    def connectToDeviceOnComPort(self, port: str):
+        return 0
+
+    def getInstrumentHandler(self, name: str) -> SimulatedHandler:
+        if name not in self._handlers:
+            self._handlers[name] = SimulatedHandler(name)
+            self.newDeviceConnected.emit(name)
+        return self._handlers[name]
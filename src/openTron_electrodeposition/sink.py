@@ -0,0 +1,115 @@
+# Streaming on-disk sinks for potentiostat data.
+#
+# A sink receives fixed-size chunks of samples from a ColumnarBuffer while the
+# experiment runs and appends them to a file on a background writer thread, so
+# the Qt data callback never waits for the disk. A failed write is logged and
+# the samples after it are dropped; the error is raised by flush() and close(),
+# outside the data callback.
+
+import logging
+import os
+import queue
+import threading
+import numpy as np
+import pandas as pd
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CsvChunkSink:
+    def __init__(self, path: str, columns: list, fsync: bool = False):
+        """Append-only CSV file that is written on a background thread.
+
+        The file has a header line with the column names followed by one line
+        per sample. Values are written with 17 significant digits, so reading
+        the file back with load_sink_file() gives the exact float64 values.
+
+        Args:
+            path (str): Path of the CSV file. Existing files are appended to.
+            columns (list): Names of the columns in the chunks.
+            fsync (bool, optional): Force every chunk to the disk, not only to
+                the operating system. Defaults to False.
+        """
+        self.path = path
+        self.columns = list(columns)
+        self.fsync = fsync
+        self._queue = queue.Queue()
+        self._error = None
+        self._file = open(path, "a", encoding="utf8")
+        if self._file.tell() == 0:
+            self._file.write(",".join(self.columns) + "\n")
+            self._file.flush()
+        self._thread = threading.Thread(
+            target=self._writer, name="CsvChunkSink", daemon=True
+        )
+        self._thread.start()
+
+    def write(self, chunk: np.ndarray) -> None:
+        """Queue a chunk for writing. Returns immediately. The chunk is
+        dropped if an earlier chunk failed to be written.
+
+        Args:
+            chunk (np.ndarray): Array of shape (number of columns, number of
+                samples). The sink takes ownership of the array.
+        """
+        if self._error is None:
+            self._queue.put(chunk)
+
+    def flush(self) -> None:
+        """Wait until the queued chunks are written.
+
+        Raises:
+            IOError: A chunk failed to be written.
+        """
+        if self._thread.is_alive():
+            self._queue.join()
+        self._raise_error()
+
+    def close(self) -> None:
+        """Write all queued chunks and close the file.
+
+        Raises:
+            IOError: A chunk failed to be written.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._file.close()
+        self._raise_error()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise IOError(f"Writing to {self.path} failed: {self._error}")
+
+    def _writer(self) -> None:
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                self._queue.task_done()
+                return
+            if self._error is None:
+                try:
+                    np.savetxt(self._file, chunk.T, fmt="%.17g", delimiter=",")
+                    self._file.flush()
+                    if self.fsync:
+                        os.fsync(self._file.fileno())
+                except Exception as e:
+                    self._error = e
+                    LOGGER.error(
+                        f"Writing to {self.path} failed, the following samples "
+                        f"are not written: {e}"
+                    )
+            self._queue.task_done()
+
+
+def load_sink_file(path: str) -> pd.DataFrame:
+    """Load a file written by CsvChunkSink.
+
+    Args:
+        path (str): Path of the CSV file.
+
+    Returns:
+        pd.DataFrame: The same dataframe as AdmiralSquidstatWrapper.get_data()
+            returns for the samples in the file.
+    """
+    return pd.read_csv(path, sep=",", dtype=np.float64, float_precision="round_trip")
@@ -0,0 +1,139 @@
+# Instrumentation of the potentiostat data path.
+#
+# AdmiralSquidstatWrapper times every data callback and records the spacing of
+# the instrument timestamps in fixed, logarithmically spaced histograms, so the
+# cost per sample is constant and the memory does not grow with the number of
+# samples. Histograms of several steps can be merged into the stats of a run.
+
+import math
+
+BINS_PER_DECADE = 10
+SMALLEST_DECADE = -7  # 100 ns
+LARGEST_DECADE = 4  # 10000 s
+
+
+class LogHistogram:
+    def __init__(self):
+        """Histogram of positive values in logarithmically spaced bins, from
+        100 ns to 10000 s with 10 bins per decade. Percentiles are accurate to
+        the width of a bin, about 25 %."""
+        self.counts = [0] * ((LARGEST_DECADE - SMALLEST_DECADE) * BINS_PER_DECADE + 2)
+        self.count = 0
+        self.total = 0.0
+        self.max = math.nan
+        self.min = math.nan
+
+    def add(self, value: float) -> None:
+        if value > 0:
+            index = int((math.log10(value) - SMALLEST_DECADE) * BINS_PER_DECADE) + 1
+            index = min(max(index, 0), len(self.counts) - 1)
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if not value <= self.max:
+            self.max = value
+        if not value >= self.min:
+            self.min = value
+
+    def merge(self, other: "LogHistogram") -> None:
+        """Add the values of another histogram."""
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.max = other.max if not other.max <= self.max else self.max
+            self.min = other.min if not other.min >= self.min else self.min
+
+    def percentile(self, percent: float) -> float:
+        """The value below which percent of the values are, taken as the
+        geometric centre of its bin."""
+        if self.count == 0:
+            return math.nan
+        target = percent / 100 * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count:
+                if index == 0:
+                    return 0.0
+                exponent = SMALLEST_DECADE + (index - 0.5) / BINS_PER_DECADE
+                return min(max(10**exponent, self.min), self.max)
+        return self.max
+
+    def count_above(self, value: float) -> int:
+        """Number of values in the bins above the bin of a value."""
+        if value <= 0:
+            return self.count - self.counts[0]
+        index = int((math.log10(value) - SMALLEST_DECADE) * BINS_PER_DECADE) + 1
+        return sum(self.counts[index + 1 :])
+
+    def summary(self, scale: float = 1.0) -> dict:
+        """Mean, percentiles and maximum of the values, multiplied by scale."""
+        mean = self.total / self.count if self.count else math.nan
+        return {
+            "mean": mean * scale,
+            "p50": self.percentile(50) * scale,
+            "p90": self.percentile(90) * scale,
+            "p99": self.percentile(99) * scale,
+            "max": self.max * scale,
+        }
+
+
+class SampleStats:
+    def __init__(self):
+        """Counters of one kind of samples (DC or AC) of a step."""
+        self.samples = 0
+        self.callback = LogHistogram()
+        self.gaps = LogHistogram()
+        self._last_timestamp = None
+
+    def add(self, timestamp: float, callback_duration: float) -> None:
+        """Record a sample.
+
+        Args:
+            timestamp (float): Instrument timestamp of the sample in s
+            callback_duration (float): Time the callback took in s
+        """
+        self.samples += 1
+        self.callback.add(callback_duration)
+        if self._last_timestamp is not None:
+            self.gaps.add(timestamp - self._last_timestamp)
+        self._last_timestamp = timestamp
+
+    def merge(self, other: "SampleStats") -> None:
+        self.samples += other.samples
+        self.callback.merge(other.callback)
+        self.gaps.merge(other.gaps)
+
+    def summary(self) -> dict:
+        median_gap = self.gaps.percentile(50)
+        return {
+            "samples": self.samples,
+            "callback_time [s]": self.callback.total,
+            "callback [us]": self.callback.summary(1e6),
+            "timestamp_gap [s]": self.gaps.summary(),
+            # Gaps of more than twice the usual sampling interval hint at
+            # samples that were lost or delivered late
+            "long_gaps": (
+                self.gaps.count_above(2 * median_gap)
+                if not math.isnan(median_gap)
+                else 0
+            ),
+        }
+
+
+class StepStats:
+    def __init__(self):
+        """Counters of the DC and AC samples of a step."""
+        self.dc = SampleStats()
+        self.ac = SampleStats()
+
+    def merge(self, other: "StepStats") -> None:
+        self.dc.merge(other.dc)
+        self.ac.merge(other.ac)
+
+    def summary(self) -> dict:
+        return {"dc": self.dc.summary(), "ac": self.ac.summary()}
@@ -0,0 +1,413 @@
+# Potentiostat worker process.
+#
+# PotentiostatProcess starts a separate Python process that owns the Qt
+# application and the device handler of the Admiral potentiostat, so the Qt
+# lifecycle is independent of the orchestrating process. Protocol plans are
+# submitted over a local, authenticated multiprocessing connection. The samples
+# are streamed back through one shared memory ring buffer per kind of data (DC
+# and AC) while the experiment runs, and only their positions are sent over the
+# connection.
+#
+# The worker is started with "python -m openTron_electrodeposition.worker", so
+# the main script of the orchestrator is not imported again in the worker.
+
+import concurrent.futures
+import os
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+import numpy as np
+from openTron_electrodeposition.admiral import (
+    AC_COLUMNS,
+    DC_COLUMNS,
+    AdmiralSquidstatWrapper,
+    ChannelState,
+    SampleStore,
+)
+from openTron_electrodeposition.protocol import ProtocolPlan
+
+RING_CAPACITY = 65536
+
+
+class SharedRing:
+    def __init__(self, columns: int, capacity: int = RING_CAPACITY, name: str = None):
+        """Ring buffer of float64 samples in shared memory, written by the
+        worker and read by the orchestrator. The first 8 bytes hold the number
+        of samples read so far, which the writer uses to not overwrite unread
+        samples.
+
+        Args:
+            columns (int): Number of values per sample.
+            capacity (int, optional): Number of samples in the ring. Defaults
+                to RING_CAPACITY.
+            name (str, optional): Name of an existing ring to attach to.
+                Defaults to None, which creates a new ring.
+        """
+        self.columns = columns
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(
+            name=name, create=name is None, size=8 + 8 * columns * capacity
+        )
+        self.name = self.shm.name
+        if name is not None and os.name == "posix":
+            # Attaching registers the memory for removal when this process
+            # ends as well, but it is owned by the process that created it
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self._read = np.ndarray((1,), np.int64, self.shm.buf)
+        self.data = np.ndarray((columns, capacity), np.float64, self.shm.buf, 8)
+        if name is None:
+            self._read[0] = 0
+
+    @property
+    def read_position(self) -> int:
+        """Number of samples read from the ring so far."""
+        return int(self._read[0])
+
+    def put(self, position: int, chunk: np.ndarray) -> None:
+        """Copy samples into the ring. Waits while the ring is full.
+
+        Args:
+            position (int): Number of samples written to the ring before.
+            chunk (np.ndarray): Array of shape (columns, samples), with at
+                most capacity samples.
+        """
+        count = chunk.shape[1]
+        while position + count - self.read_position > self.capacity:
+            time.sleep(0.001)
+        start = position % self.capacity
+        first = min(count, self.capacity - start)
+        self.data[:, start : start + first] = chunk[:, :first]
+        self.data[:, : count - first] = chunk[:, first:]
+
+    def take(self, position: int, count: int) -> np.ndarray:
+        """Copy samples out of the ring and mark them as read.
+
+        Args:
+            position (int): Number of samples written to the ring before the
+                samples to take.
+            count (int): Number of samples to take.
+
+        Returns:
+            np.ndarray: Array of shape (columns, count).
+        """
+        start = position % self.capacity
+        first = min(count, self.capacity - start)
+        chunk = np.concatenate(
+            (self.data[:, start : start + first], self.data[:, : count - first]),
+            axis=1,
+        )
+        self._read[0] = position + count
+        return chunk
+
+    def close(self, unlink: bool = False) -> None:
+        """Release the shared memory. The creator unlinks it."""
+        del self._read, self.data
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class _RingSink:
+    def __init__(self, kind: str, ring: SharedRing, connection):
+        """Internal sink of the worker, which puts the chunks of a
+        ColumnarBuffer in a ring and tells the orchestrator where they are."""
+        self.kind = kind
+        self.ring = ring
+        self.connection = connection
+        self.position = 0
+
+    def write(self, chunk: np.ndarray) -> None:
+        for start in range(0, chunk.shape[1], self.ring.capacity):
+            part = chunk[:, start : start + self.ring.capacity]
+            self.ring.put(self.position, part)
+            self.connection.send(("samples", self.kind, self.position, part.shape[1]))
+            self.position += part.shape[1]
+
+
+class PotentiostatProcess(SampleStore):
+    # The samples are handled as by AdmiralSquidstatWrapper, see SampleStore.
+    # The worker runs on the default channel.
+
+    def __init__(
+        self,
+        port="COM5",
+        instrument_name="Plus1894",
+        chunk_size: int = 64,
+        timeout: float = 60,
+        simulated: bool = False,
+    ):
+        """Run the Admiral potentiostat in a worker process. The instance
+        can be used in place of an AdmiralSquidstatWrapper for running
+        protocol plans, eg. by Experiment.
+
+        Args:
+            port (str, optional): The COM port to which the potentiostat is connected. Defaults to "COM5".
+            instrument_name (str, optional): The name of the instrument. Defaults to "Plus1894".
+            chunk_size (int, optional): Number of samples the worker collects before it sends them. Defaults to 64.
+            timeout (float, optional): Seconds to wait for the worker to connect to the potentiostat. Defaults to 60.
+            simulated (bool, optional): Run the worker on the simulated potentiostat of simulator.py. Defaults to False.
+        """
+        self.threaded = True
+        self.simulated = simulated
+        self._stats = {}
+        self.channel = 0
+        self._channels = {self.channel: ChannelState(self.channel)}
+        self._buffers = {"dc": self.dc_buffer, "ac": self.ac_buffer}
+        self._rings = {
+            "dc": SharedRing(len(DC_COLUMNS)),
+            "ac": SharedRing(len(AC_COLUMNS)),
+        }
+
+        authkey = os.urandom(32)
+        listener = Listener(("localhost", 0), authkey=authkey)
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "openTron_electrodeposition.worker"]
+            + [str(value) for value in listener.address],
+            stdin=subprocess.PIPE,
+        )
+        self._process.stdin.write(authkey.hex().encode() + b"\n")
+        self._process.stdin.close()
+
+        # Accept the connection on a thread, so a worker that fails to start
+        # does not block forever
+        accepted = []
+        acceptor = threading.Thread(
+            target=lambda: accepted.append(listener.accept()), daemon=True
+        )
+        acceptor.start()
+        deadline = time.monotonic() + timeout
+        while acceptor.is_alive() and time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                break
+            acceptor.join(0.1)
+        listener.close()
+        if not accepted:
+            self._close_rings()
+            self._process.kill()
+            self._process = None
+            raise IOError("The potentiostat worker process did not start.")
+        self._connection = accepted[0]
+        self._connection.send(
+            (
+                "connect",
+                port,
+                instrument_name,
+                {kind: ring.name for kind, ring in self._rings.items()},
+                RING_CAPACITY,
+                chunk_size,
+                simulated,
+            )
+        )
+        reply = self._connection.recv()
+        if reply[0] == "error":
+            self.close()
+            raise IOError(f"The potentiostat worker failed to connect: {reply[1]}")
+
+        self._receiver = threading.Thread(
+            target=self._receive, name="PotentiostatProcess", daemon=True
+        )
+        self._receiver.start()
+
+    def __del__(self):
+        self.close()
+
+    def submit_plan(
+        self, plan, sample_surface_area: float
+    ) -> concurrent.futures.Future:
+        """Start a protocol plan in the worker without waiting for it to
+        finish.
+
+        Args:
+            plan (ProtocolPlan): The plan to run
+            sample_surface_area (float): Sample surface area in cm^2
+
+        Returns:
+            concurrent.futures.Future: Resolved with the same list as
+                AdmiralSquidstatWrapper.run_plan() returns
+        """
+        state = self.channel_state()
+        if state.experiment_future is not None and not state.experiment_future.done():
+            raise ValueError("An experiment is already running on the potentiostat.")
+        state.dc_buffer.clear()
+        state.ac_buffer.clear()
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        state.experiment_future = future
+        self._connection.send(("run_plan", plan.spec, sample_surface_area))
+        return future
+
+    def run_plan(self, plan, sample_surface_area: float) -> list:
+        """Run a protocol plan in the worker, see
+        AdmiralSquidstatWrapper.run_plan()."""
+        return self.submit_plan(plan, sample_surface_area).result()
+
+    def _receive(self):
+        """Internal function, handles the messages of the worker."""
+        while True:
+            try:
+                message = self._connection.recv()
+            except (EOFError, OSError):
+                future = self.channel_state().experiment_future
+                if future is not None and not future.done():
+                    future.set_exception(IOError("The potentiostat worker stopped."))
+                return
+            if message[0] == "samples":
+                kind, position, count = message[1:]
+                self._buffers[kind].extend(self._rings[kind].take(position, count))
+            elif message[0] == "done":
+                self._stats = message[2]
+                future = self.channel_state().experiment_future
+                if future is not None and not future.done():
+                    future.set_result(self._results(message[1]))
+            elif message[0] == "error":
+                future = self.channel_state().experiment_future
+                if future is not None and not future.done():
+                    future.set_exception(
+                        IOError(f"The potentiostat worker failed: {message[1]}")
+                    )
+
+    def stats(self, channel: int = None) -> dict:
+        """Instrumentation of the data path of the worker for the last run,
+        see AdmiralSquidstatWrapper.stats().
+
+        Args:
+            channel (int, optional): Not used, the worker runs on one channel.
+
+        Returns:
+            dict: The counters of the last run, empty before the first run
+        """
+        return self._stats
+
+    def _results(self, steps: list) -> list:
+        """Internal function, builds the results of a run from the samples
+        received and the step ranges found by the worker."""
+        results = []
+        for step in steps:
+            dc_start, dc_stop = step["dc_range"] or (None, None)
+            ac_start, ac_stop = step["ac_range"] or (None, None)
+            step["dc_data"] = None
+            step["ac_data"] = None
+            step["dc_range"] = None
+            step["ac_range"] = None
+            if dc_start is not None and dc_stop > dc_start:
+                step["dc_data"] = self.dc_buffer.to_dataframe(dc_start, dc_stop)
+                step["dc_range"] = [dc_start, dc_stop]
+            if ac_start is not None and ac_stop > ac_start:
+                step["ac_data"] = self.ac_buffer.to_dataframe(ac_start, ac_stop)
+                step["ac_range"] = [ac_start, ac_stop]
+            results.append(step)
+        return results
+
+    def close(self):
+        """Stop the worker process and release the shared memory."""
+        if getattr(self, "_process", None) is None:
+            return
+        try:
+            self._connection.send(("close",))
+            self._process.wait(timeout=30)
+        except Exception:
+            self._process.kill()
+        self._process = None
+        self._connection.close()
+        if hasattr(self, "_receiver"):
+            self._receiver.join(timeout=10)
+        self._close_rings()
+
+    def close_experiment(self):
+        """Same as close(), for compatibility with AdmiralSquidstatWrapper."""
+        self.close()
+
+    def _close_rings(self):
+        for ring in self._rings.values():
+            ring.close(unlink=True)
+
+
+def serve(connection) -> None:
+    """Body of the worker process. Connects to the potentiostat and runs the
+    protocol plans sent over the connection until it is told to close.
+
+    Args:
+        connection (multiprocessing.connection.Connection): Connection to the
+            PotentiostatProcess
+    """
+    message = connection.recv()
+    _, port, instrument_name, ring_names, capacity, chunk_size, simulated = message
+    rings = {
+        "dc": SharedRing(len(DC_COLUMNS), capacity, ring_names["dc"]),
+        "ac": SharedRing(len(AC_COLUMNS), capacity, ring_names["ac"]),
+    }
+    try:
+        admiral = AdmiralSquidstatWrapper(
+            port=port, instrument_name=instrument_name, simulated=simulated
+        )
+    except Exception as e:
+        connection.send(("error", repr(e)))
+        return
+    admiral.attach_sinks(
+        dc_sink=_RingSink("dc", rings["dc"], connection),
+        ac_sink=_RingSink("ac", rings["ac"], connection),
+        chunk_size=chunk_size,
+    )
+    connection.send(("ready",))
+
+    plans = {}
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message[0] == "close":
+            break
+        _, spec, sample_surface_area = message
+        try:
+            plan = ProtocolPlan(spec)
+            # Reuse the plan, and with it the elements it has built
+            plan = plans.setdefault(plan.hash, plan)
+            protocol = plan.build(admiral, sample_surface_area)
+            first_event = admiral._run_blocking({None: protocol})[None]
+            dc_ranges, ac_ranges = admiral.step_ranges(
+                protocol, admiral.new_element_list.iloc[first_event:]
+            )
+            stats = admiral.stats()
+            steps = [
+                {
+                    "label": step["label"],
+                    "technique": step["technique"],
+                    "summary": summary,
+                    "stats": step_stats,
+                    "dc_range": dc_range,
+                    "ac_range": ac_range,
+                }
+                for step, summary, step_stats, dc_range, ac_range in zip(
+                    protocol.steps,
+                    admiral.step_summaries,
+                    stats["steps"],
+                    dc_ranges,
+                    ac_ranges,
+                )
+            ]
+            connection.send(("done", steps, stats))
+        except Exception as e:
+            connection.send(("error", repr(e)))
+
+    admiral.detach_sinks()
+    admiral.close_experiment()
+    for ring in rings.values():
+        ring.close()
+
+
+def main():
+    host, port = sys.argv[1], int(sys.argv[2])
+    authkey = bytes.fromhex(sys.stdin.readline().strip())
+    connection = Client((host, port), authkey=authkey)
+    try:
+        serve(connection)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
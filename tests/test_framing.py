@@ -0,0 +1,109 @@
+import struct
+import pytest
+from openTron_electrodeposition import framing
+
+
+def test_crc8_check_value():
+    # Check value of CRC-8 with the polynomial 0x07 and initial value 0
+    assert framing.crc8(b"123456789") == 0xF4
+    assert framing.crc8(b"") == 0
+
+
+def test_encode_frame_layout():
+    frame = framing.encode_frame(7, framing.RELAY_ON, b"\x03")
+    assert frame[:5] == bytes([framing.SYNC, 7, framing.RELAY_ON, 1, 3])
+    assert frame[5] == framing.crc8(frame[1:5])
+
+
+def test_encode_frame_rejects_long_payload():
+    with pytest.raises(ValueError):
+        framing.encode_frame(1, framing.PROGRAM, bytes(framing.MAX_PAYLOAD + 1))
+
+
+@pytest.mark.parametrize(
+    "payload", [b"", b"\x00", b"\xa5\x0a\n", bytes(range(framing.MAX_PAYLOAD))]
+)
+def test_round_trip(payload):
+    opcode = framing.READ_TEMPERATURE | framing.REPLY
+    parser = framing.StreamParser()
+    assert parser.feed(framing.encode_frame(42, opcode, payload)) == [
+        (42, opcode, payload)
+    ]
+    assert parser.dropped == 0
+
+
+def test_round_trip_byte_by_byte():
+    frames = [
+        (1, framing.RELAY_ON | framing.REPLY, b""),
+        (2, framing.READ_TEMPERATURE | framing.REPLY, struct.pack("<f", 21.5)),
+        (0, framing.RELAY_DONE, b"\x04"),
+    ]
+    data = b"".join(framing.encode_frame(*frame) for frame in frames)
+    parser = framing.StreamParser()
+    messages = []
+    for byte in data:
+        messages += parser.feed(bytes([byte]))
+    assert messages == frames
+
+
+def test_frames_and_text_lines():
+    frame = framing.encode_frame(3, framing.PING | framing.REPLY)
+    parser = framing.StreamParser()
+    messages = parser.feed(b"Ready\r\n" + frame + b"Heater on\n")
+    assert messages == ["Ready", (3, framing.PING | framing.REPLY, b""), "Heater on"]
+
+
+def test_wrong_crc_is_dropped():
+    frame = bytearray(framing.encode_frame(5, framing.SETPOINT | framing.REPLY))
+    frame[-1] ^= 0xFF
+    parser = framing.StreamParser()
+    assert parser.feed(bytes(frame)) == []
+    assert parser.dropped > 0
+
+
+def test_resync_after_corrupted_byte():
+    opcode = framing.READ_TEMPERATURE | framing.REPLY
+    corrupted = bytearray(framing.encode_frame(8, opcode, struct.pack("<f", 40.0)))
+    corrupted[5] ^= 0x10
+    good = framing.encode_frame(9, opcode, struct.pack("<f", 41.0))
+    parser = framing.StreamParser()
+    messages = parser.feed(bytes(corrupted) + good)
+    assert messages[-1] == (9, opcode, struct.pack("<f", 41.0))
+    assert all(message[0] != 8 for message in messages if isinstance(message, tuple))
+    assert parser.dropped > 0
+
+
+def test_sync_byte_in_text_is_not_a_frame():
+    frame = framing.encode_frame(4, framing.RELAY_OFF | framing.REPLY)
+    parser = framing.StreamParser()
+    messages = parser.feed(b"\xa5\x01\x02\x03 noise\n" + frame)
+    assert messages[-1] == (4, framing.RELAY_OFF | framing.REPLY, b"")
+
+
+def test_encode_command():
+    assert framing.encode_command("set_relay_on_time,3,2100.0") == (
+        framing.RELAY_ON_TIME,
+        struct.pack("<BI", 3, 2100),
+    )
+    assert framing.encode_command("get_relay_5_state") == (
+        framing.RELAY_STATE,
+        b"\x05",
+    )
+    opcode, payload = framing.encode_command("program,0,0,300,7,0,500")
+    assert opcode == framing.PROGRAM
+    assert len(payload) == framing.payload_length(opcode, payload) == 19
+    with pytest.raises(ValueError):
+        framing.encode_command("unknown")
+
+
+def test_payload_length():
+    assert framing.payload_length(framing.PING, b"") == 0
+    assert framing.payload_length(framing.RELAY_ON_TIME, b"\x01") == 5
+    assert framing.payload_length(framing.PROGRAM, b"") == 1
+    assert framing.payload_length(framing.PROGRAM, b"\x02") == 19
+
+
+def test_decode_response():
+    assert framing.decode_response("value", struct.pack("<f", 22.5)) == 22.5
+    assert framing.decode_response("state", b"\x01") is True
+    assert framing.decode_response("done", b"") is None